@@ -0,0 +1,527 @@
+"""
+Record counts over the log files of apps, rotated and compressed ones
+included, read by a pool of processes.
+
+Usage : python log_analyze.py <log_path> [app_name ...] --level ERROR --by app,bucket --bucket 1m
+        python log_analyze.py <log_path> app --since '2024-05-01' --by logger,site --sort count --top 20
+        python log_analyze.py <log_path> --file request.log --by app,level,bucket --bucket 1h --format json
+
+counts the records of <log_path>/<app_name>/<file> and their rotated
+files, all the apps under log_path by default, grouped by any of
+
+    app     the app, the directory of the file
+    file    the log file name, e.g. info.log
+    level   the level name
+    logger  the logger name
+    site    file:lineno of the logging call
+    bucket  the start of the time bucket holding the record
+
+Text records are told apart by the layouts of the text formatters of
+log_simple_util.LOGGING, 'standard', 'simple' and 'compact', a line not
+matching any of them goes on the previous record. JSON lines and binary
+files are understood as well.
+
+The uncompressed files are mapped with mmap and split into chunk_size
+chunks, a chunk starting and ending on a line boundary, each counted by
+one process of the pool, so a week of logs is counted by all the cores.
+Compressed and binary files can't be split, one process reads each of
+them. The partial counts are merged at the end.
+
+info.log holds the INFO, WARN and ERROR records, and warning.log and
+error.log hold them again, so the files read by default are info and
+critical, the .log and the .bin ones.
+"""
+
+import argparse
+import itertools
+import json
+import mmap
+import multiprocessing
+import os
+import re
+import sys
+import time
+from collections import Counter
+from operator import methodcaller
+if __package__:
+    from . import log_query, log_reader, log_simple_util
+    from .log_formatters import BINARY_MAGIC
+    from .mlogging_handlers import _COMPRESSED_SUFFIXES
+else:
+    import log_query
+    import log_reader
+    import log_simple_util
+    from log_formatters import BINARY_MAGIC
+    from mlogging_handlers import _COMPRESSED_SUFFIXES
+
+DIMENSIONS = ('app', 'file', 'level', 'logger', 'site', 'bucket')
+DEFAULT_FILES = ('info.log', 'critical.log', 'info.bin', 'critical.bin')
+
+# the fields of a record a layout captures, the others are skipped over. The
+# asctime is captured to the minute and the second apart, so that the records
+# of a minute are counted together when the seconds are not needed
+_FIELD_PATTERNS = {
+    'asctime': rb'(?P<minute>\d{4}-\d\d-\d\d \d\d:\d\d):(?P<second>\d\d)[.,]\d{3}',
+    'levelname': rb'(?P<levelname>[A-Z]+)',
+    'name': rb'(?P<name>[^\n]*?)',
+    'filename': rb'(?P<filename>%s)',
+    'lineno': rb'(?P<lineno>\d+)',
+    'thread': rb'\d+',
+    'process': rb'\d+',
+}
+_FORMAT_FIELD = re.compile(r'%\((\w+)\)[-#0 +]*\d*(?:\.\d+)?[a-z]')
+_JSON_STRING = rb'"(?:[^"\\\n]|\\.)*"'
+# a line of log_formatters.JsonFormatter, the message is skipped over and the
+# created time captured to the second
+_JSON_LAYOUT = re.compile(rb'^\{"created":(?P<created>\d+)[0-9.e+-]*,"level":"(?P<levelname>\w+)",'
+                          rb'"logger":(?P<name>' + _JSON_STRING + rb'),"message":' + _JSON_STRING +
+                          rb',"file":(?P<filename>' + _JSON_STRING + rb'),"line":(?P<lineno>\d+)', re.M)
+# lines looked at for the layout of a chunk
+_LAYOUT_LINES = 1000
+
+# the options of the analysis, set in every process of the pool
+_options = None
+_layouts = None
+# the patterns of the layouts anchored on the newline before a record
+# instead of with ^, which the regular expression engine searches faster
+_scans = None
+
+
+def layout_pattern(fmt):
+    """
+    Return the regular expression matching the start of a line written
+    with the %-style format fmt, up to the message, or None if fmt has no
+    asctime or levelname.
+    """
+    fields = _FORMAT_FIELD.findall(fmt)
+    if 'asctime' not in fields or 'levelname' not in fields:
+        return None
+    matches = list(_FORMAT_FIELD.finditer(fmt))
+    parts = [rb'^']
+    pos = 0
+    for i, m in enumerate(matches):
+        parts.append(re.escape(fmt[pos:m.start()].encode('utf-8')))
+        name = m.group(1)
+        if name == 'message':
+            break
+        pos = m.end()
+        # a field followed by a separator such as '|' runs up to it, without
+        # backtracking, the others up to what follows them
+        follow = fmt[pos:matches[i + 1].start()] if i + 1 < len(matches) else fmt[pos:]
+        if follow[:1] and follow[0] not in ' \t' and not follow[0].isalnum():
+            free = rb'[^\n' + re.escape(follow[0].encode('utf-8')) + rb']*'
+        else:
+            free = rb'[^\n]*?'
+        pattern = _FIELD_PATTERNS.get(name, free)
+        parts.append(pattern.replace(b'%s', free) if name == 'filename' else pattern)
+    return re.compile(b''.join(parts), re.M)
+
+
+def text_layouts(logging_conf=None):
+    """
+    Return the patterns of the text formatters of logging_conf,
+    log_simple_util.LOGGING by default, most fields first, as a line of
+    the 'standard' layout also starts like a 'compact' one.
+    """
+    conf = logging_conf or log_simple_util.LOGGING
+    formats = [formatter['format'] for formatter in conf['formatters'].values() if formatter.get('format')]
+    formats.sort(key=lambda fmt: -len(_FORMAT_FIELD.findall(fmt)))
+    return [pattern for pattern in map(layout_pattern, formats) if pattern is not None]
+
+
+def parse_duration(text):
+    """
+    Return the seconds of text, a number with an optional unit s, m, h or
+    d, e.g. '5m'.
+    """
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    if text[-1:] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
+
+
+def _init_worker(options):
+    global _options, _layouts, _scans
+    _options = options
+    _layouts = text_layouts()
+    _scans = {pattern: re.compile(pattern.pattern.replace(b'^', b'\n', 1), re.M)
+              for pattern in _layouts + [_JSON_LAYOUT]}
+
+
+class _Counts(object):
+    """
+    The counts of the records of one task, by the key of the group-by
+    dimensions.
+
+    The matches of a chunk are first counted by the fields they need,
+    as bytes, without a line of Python per record, then each distinct set
+    of fields is filtered, turned into its key and decoded.
+    """
+
+    def __init__(self, app, kind):
+        options = _options
+        self.app = app
+        self.kind = kind
+        self.counts = Counter()
+        self.records = 0
+        self.by = options['by']
+        self.bucket = options['bucket']
+        self.since = options['since']
+        self.until = options['until']
+        self.levels = options['levels']
+        self.use_time = 'bucket' in self.by or self.since is not None or self.until is not None
+        # seconds matter with a time range or buckets which are not whole minutes
+        self.use_second = self.since is not None or self.until is not None or self.bucket % 60 != 0
+        # the epoch seconds of the minutes seen
+        self.minutes = {}
+        # the buckets of the epoch seconds seen
+        self.buckets = {}
+
+    def _fields(self, pattern):
+        """
+        Return the names of the groups of pattern the dimensions need.
+        """
+        names = ['levelname']
+        if 'logger' in self.by:
+            names.append('name')
+        if 'site' in self.by:
+            names += ['filename', 'lineno']
+        if self.use_time:
+            names += ['created'] if pattern is _JSON_LAYOUT else ['minute'] + (['second'] if self.use_second else [])
+        return [name for name in names if name in pattern.groupindex]
+
+    def _epoch(self, fields):
+        created = fields.get('created')
+        if created is not None:
+            return int(created)
+        minute = fields['minute']
+        second = self.minutes.get(minute)
+        if second is None:
+            second = self.minutes[minute] = time.mktime(time.strptime(minute.decode('ascii'), '%Y-%m-%d %H:%M'))
+        return second + int(fields.get('second', 0))
+
+    def _bucket_of(self, second):
+        bucket = self.buckets.get(second)
+        if bucket is None:
+            # aligned on the local time
+            offset = time.localtime(second).tm_gmtoff
+            bucket = self.buckets[second] = second - (second + offset) % self.bucket
+        return bucket
+
+    def _in_range(self, second):
+        return (self.since is None or second >= self.since) and (self.until is None or second <= self.until)
+
+    def add_chunk(self, pattern, buf, start, stop):
+        """
+        Count the records pattern finds in buf[start:stop].
+        """
+        names = self._fields(pattern)
+        # buf[start - 1] is a newline, the first record of buf has none
+        matches = _scans[pattern].finditer(buf, start - 1 if start else 0, stop)
+        if not start:
+            first = pattern.match(buf, 0, stop)
+            matches = itertools.chain([first] if first else [], matches)
+        raw = Counter(map(methodcaller('group', *names), matches))
+        for values, n in raw.items():
+            if len(names) == 1:
+                values = (values,)
+            self._add(dict(zip(names, values)), n)
+
+    def _add(self, fields, n):
+        level = fields['levelname']
+        if self.levels is not None and level not in self.levels:
+            return
+        key = []
+        second = self._epoch(fields) if self.use_time else None
+        if second is not None and not self._in_range(second):
+            return
+        for dimension in self.by:
+            if dimension == 'app':
+                key.append(self.app)
+            elif dimension == 'file':
+                key.append(self.kind)
+            elif dimension == 'level':
+                key.append(level.decode('ascii'))
+            elif dimension == 'logger':
+                key.append(_decode(fields.get('name')))
+            elif dimension == 'site':
+                key.append('%s:%s' % (_decode(fields.get('filename')) or '?', _decode(fields.get('lineno')) or '?'))
+            else:
+                key.append(self._bucket_of(second))
+        self.counts[tuple(key)] += n
+        self.records += n
+
+    def add_record(self, record):
+        """
+        Count a record read by log_reader.
+        """
+        level = (record['levelname'] or '').encode('utf-8')
+        # the reader names the levels as logging does, the files as log_simple_util does
+        if level == b'WARNING':
+            level = b'WARN'
+        fields = {'levelname': level, 'name': (record['name'] or '').encode('utf-8'),
+                  'filename': (record['filename'] or '').encode('utf-8'),
+                  'lineno': str(record['lineno']).encode('ascii'), 'created': record['created'] or 0}
+        self._add(fields, 1)
+
+
+def _decode(value):
+    if value is None:
+        return None
+    if value[:1] == b'"':
+        # a JSON string
+        try:
+            return json.loads(value)
+        except ValueError:
+            pass
+    return value.decode('utf-8', 'replace')
+
+
+def _chunk_layout(buf, start, stop):
+    """
+    Return the pattern matching the records of buf[start:stop], as told
+    by its first lines, or None.
+    """
+    pos = start
+    for _ in range(_LAYOUT_LINES):
+        if pos >= stop:
+            break
+        if buf[pos:pos + 11] == b'{"created":':
+            return _JSON_LAYOUT
+        for pattern in _layouts:
+            if pattern.match(buf, pos, stop):
+                return pattern
+        pos = buf.find(b'\n', pos, stop) + 1
+        if not pos:
+            break
+    return None
+
+
+def _count_chunk(task):
+    """
+    Count the records of the lines starting in [start, stop) of an
+    uncompressed text or JSON lines file mapped up to size bytes.
+    """
+    app, kind, path, start, stop, size = task
+    result = _Counts(app, kind)
+    try:
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        # rotated away, compressed or truncated since it was listed
+        return result
+    try:
+        if start > 0:
+            start = mm.find(b'\n', start - 1, size) + 1 or size
+        if stop < size:
+            stop = mm.find(b'\n', stop - 1, size) + 1 or size
+        pattern = _chunk_layout(mm, start, stop)
+        if pattern is not None:
+            result.add_chunk(pattern, mm, start, stop)
+    finally:
+        mm.close()
+    return result
+
+
+def _count_stream(task):
+    """
+    Count the records of a compressed or binary file, read from the start.
+    """
+    app, kind, path = task[:3]
+    result = _Counts(app, kind)
+    chunk_size = _options['chunk_size']
+    try:
+        with log_reader.open_log(path) as f:
+            head = f.read(2)
+            if head == BINARY_MAGIC:
+                f.seek(0)
+                for record in log_reader.iter_binary(f):
+                    result.add_record(record)
+                return result
+            buf = head
+            pattern = None
+            while True:
+                data = f.read(chunk_size)
+                buf += data
+                stop = len(buf) if not data else buf.rfind(b'\n') + 1
+                if pattern is None:
+                    pattern = _chunk_layout(buf, 0, stop)
+                if pattern is not None:
+                    result.add_chunk(pattern, buf, 0, stop)
+                if not data:
+                    return result
+                buf = buf[stop:]
+    except (FileNotFoundError, EOFError, OSError):
+        # rotated away, or a compressed file not whole yet
+        return result
+
+
+def _run_task(task):
+    result = _count_stream(task) if task[3] is None else _count_chunk(task)
+    # only the counts go back to the parent
+    result.minutes = result.buckets = None
+    return result
+
+
+def make_tasks(log_path, app_names, filenames, chunk_size, since=None):
+    """
+    Return the tasks of the files of app_names, chunks of chunk_size bytes
+    of the uncompressed files and whole compressed or binary files, the
+    biggest first, and the total size of the files. Files last written
+    before since are left out.
+    """
+    tasks = []
+    total = 0
+    for app in app_names:
+        log_dir = os.path.join(log_path, app)
+        for filename in filenames:
+            try:
+                paths = log_query.log_files(log_dir, filename)
+            except FileNotFoundError:
+                continue
+            for path in paths:
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if not st.st_size or since is not None and st.st_mtime < since:
+                    continue
+                total += st.st_size
+                if path.endswith(_COMPRESSED_SUFFIXES) or _is_binary(path):
+                    tasks.append((app, filename, path, None, None, st.st_size))
+                    continue
+                for start in range(0, st.st_size, chunk_size):
+                    tasks.append((app, filename, path, start, min(start + chunk_size, st.st_size), st.st_size))
+    tasks.sort(key=lambda task: -(task[5] if task[3] is None else task[4] - task[3]))
+    return tasks, total
+
+
+def _is_binary(path):
+    with open(path, 'rb') as f:
+        return f.read(2) == BINARY_MAGIC
+
+
+def analyze(log_path, app_names=None, filenames=DEFAULT_FILES, by=('app', 'level', 'bucket'), bucket=60,
+            since=None, until=None, levels=None, jobs=None, chunk_size=16 << 20):
+    """
+    Count the records of filenames and their rotated files under
+    <log_path>/<app_name> for app_names, all the apps by default, created
+    between since and until, of levels only if given.
+
+    Return a dict with the rows, one per key of the by dimensions with its
+    count, and the number of files, bytes and records read. jobs processes
+    read the files, os.cpu_count() by default, 1 reads them in this
+    process.
+    """
+    by = tuple(by)
+    for dimension in by:
+        if dimension not in DIMENSIONS:
+            raise ValueError('unknown dimension %r, not one of %s' % (dimension, ', '.join(DIMENSIONS)))
+    if app_names is None:
+        app_names = sorted(name for name in os.listdir(log_path)
+                           if not name.startswith('.') and os.path.isdir(os.path.join(log_path, name)))
+    if levels is not None:
+        levels = {level.upper().encode('ascii') for level in levels}
+        # WARNING is written as WARN
+        if b'WARNING' in levels:
+            levels.add(b'WARN')
+    options = {'by': by, 'bucket': bucket, 'since': since, 'until': until, 'levels': levels,
+               'chunk_size': chunk_size}
+    started = time.perf_counter()
+    tasks, total = make_tasks(log_path, app_names, filenames, chunk_size, since)
+    jobs = min(jobs or os.cpu_count() or 1, len(tasks)) or 1
+    counts = Counter()
+    records = 0
+    if jobs == 1:
+        _init_worker(options)
+        results = map(_run_task, tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(jobs, initializer=_init_worker, initargs=(options,))
+        results = pool.imap_unordered(_run_task, tasks)
+    try:
+        for result in results:
+            counts.update(result.counts)
+            records += result.records
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    rows = [dict(zip(by, _decode_key(key, by, bucket)), count=count) for key, count in counts.items()]
+    return {'by': list(by), 'bucket': bucket, 'files': len({task[2] for task in tasks}), 'bytes': total,
+            'records': records, 'jobs': jobs, 'seconds': round(time.perf_counter() - started, 3), 'rows': rows}
+
+
+def _decode_key(key, by, bucket):
+    """
+    Return the values of key, the bucket as a local time.
+    """
+    fmt = '%Y-%m-%d %H:%M' if bucket % 60 == 0 else '%Y-%m-%d %H:%M:%S'
+    return [time.strftime(fmt, time.localtime(value)) if dimension == 'bucket' else value
+            for dimension, value in zip(by, key)]
+
+
+def format_table(rows, columns):
+    """
+    Return rows as a text table of columns, count last.
+    """
+    columns = list(columns) + ['count']
+    cells = [[str(row[column]) for column in columns] for row in rows]
+    widths = [max([len(column)] + [len(line[i]) for line in cells]) for i, column in enumerate(columns)]
+    lines = ['  '.join(column.ljust(width) for column, width in zip(columns, widths)).rstrip()]
+    for line in cells:
+        lines.append('  '.join(cell.rjust(width) if i == len(columns) - 1 else cell.ljust(width)
+                               for i, (cell, width) in enumerate(zip(line, widths))).rstrip())
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Count the records of the log files of apps and their rotated '
+                                                 'files, by level, logger, call site and time bucket.')
+    parser.add_argument('log_path')
+    parser.add_argument('app_names', nargs='*', help='the apps to read, all the apps under log_path by default')
+    parser.add_argument('--file', action='append', dest='files',
+                        help='log file name, may be given more than once, info and critical by default')
+    parser.add_argument('--by', default='app,level,bucket',
+                        help='comma separated dimensions among %s, app,level,bucket by default'
+                             % ','.join(DIMENSIONS))
+    parser.add_argument('--bucket', default='1m', help='time bucket, e.g. 30s, 5m, 1h, 1d, 1m by default')
+    parser.add_argument('--since', help="'YYYY-MM-DD HH:MM[:SS]' local time, or epoch seconds")
+    parser.add_argument('--until')
+    parser.add_argument('--level', action='append', dest='levels', help='count only this level, may be repeated')
+    parser.add_argument('--jobs', type=int, default=None, help='processes, the number of CPUs by default')
+    parser.add_argument('--chunk-size', type=int, default=16 << 20, help='bytes per chunk, 16MB by default')
+    parser.add_argument('--format', choices=('table', 'json'), default='table')
+    parser.add_argument('--sort', choices=('key', 'count'), default='key')
+    parser.add_argument('--top', type=int, default=0, help='print only the first rows')
+    options = parser.parse_args(argv)
+    by = [dimension.strip() for dimension in options.by.split(',') if dimension.strip()]
+    try:
+        result = analyze(options.log_path, options.app_names or None, options.files or DEFAULT_FILES, by=by,
+                         bucket=parse_duration(options.bucket),
+                         since=log_query.parse_time(options.since) if options.since else None,
+                         until=log_query.parse_time(options.until) if options.until else None,
+                         levels=options.levels, jobs=options.jobs, chunk_size=options.chunk_size)
+    except ValueError as e:
+        parser.error(str(e))
+    rows = result['rows']
+    if options.sort == 'count':
+        rows.sort(key=lambda row: -row['count'])
+    else:
+        rows.sort(key=lambda row: [str(row[dimension]) for dimension in by])
+    if options.top:
+        del rows[options.top:]
+    if options.format == 'json':
+        sys.stdout.write(json.dumps(result, ensure_ascii=False, indent=2) + '\n')
+    else:
+        sys.stdout.write(format_table(rows, by) + '\n')
+        sys.stderr.write('%d records, %d files, %d bytes, %d processes, %.3fs\n'
+                         % (result['records'], result['files'], result['bytes'], result['jobs'], result['seconds']))
+    return 0
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except BrokenPipeError:
+        sys.exit(1)
@@ -0,0 +1,176 @@
+"""
+asyncio front end for the loggers of log_simple_util.
+
+    logger = get_async_logger('app', log_path)
+    logger.info('request %s done', path)     # never blocks the event loop
+    await logger.flush()                     # wait until written
+    await logger.aclose()                    # or async with, or let asyncio.run() do it
+
+A logging call only makes the record, merges its arguments into the
+message and puts it on the queue of the writer thread of log_simple_util,
+the QueueListenerMP the loggers in async_mode use as well, one per
+process. It takes the records off in batches and writes them through the
+handlers of the synchronous loggers, a batch with one write per file, so
+locks, writes and rollovers all happen off the loop. A logger already in
+async_mode is written by that thread anyway, its records are queued once.
+When queue_size records are waiting already the record is dropped and
+counted, the number of dropped records is logged as a WARN record once
+there is room again. The first record a logger gets from an event loop
+has it closed, its records written, when the loop shuts down, as
+asyncio.run() does on return. Records still queued at interpreter exit
+are written by the exit hook of log_simple_util.
+"""
+
+import asyncio
+import logging
+import threading
+import weakref
+if __package__:
+    from . import mlogging_handlers
+else:
+    import mlogging_handlers
+
+
+class AsyncLogger(logging.Logger):
+    """
+    Logger with the level, filters and caller lookup of logger which
+    hands its records to writer, a QueueListenerMP, through its queue,
+    instead of calling the handlers of logger itself. No more than
+    queue_size records of all loggers are left waiting.
+
+    It is a logging.Logger, debug() to exception() and log() are those of
+    logging, only handle() differs. Logger-level filters, such as a
+    log_filters.LimiterFilter, run in the caller before the record is
+    queued.
+
+    The logger is closed by the shutdown of every event loop it got a
+    record from, see close_on_shutdown().
+    """
+
+    def __init__(self, logger, writer, queue_size=10000):
+        logging.Logger.__init__(self, logger.name, logger.level)
+        self.target = logger
+        self.propagate = False
+        # the same list, filters added later apply as well
+        self.filters = logger.filters
+        # the caller lookup and the record class of the fields profile
+        for name in ('findCaller', 'makeRecord'):
+            if name in logger.__dict__:
+                setattr(self, name, logger.__dict__[name])
+        self.writer = writer
+        self.queue = writer.queue
+        self.queue_size = queue_size
+        # a logger in async_mode has its route already, its handlers are
+        # then a QueueHandler which would queue the records a second time
+        if logger.name not in writer.routes:
+            writer.add_route(logger.name, logger.handlers)
+        self.dropped = 0
+        self._unreported = 0
+        self._close_lock = threading.Lock()
+        # the loop of the last record, and those closing the logger on shutdown
+        self._loop = None
+        self._watched = weakref.WeakSet()
+
+    def isEnabledFor(self, level):
+        """
+        Is this logger enabled for level, as told by the logger it writes
+        for.
+        """
+        return not self.disabled and self.target.isEnabledFor(level)
+
+    def handle(self, record):
+        """
+        Apply the logger-level filters and queue the record without
+        waiting. The message is merged with its arguments here, as they
+        may change before the writer thread formats the record.
+        """
+        if self.disabled or not self.filter(record):
+            return
+        loop = asyncio._get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            if loop is not None and loop not in self._watched:
+                self.close_on_shutdown(loop)
+        record.msg = record.getMessage()
+        record.args = None
+        if self.queue.qsize() >= self.queue_size:
+            self.dropped += 1
+            self._unreported += 1
+            self.writer.metrics.add(mlogging_handlers.DROPS)
+            return
+        self.queue.put_nowait(record)
+        if self._unreported:
+            self._report_drops()
+
+    def _report_drops(self):
+        """
+        Queue a WARN record telling how many records were dropped since the
+        last one.
+        """
+        record = self.makeRecord(self.name, logging.WARNING, '(async logger)', 0,
+                                 'async logger dropped %d records, the queue was full' % self._unreported,
+                                 None, None)
+        self.queue.put_nowait(record)
+        self._unreported = 0
+
+    def snapshot_metrics(self):
+        """
+        Return the records dropped by this logger and the queue depth, the
+        metrics of the writer thread are those of log_simple_util.
+        """
+        return {'dropped': self.dropped, 'queue_size': self.queue_size, 'queue_depth': self.queue.qsize()}
+
+    def close_on_shutdown(self, loop):
+        """
+        Have the logger closed, as by aclose(), when loop shuts down its
+        asynchronous generators, which asyncio.run() does once main() has
+        returned and the tasks left are cancelled, before the default
+        executor is shut down. Loops which don't let shutdown_asyncgens be
+        replaced, those of C extensions, are left alone, aclose() has to be
+        awaited there.
+        """
+        shutdown_asyncgens = loop.shutdown_asyncgens
+
+        async def close_then_shutdown_asyncgens():
+            try:
+                await self.aclose()
+            finally:
+                await shutdown_asyncgens()
+
+        try:
+            loop.shutdown_asyncgens = close_then_shutdown_asyncgens
+        except AttributeError:
+            return
+        self._watched.add(loop)
+
+    async def flush(self):
+        """
+        Wait, without blocking the loop, until the records queued so far
+        are written and the handlers flushed.
+        """
+        await asyncio.get_running_loop().run_in_executor(None, self.writer.flush)
+
+    async def aclose(self):
+        """
+        Wait, without blocking the loop, until the records queued so far
+        are written. Later records are ignored. The writer thread keeps
+        running for the other loggers.
+        """
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    def close(self):
+        """
+        The blocking part of aclose().
+        """
+        with self._close_lock:
+            if self.disabled:
+                return
+            self.disabled = True
+        if self.writer._thread is not None:
+            self.writer.flush()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
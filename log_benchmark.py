@@ -0,0 +1,372 @@
+"""
+Benchmark for the multi-process handlers.
+
+Starts N processes x M threads logging through get_logger (or
+get_request_logger) into a fresh log directory, then reports as JSON :
+
+    records_per_s          : records of all processes per second of wall time
+    latency_us             : p50/p99/p999/max of a single logger call
+    loop_lag_us            : with --event-loop, p50/p99/max of how late the
+                             event loop ran a task waking from a 1 ms sleep
+    syscalls_per_record    : write syscalls of the workers per record
+    bytes_per_record       : bytes written by the workers per record
+    integrity              : torn, duplicated and missing records in the
+                             log files, rotated files included, and the
+                             records an async logger dropped
+
+Usage : python log_benchmark.py --processes 4 --threads 2 --records 20000
+        python log_benchmark.py --atomic-append --rollover --out run.json
+
+--event-loop logs from asyncio tasks instead of threads, 'sync' through
+get_logger, 'async' through get_async_logger. Runs of both, with the same
+options, compare the throughput and the loop lag of the two. With
+--max-loop-lag-ms the exit status is 1 as well if the p99 loop lag is
+above it, 20 ms is what a logging call should never keep a loop from.
+
+--rollover rotates every second (when='S') and has every thread wait for
+the next second halfway through, so records are written across at least
+one rollover. --max-bytes rotates on size as well. The exit status is 1
+if the integrity check fails.
+"""
+
+import argparse
+import array
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+if __package__:
+    from . import log_simple_util
+else:
+    import log_simple_util
+
+APP_NAME = 'bench'
+_line = re.compile(r' - bench p=(\d+) t=(\d+) seq=(\d+) payload=(x*) end$')
+_drop_notice = re.compile(r' - async logger dropped \d+ records')
+
+
+def _read_io():
+    """
+    Return (write syscalls, bytes written) of this process, or (None, None)
+    without /proc.
+    """
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+    except (OSError, ValueError):
+        return None, None
+    return int(fields['syscw']), int(fields['wchar'])
+
+
+def _worker(options, index, barrier, results):
+    kwargs = dict(app_name=APP_NAME, log_path=options.log_path, is_debug=False,
+                  atomic_append=options.atomic_append, async_mode=options.async_mode,
+                  use_collector=options.use_collector, buffer_size=options.buffer_size,
+                  route_levels=options.route_levels, fields=options.fields,
+                  when='S' if options.rollover else 'D', max_bytes=options.max_bytes)
+    # keep the setup banners out of the JSON on stdout
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        if options.event_loop == 'async':
+            logger = log_simple_util.get_async_logger(request=options.request, queue_size=options.queue_size,
+                                                      **kwargs)
+        elif options.request:
+            logger = log_simple_util.get_request_logger(**kwargs)
+        else:
+            logger = log_simple_util.get_logger(**kwargs)
+    payload = 'x' * options.payload
+    latencies = [array.array('q') for _ in range(options.threads)]
+    if options.event_loop:
+        _loop_worker(options, index, barrier, results, logger, payload, latencies)
+        return
+
+    def run(t):
+        timer = time.perf_counter_ns
+        info = logger.info
+        out = latencies[t]
+        # with --rollover every thread crosses a second boundary halfway, forcing at least one rollover
+        pause_at = options.records // 2 if options.rollover else -1
+        for seq in range(options.records):
+            if seq == pause_at:
+                time.sleep(1.05 - time.time() % 1)
+            start = timer()
+            info('bench p=%d t=%d seq=%d payload=%s end', index, t, seq, payload)
+            out.append(timer() - start)
+
+    threads = [threading.Thread(target=run, args=(t,)) for t in range(options.threads)]
+    barrier.wait()
+    syscw, wchar = _read_io()
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    log_simple_util.flush()
+    finished = time.time()
+    syscw_end, wchar_end = _read_io()
+    log_simple_util.close()
+    merged = array.array('q')
+    for out in latencies:
+        merged.extend(out)
+    results.put({
+        'started': started,
+        'finished': finished,
+        'write_syscalls': None if syscw is None else syscw_end - syscw,
+        'bytes_written': None if wchar is None else wchar_end - wchar,
+        'latencies': merged.tobytes(),
+    })
+
+
+def _loop_worker(options, index, barrier, results, logger, payload, latencies):
+    """
+    Log from --threads asyncio tasks on one event loop, each giving the
+    loop back every 10 records as a request handler would, or with --rate
+    sleeping between records to log rate records per second altogether,
+    while a probe task measures how late the loop wakes it up from 1 ms
+    sleeps.
+    """
+    lags = array.array('q')
+
+    async def task(t):
+        timer = time.perf_counter_ns
+        info = logger.info
+        out = latencies[t]
+        pause_at = options.records // 2 if options.rollover else -1
+        interval = options.threads / options.rate if options.rate else 0
+        began = time.perf_counter()
+        for seq in range(options.records):
+            if seq == pause_at:
+                await asyncio.sleep(1.05 - time.time() % 1)
+            start = timer()
+            info('bench p=%d t=%d seq=%d payload=%s end', index, t, seq, payload)
+            out.append(timer() - start)
+            if interval:
+                await asyncio.sleep(max(0, began + (seq + 1) * interval - time.perf_counter()))
+            elif seq % 10 == 9:
+                await asyncio.sleep(0)
+
+    async def probe(done):
+        while not done.is_set():
+            start = time.perf_counter_ns()
+            await asyncio.sleep(0.001)
+            lags.append(time.perf_counter_ns() - start - 1000000)
+
+    async def main():
+        done = asyncio.Event()
+        prober = asyncio.ensure_future(probe(done))
+        await asyncio.gather(*[task(t) for t in range(options.threads)])
+        if options.event_loop == 'async':
+            await logger.flush()
+        done.set()
+        await prober
+
+    barrier.wait()
+    syscw, wchar = _read_io()
+    started = time.time()
+    asyncio.run(main())
+    log_simple_util.flush()
+    finished = time.time()
+    syscw_end, wchar_end = _read_io()
+    dropped = 0
+    if options.event_loop == 'async':
+        logger.close()
+        dropped = logger.dropped
+    log_simple_util.close()
+    merged = array.array('q')
+    for out in latencies:
+        merged.extend(out)
+    results.put({
+        'started': started,
+        'finished': finished,
+        'write_syscalls': None if syscw is None else syscw_end - syscw,
+        'bytes_written': None if wchar is None else wchar_end - wchar,
+        'latencies': merged.tobytes(),
+        'loop_lags': lags.tobytes(),
+        'dropped': dropped,
+    })
+
+
+def _percentile(values, p):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p))] / 1000.0
+
+
+def check_integrity(log_dir, basename, options, dropped=0):
+    """
+    Scan basename and its rotated files in log_dir, return the counts of
+    lines, torn lines, duplicated and missing records. dropped records,
+    those an async logger dropped as its queue was full, are expected to
+    be missing.
+    """
+    seen = set()
+    files = lines = torn = duplicates = 0
+    for name in sorted(os.listdir(log_dir)):
+        if name != basename and not name.startswith(basename + '.'):
+            continue
+        files += 1
+        with open(os.path.join(log_dir, name), 'rb') as f:
+            for raw in f:
+                lines += 1
+                text = raw.decode('utf-8', 'replace').rstrip('\n')
+                if _drop_notice.search(text):
+                    continue
+                match = _line.search(text)
+                if raw[-1:] != b'\n' or match is None or len(match.group(4)) != options.payload:
+                    torn += 1
+                    continue
+                key = match.group(1, 2, 3)
+                if key in seen:
+                    duplicates += 1
+                seen.add(key)
+    expected = options.processes * options.threads * options.records
+    missing = expected - len(seen)
+    return {
+        'files': files,
+        'rotated_files': max(files - 1, 0),
+        'lines': lines,
+        'torn': torn,
+        'duplicates': duplicates,
+        'missing': missing,
+        'dropped': dropped,
+        'ok': torn == 0 and duplicates == 0 and missing == dropped,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(options):
+    """
+    Run one benchmark with the given options, return the result dict.
+    """
+    barrier = multiprocessing.Barrier(options.processes)
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=_worker, args=(options, index, barrier, results))
+               for index in range(options.processes)]
+    for worker in workers:
+        worker.start()
+    reports = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+
+    log_dir = os.path.join(options.log_path, APP_NAME)
+    basename = 'request.log' if options.request else 'info.log'
+    dropped = sum(r.get('dropped', 0) for r in reports)
+    integrity = check_integrity(log_dir, basename, options, dropped)
+    if options.use_collector:
+        # the collector writes after the workers are gone, wait for it
+        deadline = time.time() + options.collector_wait
+        while integrity['missing'] > dropped and time.time() < deadline:
+            time.sleep(0.2)
+            integrity = check_integrity(log_dir, basename, options, dropped)
+
+    latencies = array.array('q')
+    for report in reports:
+        latencies.frombytes(report['latencies'])
+    latencies = sorted(latencies)
+    total = len(latencies)
+    lags = array.array('q')
+    for report in reports:
+        lags.frombytes(report.get('loop_lags', b''))
+    lags = sorted(lags)
+    elapsed = max(r['finished'] for r in reports) - min(r['started'] for r in reports)
+    syscalls = [r['write_syscalls'] for r in reports]
+    written = [r['bytes_written'] for r in reports]
+    syscalls = None if None in syscalls else sum(syscalls)
+    written = None if None in written else sum(written)
+    config = dict(vars(options))
+    del config['log_path'], config['out']
+    return {
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'config': config,
+        'records': total,
+        'elapsed_s': round(elapsed, 6),
+        'records_per_s': round(total / elapsed, 1) if elapsed > 0 else None,
+        'latency_us': {
+            'p50': _percentile(latencies, 0.5),
+            'p99': _percentile(latencies, 0.99),
+            'p999': _percentile(latencies, 0.999),
+            'max': latencies[-1] / 1000.0 if latencies else None,
+        },
+        'loop_lag_us': {
+            'p50': _percentile(lags, 0.5),
+            'p99': _percentile(lags, 0.99),
+            'max': lags[-1] / 1000.0 if lags else None,
+        } if options.event_loop else None,
+        'write_syscalls': syscalls,
+        'syscalls_per_record': round(syscalls / total, 4) if syscalls is not None and total else None,
+        'bytes_written': written,
+        'bytes_per_record': round(written / total, 1) if written is not None and total else None,
+        'integrity': integrity,
+        'loop_lag_ok': _percentile(lags, 0.99) <= options.max_loop_lag_ms * 1000
+        if options.event_loop and options.max_loop_lag_ms and lags else None,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the multi-process log handlers.')
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=1, help='threads per process')
+    parser.add_argument('--records', type=int, default=10000, help='records per thread')
+    parser.add_argument('--payload', type=int, default=100, help='payload bytes per record')
+    parser.add_argument('--request', action='store_true', help='log through get_request_logger')
+    parser.add_argument('--atomic-append', action='store_true')
+    parser.add_argument('--async', dest='async_mode', action='store_true')
+    parser.add_argument('--buffer-size', type=int, default=0)
+    parser.add_argument('--route-levels', action='store_true')
+    parser.add_argument('--fields', choices=('full', 'lean', 'auto'), default='auto')
+    parser.add_argument('--use-collector', action='store_true')
+    parser.add_argument('--collector-wait', type=float, default=30.0,
+                        help='seconds to wait for the collector to write everything')
+    parser.add_argument('--rollover', action='store_true', help="rotate every second, when='S'")
+    parser.add_argument('--max-bytes', type=int, default=0, help='also rotate files once they reach this size')
+    parser.add_argument('--event-loop', choices=('sync', 'async'),
+                        help='log from asyncio tasks, through get_logger (sync) or get_async_logger (async), '
+                             'and measure the event loop lag')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='with --event-loop, records per second and process, as fast as possible by default')
+    parser.add_argument('--queue-size', type=int, default=10000,
+                        help='queue size of get_async_logger, records beyond it are dropped and reported')
+    parser.add_argument('--max-loop-lag-ms', type=float, default=0,
+                        help='with --event-loop, fail if the p99 loop lag is above this many milliseconds')
+    parser.add_argument('--log-path', help='log directory, a temporary one is used and removed by default')
+    parser.add_argument('--out', help='write the JSON result to this file instead of stdout')
+    options = parser.parse_args(argv)
+
+    temporary = options.log_path is None
+    if temporary:
+        options.log_path = tempfile.mkdtemp(prefix='log_benchmark.')
+    try:
+        result = run(options)
+    finally:
+        if temporary:
+            shutil.rmtree(options.log_path, ignore_errors=True)
+    text = json.dumps(result, indent=2)
+    if options.out:
+        with open(options.out, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    return 0 if result['integrity']['ok'] and result['loop_lag_ok'] is not False else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,378 @@
+"""
+Log collector : one local process owns the log files under log_path and
+does the rotation, worker processes ship pre-encoded records to it over a
+unix domain socket instead of taking file locks themselves.
+
+Usage : python log_collector.py <socket_path> <log_root> [idle_timeout]
+
+Wire format, one frame per batch of records of one file :
+
+    !HI header : key length, data length
+    key        : b'<when>|<retention>|<filename>', utf-8, retention being
+                 the JSON of the retention, compression and index options
+    data       : the encoded records, terminators included
+"""
+
+import fcntl
+import json
+import logging
+import os
+import selectors
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+if __package__:
+    from . import mlogging_handlers
+else:
+    import mlogging_handlers
+
+_header = struct.Struct('!HI')
+# frames larger than this are garbage, the connection is dropped
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+# options of TimedRotatingFileHandlerMP a client may pass in a key
+RETENTION_OPTIONS = ('backup_count', 'max_age', 'max_total_bytes', 'compress', 'compress_level', 'index_interval',
+                     'max_bytes')
+
+
+class CollectorClient(object):
+    """
+    Connection of one process to the collector listening on socket_path.
+
+    Records of all the handlers using the same socket are buffered per
+    file and sent as one length-prefixed frame per file, when batch_size
+    bytes are waiting, on an ERROR record, or every flush_interval seconds
+    from a background thread. While the collector can't be reached the
+    records are written directly by the handlers' fallback file handlers.
+    """
+    _clients = {}
+    _clients_lock = threading.Lock()
+
+    def __init__(self, socket_path, log_root, batch_size=65536, flush_interval=0.2, retry_interval=5.0):
+        self.socket_path = socket_path
+        self.log_root = log_root
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_interval = retry_interval
+        self.lock = threading.RLock()
+        self.buffers = {}
+        self.fallbacks = {}
+        self.pending = 0
+        self.sock = None
+        self.pid = None
+        self.next_connect = 0
+        self.started_collector = False
+        self.metrics = mlogging_handlers.HandlerMetrics()
+        self._flusher = None
+        self._start_flusher()
+
+    def _start_flusher(self):
+        self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
+
+    def _after_fork(self):
+        """
+        Let go of what a forked child inherited : the records still
+        buffered, which the parent sends, its connection and its lock. The
+        flusher thread is started again with the first record.
+        """
+        self.lock = threading.RLock()
+        self.buffers = {}
+        self.pending = 0
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self._flusher = None
+        self.metrics = mlogging_handlers.HandlerMetrics()
+
+    @classmethod
+    def get(cls, socket_path, log_root, **kwargs):
+        """
+        Return the client of this process for socket_path.
+        """
+        with cls._clients_lock:
+            client = cls._clients.get(socket_path)
+            if client is None:
+                client = cls._clients[socket_path] = cls(socket_path, log_root, **kwargs)
+            return client
+
+    def register(self, key, fallback):
+        """
+        Register the file handler used for key while the collector is down.
+        """
+        with self.lock:
+            self.fallbacks[key] = fallback
+
+    def _connect(self):
+        """
+        Connect to the collector, starting it once if nobody listens yet.
+        A process only keeps a connection it made itself, a forked child
+        connects again.
+        """
+        if self.sock is not None and self.pid == os.getpid():
+            return True
+        self.sock = None
+        now = time.time()
+        if now < self.next_connect:
+            return False
+        for attempt in range(20):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.socket_path)
+            except OSError:
+                sock.close()
+                if not self.started_collector:
+                    self.started_collector = True
+                    start_collector(self.socket_path, self.log_root)
+                elif attempt == 0:
+                    break
+                time.sleep(0.05)
+                continue
+            self.sock = sock
+            self.pid = os.getpid()
+            return True
+        self.next_connect = now + self.retry_interval
+        return False
+
+    def write(self, key, data, urgent=False):
+        """
+        Queue the encoded records data for key, sending the batch if it is
+        big enough or urgent.
+        """
+        with self.lock:
+            if self._flusher is None:
+                self._start_flusher()
+            buf = self.buffers.get(key)
+            if buf is None:
+                buf = self.buffers[key] = bytearray()
+            buf += data
+            self.pending += len(data)
+            if urgent or self.pending >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        """
+        Send everything buffered, one frame per file, with a single sendall.
+        """
+        with self.lock:
+            if not self.pending:
+                return
+            buffers, self.buffers, self.pending = self.buffers, {}, 0
+            if self._connect():
+                frames = bytearray()
+                for key, data in buffers.items():
+                    encoded_key = key.encode('utf-8')
+                    frames += _header.pack(len(encoded_key), len(data))
+                    frames += encoded_key
+                    frames += data
+                try:
+                    started = time.perf_counter_ns()
+                    self.sock.sendall(frames)
+                    self.metrics.observe(mlogging_handlers.WRITE, time.perf_counter_ns() - started)
+                    self.metrics.add(mlogging_handlers.WRITES)
+                    self.metrics.add(mlogging_handlers.BYTES, len(frames))
+                    return
+                except OSError:
+                    self.sock.close()
+                    self.sock = None
+                    self.next_connect = time.time() + self.retry_interval
+            for key, data in buffers.items():
+                self.fallbacks[key].emit_bytes(bytes(data))
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                pass
+
+
+class CollectorHandler(logging.Handler):
+    """
+    Handler which formats and encodes records in the worker and hands them
+    to the collector process owning filename. If the collector is down,
+    records go to a TimedRotatingFileHandlerMP on the same file instead, a
+    HybridRotatingFileHandlerMP if max_bytes is set.
+    The retention, compression and index options are those of that
+    handler, the collector applies them to the files it writes.
+    """
+
+    def __init__(self, filename, socket_path, when='D', encoding=None, atomic_append=False,
+                 batch_size=65536, flush_interval=0.2, backup_count=0, max_age=0, max_total_bytes=0,
+                 compress=None, compress_level=6, index_interval=0, max_bytes=0):
+        logging.Handler.__init__(self)
+        self.metrics = mlogging_handlers.HandlerMetrics()
+        self.baseFilename = os.path.abspath(filename)
+        self.encoding = encoding or 'utf-8'
+        retention = dict(backup_count=backup_count, max_age=max_age, max_total_bytes=max_total_bytes,
+                         compress=compress, compress_level=compress_level, index_interval=index_interval,
+                         max_bytes=max_bytes)
+        self.key = '%s|%s|%s' % (when, json.dumps(retention, sort_keys=True, separators=(',', ':')),
+                                 self.baseFilename)
+        self.fallback = mlogging_handlers.timed_file_handler(self.baseFilename, when=when, encoding=encoding,
+                                                             delay=True, atomic_append=atomic_append, **retention)
+        log_root = os.path.dirname(os.path.dirname(self.baseFilename))
+        self.client = CollectorClient.get(socket_path, log_root, batch_size=batch_size,
+                                          flush_interval=flush_interval)
+        self.client.register(self.key, self.fallback)
+
+    def emit(self, record):
+        try:
+            if getattr(self.formatter, 'binary', False):
+                data = self.formatter.format_bytes(record)
+            else:
+                data = (self.format(record) + '\n').encode(self.encoding)
+            self.metrics.add(mlogging_handlers.RECORDS)
+            self.client.write(self.key, data, urgent=record.levelno >= logging.ERROR)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+    def handleError(self, record):
+        self.metrics.add(mlogging_handlers.ERRORS)
+        logging.Handler.handleError(self, record)
+
+    def snapshot_metrics(self):
+        """
+        Return the metrics of the handler, with those of the connection,
+        shared by the handlers of the process, under 'client' and those of
+        the fallback file handler under 'fallback'.
+        """
+        result = self.metrics.snapshot()
+        result['client'] = self.client.metrics.snapshot()
+        result['fallback'] = self.fallback.snapshot_metrics()
+        return result
+
+    def flush(self):
+        self.client.flush()
+
+    def close(self):
+        self.flush()
+        self.fallback.close()
+        logging.Handler.close(self)
+
+
+def _after_fork():
+    CollectorClient._clients_lock = threading.Lock()
+    for client in CollectorClient._clients.values():
+        client._after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def start_collector(socket_path, log_root, idle_timeout=300):
+    """
+    Start a collector process in the background, detached from the caller.
+    If one is running already the new one exits right away.
+    """
+    subprocess.Popen([sys.executable, os.path.abspath(__file__), socket_path, log_root, str(idle_timeout)],
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                     close_fds=True, start_new_session=True)
+
+
+class LogCollector(object):
+    """
+    The collector process : accepts connections on socket_path, reads
+    frames and writes them through one timed_file_handler() per file, for
+    files under log_root only. It exits after idle_timeout seconds without
+    any client.
+    """
+
+    def __init__(self, socket_path, log_root, idle_timeout=300):
+        self.socket_path = socket_path
+        self.log_root = os.path.realpath(log_root)
+        self.idle_timeout = idle_timeout
+        self.handlers = {}
+        self.buffers = {}
+        self.selector = selectors.DefaultSelector()
+
+    def _handler(self, key):
+        handler = self.handlers.get(key)
+        if handler is None:
+            when, retention, filename = key.split('|', 2)
+            filename = os.path.realpath(filename)
+            if not filename.startswith(self.log_root + os.sep):
+                raise ValueError('%s is not under %s' % (filename, self.log_root))
+            retention = json.loads(retention)
+            if not isinstance(retention, dict) or not set(retention) <= set(RETENTION_OPTIONS):
+                raise ValueError('invalid retention options %r' % retention)
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            handler = mlogging_handlers.timed_file_handler(filename, when=when, delay=True, atomic_append=True,
+                                                           **retention)
+            self.handlers[key] = handler
+        return handler
+
+    def _read(self, conn):
+        buf = self.buffers[conn]
+        try:
+            data = conn.recv(1 << 20)
+        except OSError:
+            data = b''
+        if not data:
+            self._drop(conn)
+            return
+        buf += data
+        while len(buf) >= _header.size:
+            key_len, data_len = _header.unpack_from(buf)
+            if data_len > MAX_FRAME_SIZE:
+                self._drop(conn)
+                return
+            end = _header.size + key_len + data_len
+            if len(buf) < end:
+                break
+            key = bytes(buf[_header.size:_header.size + key_len]).decode('utf-8')
+            try:
+                self._handler(key).emit_bytes(bytes(buf[_header.size + key_len:end]))
+            except (OSError, ValueError):
+                pass
+            del buf[:end]
+
+    def _drop(self, conn):
+        self.selector.unregister(conn)
+        del self.buffers[conn]
+        conn.close()
+
+    def serve(self):
+        lock_file = open(self.socket_path + '.lock', 'w')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            # another collector owns this socket
+            lock_file.close()
+            return
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        server.listen(128)
+        self.selector.register(server, selectors.EVENT_READ)
+        idle_since = time.time()
+        try:
+            while True:
+                for key, _ in self.selector.select(timeout=1):
+                    if key.fileobj is server:
+                        conn, _ = server.accept()
+                        self.buffers[conn] = bytearray()
+                        self.selector.register(conn, selectors.EVENT_READ)
+                    else:
+                        self._read(key.fileobj)
+                if self.buffers:
+                    idle_since = time.time()
+                elif time.time() - idle_since > self.idle_timeout:
+                    break
+        finally:
+            os.remove(self.socket_path)
+            server.close()
+            for handler in self.handlers.values():
+                handler.close()
+            lock_file.close()
+
+
+if __name__ == '__main__':
+    LogCollector(sys.argv[1], sys.argv[2], float(sys.argv[3]) if len(sys.argv) > 3 else 300).serve()
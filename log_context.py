@@ -0,0 +1,344 @@
+"""
+Request scoped context for the loggers of log_simple_util.
+
+    request_logger = get_request_logger('app', log_path, request_summary=True)
+    with log_context.request(request_logger, route='/users', request_id=rid, user=uid) as ctx:
+        request_logger.info('parsed')            # route=/users request_id=... user=... parsed
+        with log_context.timed('db'):
+            ...
+        log_context.count('cache_miss')
+        ctx.set(status=200)
+
+The fields of the request are kept in a contextvars.ContextVar, so every
+thread and asyncio task sees its own, and tasks started during a request
+share it. They are rendered once into a 'key=value ' prefix, which
+RequestContextFilter puts in front of the message of every record of the
+loggers it is attached to, or, for the JSON and binary formats, sets on
+the record as extra fields.
+
+In summary mode the records below summary_level of the request logger
+are not written one by one during a request : their messages, the
+timings and counters of the request and its duration go into a single
+record written when it ends. With histogram_interval the durations are
+also counted per route, in power of two buckets, and every
+histogram_interval seconds one record per route tells the count, the
+mean, p50, p99 and max. Routes are meant to be templates such as
+'/users/{id}', past max_routes of them the others are counted together.
+"""
+
+import contextvars
+import logging
+import os
+import threading
+import time
+import weakref
+if __package__:
+    from .mlogging_handlers import _BUCKETS, _bucket_percentile
+else:
+    from mlogging_handlers import _BUCKETS, _bucket_percentile
+
+_current = contextvars.ContextVar('log_tool_request', default=None)
+
+
+class RequestContext(object):
+    """
+    The fields bound to a request, their rendered prefix, and what the
+    summary of the request is made of.
+    """
+    __slots__ = ('fields', 'prefix', 'route', 'request', 'started', 'timings', 'counters', 'events', 'suppressed')
+
+    def __init__(self, fields, route=None, request=True):
+        self.fields = fields
+        self.prefix = _render(fields)
+        self.route = route
+        # False for fields bound outside of a request, which has no summary
+        self.request = request
+        self.started = time.perf_counter()
+        self.timings = {}
+        self.counters = {}
+        self.events = []
+        self.suppressed = 0
+
+    def set(self, **fields):
+        """
+        Bind more fields to the request, such as its status once known.
+        """
+        self.fields.update(fields)
+        self.prefix = _render(self.fields)
+
+    def add_time(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+        self.counters[name] = self.counters.get(name, 0) + 1
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+
+def _render(fields):
+    return ''.join('%s=%s ' % item for item in fields.items())
+
+
+def current():
+    """
+    Return the RequestContext of the running request, or None.
+    """
+    return _current.get()
+
+
+def bind(**fields):
+    """
+    Bind fields to the running request, or outside of one to the current
+    thread or task until unbind() is called with the returned token.
+    """
+    ctx = _current.get()
+    if ctx is not None:
+        ctx.set(**fields)
+        return None
+    return _current.set(RequestContext(fields, request=False))
+
+
+def unbind(token):
+    if token is not None:
+        _current.reset(token)
+
+
+class request(object):
+    """
+    Context manager making a request of the fields, route first. When it
+    ends the RequestContextFilter of logger writes the summary of the
+    request and counts its duration for the route.
+    """
+
+    def __init__(self, logger, route=None, **fields):
+        if route is not None:
+            fields = dict(route=route, **fields)
+        self.logger = logger
+        self.ctx = RequestContext(fields, route)
+        self.token = None
+
+    def __enter__(self):
+        self.token = _current.set(self.ctx)
+        return self.ctx
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _current.reset(self.token)
+        ctx = self.ctx
+        if exc_type is not None and 'error' not in ctx.fields:
+            ctx.set(error=exc_type.__name__)
+        for f in self.logger.filters:
+            if isinstance(f, RequestContextFilter):
+                f.end(ctx)
+        return False
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        return self.__exit__(exc_type, exc_value, tb)
+
+
+class timed(object):
+    """
+    Context manager adding the time spent in it to the timing name of the
+    running request, and counting it. Outside of a request it does
+    nothing.
+    """
+    __slots__ = ('name', 'ctx', 'started')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.ctx = _current.get()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.ctx is not None:
+            self.ctx.add_time(self.name, time.perf_counter() - self.started)
+        return False
+
+
+def count(name, n=1):
+    """
+    Add n to the counter name of the running request, if there is one.
+    """
+    ctx = _current.get()
+    if ctx is not None:
+        ctx.count(name, n)
+
+
+class RequestContextFilter(logging.Filter):
+    """
+    Logger filter adding the fields of the running request to its records,
+    as a prefix of the message or, with structured, as extra fields.
+
+    With summary, records below summary_level logged during a request are
+    kept for its summary instead, up to max_events messages, the summary
+    being written at the end of the request. With histogram_interval, the
+    durations of the requests are counted per route and written out every
+    histogram_interval seconds from a background thread.
+    """
+
+    def __init__(self, name='', structured=False, summary=False, summary_level=logging.WARNING, max_events=32,
+                 histogram_interval=0, max_routes=1000):
+        logging.Filter.__init__(self, name)
+        self.structured = structured
+        self.summary = summary
+        self.summary_level = summary_level
+        self.max_events = max_events
+        self.histogram_interval = histogram_interval
+        self.max_routes = max_routes
+        # route -> [count, total ns, max ns] + buckets
+        self.routes = {}
+        self.summaries = 0
+        self.logger = None
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def attach(self, logger):
+        """
+        Add the filter to logger, whose handlers write the summaries.
+        """
+        self.logger = logger
+        logger.addFilter(self)
+        return self
+
+    def filter(self, record):
+        ctx = _current.get()
+        if ctx is None:
+            return True
+        if self.summary and ctx.request and record.levelno < self.summary_level:
+            if len(ctx.events) < self.max_events:
+                ctx.events.append(record.getMessage())
+            ctx.suppressed += 1
+            return False
+        if self.structured:
+            attrs = record.__dict__
+            for key, value in ctx.fields.items():
+                if key not in attrs:
+                    attrs[key] = value
+        else:
+            record.msg = ctx.prefix + record.getMessage()
+            record.args = None
+        return True
+
+    def end(self, ctx):
+        """
+        Called when the request of ctx ends : count its duration for its
+        route and write its summary.
+        """
+        seconds = time.perf_counter() - ctx.started
+        if self.histogram_interval and ctx.route is not None:
+            self._observe(ctx.route, seconds)
+        if self.summary:
+            self.summaries += 1
+            self._emit(self._summary_record(ctx, seconds))
+
+    def _summary_record(self, ctx, seconds):
+        values = [('duration_ms', round(seconds * 1e3, 3))]
+        for name, total in ctx.timings.items():
+            values.append((name + '_ms', round(total * 1e3, 3)))
+        for name, n in ctx.counters.items():
+            values.append((name, n))
+        if ctx.suppressed:
+            values.append(('records', ctx.suppressed))
+        events = '; '.join(ctx.events)
+        if ctx.suppressed > len(ctx.events):
+            events += '; ...'
+        if self.structured:
+            msg = 'request summary' + (' | ' + events if events else '')
+        else:
+            msg = ctx.prefix + ' '.join('%s=%s' % value for value in values) + (' | ' + events if events else '')
+        record = self.logger.makeRecord(self.logger.name, logging.INFO, '(request summary)', 0, msg, None, None)
+        if self.structured:
+            record.__dict__.update(ctx.fields)
+            record.__dict__.update(values)
+        return record
+
+    def _observe(self, route, seconds):
+        ns = int(seconds * 1e9)
+        with self.lock:
+            stats = self.routes.get(route)
+            if stats is None:
+                if len(self.routes) >= self.max_routes:
+                    route = '(other)'
+                    stats = self.routes.get(route)
+                if stats is None:
+                    stats = self.routes[route] = [0, 0, 0] + [0] * _BUCKETS
+            stats[0] += 1
+            stats[1] += ns
+            if ns > stats[2]:
+                stats[2] = ns
+            stats[3 + min(ns.bit_length(), _BUCKETS - 1)] += 1
+            if self.thread is None:
+                _filters.add(self)
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    @staticmethod
+    def _route_stats(stats):
+        count, total, longest = stats[:3]
+        # the percentiles are the upper bounds of their buckets, no more than the max
+        return {'count': count, 'mean_ms': round(total / count / 1e6, 3),
+                'p50_ms': round(min(_bucket_percentile(stats[3:], count, 0.5) * 1e3, longest) / 1e6, 3),
+                'p99_ms': round(min(_bucket_percentile(stats[3:], count, 0.99) * 1e3, longest) / 1e6, 3),
+                'max_ms': round(longest / 1e6, 3)}
+
+    def flush_histograms(self):
+        """
+        Write one record per route with the durations counted since the
+        last call, and start counting again.
+        """
+        with self.lock:
+            routes, self.routes = self.routes, {}
+        for route, stats in sorted(routes.items()):
+            values = self._route_stats(stats)
+            if self.structured:
+                msg = 'route latency in the last %gs' % self.histogram_interval
+            else:
+                msg = 'route=%s %s interval_s=%g' % (route, ' '.join('%s=%s' % item for item in values.items()),
+                                                     self.histogram_interval)
+            record = self.logger.makeRecord(self.logger.name, logging.INFO, '(route histogram)', 0, msg, None, None)
+            if self.structured:
+                record.route = route
+                record.__dict__.update(values)
+            self._emit(record)
+
+    def _emit(self, record):
+        if self.logger is not None:
+            # not through the filters of the logger, straight to its handlers
+            self.logger.callHandlers(record)
+
+    def _run(self):
+        while True:
+            time.sleep(self.histogram_interval)
+            try:
+                self.flush_histograms()
+            except Exception:
+                pass
+
+    def snapshot_metrics(self):
+        """
+        Return the number of summaries written, and the durations counted
+        per route since the last histogram record.
+        """
+        with self.lock:
+            routes = {route: self._route_stats(stats) for route, stats in self.routes.items()}
+        return {'summaries': self.summaries, 'routes': routes}
+
+
+# the histogram thread does not survive a fork, the child starts it again
+# and does not write out the durations counted by the parent
+_filters = weakref.WeakSet()
+
+
+def _after_fork():
+    for f in _filters:
+        f.thread = None
+        f.lock = threading.Lock()
+        f.routes = {}
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
@@ -2,6 +2,11 @@
 # @Author  : lirui
 # @ qq     : 270239148
 import logging
+import os
+import random
+import threading
+import time
+import weakref
 
 
 class NoDebugFilter(logging.Filter):
@@ -16,37 +21,248 @@ class DebugFilter(logging.Filter):
         return True
 
 
-class InfoFilter(logging.Filter):
+class LevelRangeFilter(logging.Filter):
+    # 按record.levelno过滤，只放行min <= levelno <= max的日志，与等级名称无关
+    # LOGGING中配置：{'()': 'log_filters.LevelRangeFilter', 'min': 20, 'max': 40}
+
+    def __init__(self, name='', min=logging.NOTSET, max=logging.CRITICAL):
+        super().__init__(name)
+        self.min = logging._checkLevel(min)
+        self.max = logging._checkLevel(max)
 
     def filter(self, record):
-        level = record.levelname.upper()
-        if level in {'INFO', 'WARNING', 'ERROR'}:
-            return True
-        return False
+        return self.min <= record.levelno <= self.max
 
 
-class WarningFilter(logging.Filter):
+class LevelSetFilter(logging.Filter):
+    # 按record.levelno过滤，只放行levels中的等级，levels预先编译为位掩码
+    # LOGGING中配置：{'()': 'log_filters.LevelSetFilter', 'levels': [20, 30, 40]}，等级也可以写名称
+
+    def __init__(self, name='', levels=()):
+        super().__init__(name)
+        self.mask = 0
+        for level in levels:
+            self.mask |= 1 << logging._checkLevel(level)
 
     def filter(self, record):
-        level = record.levelname.upper()
-        if level == 'WARNING':
-            return True
-        return False
+        return self.mask >> record.levelno & 1
 
 
-class ErrorFilter(logging.Filter):
+class InfoFilter(LevelSetFilter):
 
-    def filter(self, record):
-        level = record.levelname.upper()
-        if level == 'ERROR':
-            return True
-        return False
+    def __init__(self, name=''):
+        super().__init__(name, levels=(logging.INFO, logging.WARNING, logging.ERROR))
+
+
+class WarningFilter(LevelSetFilter):
+
+    def __init__(self, name=''):
+        super().__init__(name, levels=(logging.WARNING,))
+
+
+class ErrorFilter(LevelSetFilter):
+
+    def __init__(self, name=''):
+        super().__init__(name, levels=(logging.ERROR,))
+
+
+class CriticalFilter(LevelSetFilter):
+
+    def __init__(self, name=''):
+        super().__init__(name, levels=(logging.CRITICAL,))
+
+
+class LimiterFilter(logging.Filter):
+    # 限流过滤器，挂在logger上，在日志格式化、handler加锁和写文件之前决定是否丢弃，被丢弃的日志只需几次查表
+    # levels：{等级: (每秒条数, 突发条数)}，按等级的令牌桶，如{'ERROR': (10, 100)}
+    # site_rate、site_burst：每个调用位置(pathname:lineno)的令牌桶，site_rate为0时不限
+    # sample_rates：{等级: 保留比例}，如{'INFO': 0.1}随机保留10%的INFO日志
+    # dedup_window：秒，窗口内重复的同一条日志（同一格式串和参数）只保留第一条，窗口结束后补一条重复次数
+    # summary_interval：秒，有日志被丢弃时，定期以一条WARN日志汇总丢弃的原因和条数
+    # 限流按进程计算，多进程时总量为各进程之和
 
+    def __init__(self, name='', levels=None, site_rate=0, site_burst=None, sample_rates=None, dedup_window=0,
+                 summary_interval=60):
+        super().__init__(name)
+        now = time.time()
+        self.buckets = {}
+        for level, (rate, burst) in (levels or {}).items():
+            self.buckets[logging._checkLevel(level)] = [burst, now, rate, burst]
+        self.site_rate = site_rate
+        self.site_burst = site_burst or max(site_rate, 1)
+        self.sites = {}
+        self.sample_rates = {logging._checkLevel(level): rate for level, rate in (sample_rates or {}).items()}
+        self.dedup_window = dedup_window
+        # 重复日志：key -> [窗口结束时间, 被合并的条数, 最后一条被合并的record]
+        self.repeats = {}
+        self.summary_interval = summary_interval
+        # 本次汇总以来的丢弃条数，(原因, 等级或调用位置) -> 条数，以及启动以来按原因的累计条数
+        self.dropped = {}
+        self.totals = {'sampled': 0, 'rate': 0, 'site': 0, 'repeated': 0}
+        self.next_summary = now + summary_interval
+        self.logger = None
+        self.lock = threading.Lock()
+        self.thread = None
 
-class CriticalFilter(logging.Filter):
+    # 挂到logger上，汇总日志经logger的handler写出
+    def attach(self, logger):
+        self.logger = logger
+        logger.addFilter(self)
+        return self
 
     def filter(self, record):
-        level = record.levelname.upper()
-        if level == 'CRITICAL':
+        levelno = record.levelno
+        rate = self.sample_rates.get(levelno)
+        if rate is not None and random.random() >= rate:
+            with self.lock:
+                self._drop('sampled', record.levelname)
+            return False
+        if not (self.dedup_window or self.buckets or self.site_rate):
             return True
-        return False
+        now = record.created
+        repeated = None
+        keep = True
+        with self.lock:
+            if self.dedup_window:
+                key = self._repeat_key(record)
+                repeat = self.repeats.get(key)
+                if repeat is not None and now < repeat[0]:
+                    repeat[1] += 1
+                    repeat[2] = record
+                    self._drop('repeated', record.levelname)
+                    return False
+                if repeat is not None and repeat[1]:
+                    repeated = self._repeated_record(repeat)
+                self.repeats[key] = [now + self.dedup_window, 0, None]
+                # 过期的窗口由汇总线程清理
+                self._start_thread()
+            bucket = self.buckets.get(levelno)
+            if bucket is not None and not _take(bucket, now):
+                self._drop('rate', record.levelname)
+                keep = False
+            elif self.site_rate:
+                # 跳过了findCaller时没有行号，按格式串区分调用位置
+                site = (record.pathname, record.lineno) if record.lineno else record.msg
+                bucket = self.sites.get(site)
+                if bucket is None:
+                    bucket = self.sites[site] = [self.site_burst, now, self.site_rate, self.site_burst]
+                if not _take(bucket, now):
+                    self._drop('site', site)
+                    keep = False
+        if repeated is not None:
+            # 上一个窗口的重复次数先于本条写出，本条被限流丢弃时也照样写出，否则重复次数就丢了
+            self._emit(repeated)
+        return keep
+
+    @staticmethod
+    def _repeat_key(record):
+        key = (record.name, record.levelno, record.msg, record.args)
+        try:
+            hash(key)
+        except TypeError:
+            key = (record.name, record.levelno, record.getMessage())
+        return key
+
+    # 记一条丢弃
+    def _drop(self, reason, where):
+        self.totals[reason] += 1
+        key = (reason, where)
+        self.dropped[key] = self.dropped.get(key, 0) + 1
+        self._start_thread()
+
+    # 第一次丢弃或去重时启动汇总线程
+    def _start_thread(self):
+        if self.thread is None:
+            _limiters.add(self)
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    # 由最后一条被合并的日志生成"重复N次"的日志，不带异常信息
+    def _repeated_record(self, repeat):
+        _, count, last = repeat
+        record = logging.makeLogRecord(dict(last.__dict__))
+        record.msg = '%s [repeated %d more times in %gs]' % (last.getMessage(), count, self.dedup_window)
+        record.args = None
+        record.exc_info = record.exc_text = record.stack_info = None
+        return record
+
+    def _summary_record(self, dropped, now):
+        total = sum(dropped.values())
+        parts = []
+        for (reason, where), count in sorted(dropped.items(), key=lambda item: -item[1])[:10]:
+            if isinstance(where, tuple):
+                where = '%s:%d' % where
+            parts.append('%s %s %d' % (reason, where, count))
+        msg = 'limiter dropped %d records in the last %gs: %s' % (total, self.summary_interval, ', '.join(parts))
+        record = self.logger.makeRecord(self.logger.name, logging.WARNING, '(limiter)', 0, msg, None, None)
+        record.created = now
+        return record
+
+    # 补写窗口已结束的重复次数，到时间时写出丢弃汇总，由后台线程调用
+    def flush_summary(self, now=None):
+        now = time.time() if now is None else now
+        records = []
+        with self.lock:
+            for key, repeat in list(self.repeats.items()):
+                if repeat[0] <= now:
+                    if repeat[1]:
+                        records.append(self._repeated_record(repeat))
+                    del self.repeats[key]
+            if self.dropped and now >= self.next_summary:
+                records.append(self._summary_record(self.dropped, now))
+                self.dropped = {}
+            if now >= self.next_summary:
+                self.next_summary = now + self.summary_interval
+        for record in records:
+            self._emit(record)
+
+    def _emit(self, record):
+        if self.logger is not None:
+            # 不经过logger的过滤器，直接交给handler
+            self.logger.callHandlers(record)
+
+    def _run(self):
+        interval = min(self.summary_interval, self.dedup_window or self.summary_interval)
+        while True:
+            time.sleep(interval / 2)
+            try:
+                self.flush_summary()
+            except Exception:
+                pass
+
+    # 监控指标：启动以来按原因的丢弃条数
+    def snapshot_metrics(self):
+        result = dict(self.totals)
+        result['dropped'] = sum(self.totals.values())
+        return result
+
+
+# 令牌桶：[令牌数, 上次时间, 每秒条数, 突发条数]，有令牌时取走一个并返回True
+def _take(bucket, now):
+    tokens = bucket[0]
+    # 多线程时record.created不一定递增，时间不前进时不补充令牌
+    if now > bucket[1]:
+        tokens += (now - bucket[1]) * bucket[2]
+        if tokens > bucket[3]:
+            tokens = bucket[3]
+        bucket[1] = now
+    if tokens >= 1:
+        bucket[0] = tokens - 1
+        return True
+    bucket[0] = tokens
+    return False
+
+
+# 汇总线程不会随fork复制，子进程中清空线程、锁和父进程的丢弃条数，下一次丢弃时重新启动
+_limiters = weakref.WeakSet()
+
+
+def _after_fork():
+    for limiter in _limiters:
+        limiter.thread = None
+        limiter.lock = threading.Lock()
+        limiter.dropped = {}
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,472 @@
+"""
+Follow the log files of one or more apps as they are written, like
+tail -F, across rotations.
+
+Usage : python log_follow.py <log_path> <app_name> [<app_name> ...] [--file request.log]
+                             [--checkpoint <file>] [--from-start] [--once]
+
+prints the records appended to <log_path>/<app_name>/<file> of every app,
+binary records as text lines. follow() yields the same as a generator.
+
+The handlers rotate a file by renaming it, processes which still have the
+old file open may write to it for a moment, until they notice. A follower
+keeps the renamed file open and goes on reading it for drain_time seconds,
+while it reads the new file from its start. A file which shrinks under
+the offset read so far, truncated by some other tool, is read again from
+its start. Directories are watched with inotify, through ctypes, where
+there is one, polled every poll_interval seconds otherwise.
+
+Data is read into one buffer per file with readinto, in chunks of up to
+chunk_size bytes, and handed out as a memoryview of the whole records in
+it, text lines or binary records, without a copy. The view is only valid
+until the next one is asked for.
+
+With a checkpoint file the (inode, offset) reached in every file is saved
+every checkpoint_interval seconds and when the generator is closed, a
+record counting as read once the next one is asked for. A follower which
+starts again goes on from there: if the file was rotated in the meantime
+it is found by its inode among the rotated files, which are read first,
+files rotated after it included. Records are delivered at least once, a
+file compressed since the checkpoint is read again from its start.
+"""
+
+import argparse
+import ctypes
+import io
+import json
+import os
+import select
+import struct
+import sys
+import time
+if __package__:
+    from . import log_query
+    from . import log_reader
+    from .log_formatters import BINARY_MAGIC, BINARY_PREFIX_SIZE
+    from .mlogging_handlers import _COMPRESSED_SUFFIXES
+else:
+    import log_query
+    import log_reader
+    from log_formatters import BINARY_MAGIC, BINARY_PREFIX_SIZE
+    from mlogging_handlers import _COMPRESSED_SUFFIXES
+
+# IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+_IN_MASK = 0x2 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200
+# magic and length of a binary record
+_binary_prefix = struct.Struct('<2sI')
+
+
+class _Inotify(object):
+    """
+    Wakes the follower up when something happens in the watched
+    directories, through the inotify calls of libc.
+    """
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        # raises AttributeError without inotify
+        self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.watched = set()
+
+    def watch(self, directory):
+        """
+        Watch directory, unless it does not exist yet, it is tried again
+        on the next call.
+        """
+        if directory in self.watched:
+            return
+        if self.libc.inotify_add_watch(self.fd, os.fsencode(directory), _IN_MASK) >= 0:
+            self.watched.add(directory)
+
+    def wait(self, timeout):
+        """
+        Wait until something happens or timeout seconds have passed. The
+        events themselves are thrown away, the followers look at the files.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if readable:
+            try:
+                while os.read(self.fd, 65536):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _Poller(object):
+    """
+    Wakes the follower up every poll_interval seconds, where there is no
+    inotify.
+    """
+
+    def watch(self, directory):
+        pass
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+
+    def close(self):
+        pass
+
+
+def _watcher():
+    try:
+        return _Inotify()
+    except (AttributeError, OSError):
+        return _Poller()
+
+
+class _Source(object):
+    """
+    A log file being read, from offset on, compressed ones read once from
+    their start.
+    """
+
+    def __init__(self, path, offset=0):
+        self.path = path
+        self.compressed = path.endswith(_COMPRESSED_SUFFIXES)
+        if self.compressed:
+            self.f = log_reader.open_log(path)
+            self.inode = None
+            offset = 0
+        else:
+            self.f = open(path, 'rb', buffering=0)
+            st = os.fstat(self.f.fileno())
+            self.inode = st.st_ino
+            if offset > st.st_size:
+                # truncated since the checkpoint
+                offset = 0
+        self.offset = offset
+        self.binary = None
+        self.until = None
+
+    def size(self):
+        return os.fstat(self.f.fileno()).st_size
+
+    def close(self):
+        self.f.close()
+
+
+class Follower(object):
+    """
+    Follows the log file path, yielding the whole records appended to it.
+
+    poll() reads whatever was written since the last call, state() and
+    the state argument save and restore the position, see follow().
+    """
+
+    def __init__(self, path, state=None, from_start=False, drain_time=5.0, chunk_size=1 << 20):
+        self.path = os.path.abspath(path)
+        self.drain_time = drain_time
+        self.buf = bytearray(chunk_size)
+        self.current = None
+        # rotated files still read, see poll()
+        self.draining = []
+        # (path, offset, inode) of the rotated files to read before the
+        # live file, those rotated while nobody followed or between polls
+        self.backlog = []
+        # files modified since are not read yet
+        self.since = time.time()
+        self._resume(state, from_start)
+
+    def _resume(self, state, from_start):
+        """
+        Set up where reading starts : the checkpointed positions, or the
+        start or the end of the live file.
+        """
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            st = None
+        if state is None:
+            if st is not None:
+                self.current = _Source(self.path, 0 if from_start else st.st_size)
+            return
+        offsets = dict(state['files'])
+        self.since = state['time']
+        self._find_rotated(offsets)
+        if st is not None:
+            self.current = _Source(self.path, offsets.get(st.st_ino, 0))
+
+    def _find_rotated(self, offsets):
+        """
+        Add to the backlog the rotated files which may hold records not
+        read yet : those of offsets, a dict of inode to the offset reached
+        in them, and those modified since self.since, from their start.
+        """
+        try:
+            paths = log_query.log_files(os.path.dirname(self.path), os.path.basename(self.path))
+        except FileNotFoundError:
+            return
+        backlog = {entry[0] for entry in self.backlog}
+        for path in paths:
+            if path == self.path or path in backlog:
+                continue
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            compressed = path.endswith(_COMPRESSED_SUFFIXES)
+            if not compressed and st.st_ino in offsets:
+                self.backlog.append((path, offsets[st.st_ino], st.st_ino))
+            elif st.st_mtime >= self.since:
+                self.backlog.append((path, 0, None if compressed else st.st_ino))
+
+    def state(self):
+        """
+        Return the positions to start again from : the inode and offset of
+        every file not read to its end, and the time after which files
+        unknown to it may have been written to.
+        """
+        files = [(inode, offset) for _, offset, inode in self.backlog if inode is not None]
+        files += [(source.inode, source.offset) for source in self.draining + [self.current]
+                  if source is not None and source.inode is not None]
+        return {'files': files, 'time': self.since}
+
+    def poll(self):
+        """
+        Yield memoryviews of the whole records written since the last call,
+        in file order: those of rotated files left over or still drained,
+        then those of the live file.
+        """
+        now = time.time()
+        yield from self._read_backlog()
+        for source in list(self.draining):
+            yield from self._read(source)
+            if now >= source.until:
+                self.draining.remove(source)
+                source.close()
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            st = None
+        current = self.current
+        if current is not None and (st is None or st.st_ino != current.inode):
+            # renamed away or deleted : read the rest, and what the other
+            # processes still write to it for drain_time seconds
+            yield from self._read(current)
+            current.until = now + self.drain_time
+            self.draining.append(current)
+            self.current = current = None
+            # rotated more than once since the last poll
+            self._find_rotated({source.inode: source.offset for source in self.draining})
+            self.backlog = [entry for entry in self.backlog
+                            if entry[2] not in {source.inode for source in self.draining}]
+            yield from self._read_backlog()
+        if current is None and st is not None:
+            try:
+                self.current = current = _Source(self.path, 0)
+            except FileNotFoundError:
+                current = None
+        if current is not None:
+            if current.size() < current.offset:
+                current.offset = 0
+            yield from self._read(current)
+        # a second of slack for mtimes, which are not taken at the same time as ours
+        self.since = now - 1
+
+    def _read_backlog(self):
+        while self.backlog:
+            path, offset, inode = self.backlog[0]
+            try:
+                source = _Source(path, offset)
+            except FileNotFoundError:
+                self.backlog.pop(0)
+                continue
+            if inode is not None and source.inode != inode:
+                # renamed over since it was listed
+                source.close()
+                self.backlog.pop(0)
+                continue
+            self.backlog[0] = (path, offset, source.inode)
+            try:
+                for data in self._read(source):
+                    self.backlog[0] = (path, source.offset, source.inode)
+                    yield data
+                    self.backlog[0] = (path, source.offset + len(data), source.inode)
+            finally:
+                source.close()
+            self.backlog.pop(0)
+
+    def _read(self, source):
+        """
+        Yield memoryviews of the whole records of source from its offset
+        to its end, moving the offset past each once the next is asked for.
+        A record not whole yet is read again by the next call.
+        """
+        if not source.compressed:
+            source.f.seek(source.offset)
+        fill = 0
+        while True:
+            buf = self.buf
+            view = memoryview(buf)
+            n = source.f.readinto(view[fill:])
+            if not n:
+                return
+            fill += n
+            if source.binary is None:
+                source.binary = self._is_binary(source, view, fill)
+            cut = self._whole(buf, fill) if source.binary else buf.rfind(b'\n', 0, fill) + 1
+            if not cut:
+                if fill == len(buf):
+                    # a record longer than the buffer
+                    self.buf = buf + bytearray(len(buf))
+                continue
+            yield view[:cut]
+            source.offset += cut
+            buf[:fill - cut] = buf[cut:fill]
+            fill -= cut
+
+    @staticmethod
+    def _is_binary(source, view, fill):
+        """
+        Tell whether source holds binary records, from its first bytes.
+        """
+        if source.offset == 0:
+            head = bytes(view[:2])
+        elif not source.compressed:
+            head = os.pread(source.f.fileno(), 2, 0)
+        else:
+            head = b''
+        return head == BINARY_MAGIC if len(head) == 2 else None
+
+    @staticmethod
+    def _whole(buf, fill):
+        """
+        Return the end of the last whole binary record in buf[:fill]. Bytes
+        which are not a record are passed on with the records around them.
+        """
+        unpack = _binary_prefix.unpack_from
+        pos = 0
+        while fill - pos >= BINARY_PREFIX_SIZE:
+            magic, length = unpack(buf, pos)
+            if magic != BINARY_MAGIC or length > log_reader.MAX_RECORD_SIZE:
+                found = buf.find(BINARY_MAGIC, pos + 1, fill)
+                if found < 0:
+                    return fill - 1
+                pos = found
+                continue
+            end = pos + BINARY_PREFIX_SIZE + length
+            if end > fill:
+                break
+            pos = end
+        return pos
+
+    def close(self):
+        for source in self.draining + [self.current]:
+            if source is not None:
+                source.close()
+        self.draining = []
+        self.current = None
+
+
+def load_checkpoint(path):
+    """
+    Return the positions saved in the checkpoint file path, by file.
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_checkpoint(path, states):
+    """
+    Save the positions states to the checkpoint file path, replacing it
+    at once.
+    """
+    part = '%s.%d.part' % (path, os.getpid())
+    with open(part, 'w') as f:
+        json.dump(states, f)
+    os.replace(part, path)
+
+
+def follow(log_path, app_names, filename='request.log', checkpoint=None, from_start=False, once=False,
+           poll_interval=1.0, drain_time=5.0, checkpoint_interval=1.0, chunk_size=1 << 20):
+    """
+    Yield (app_name, data) for the records written to filename of every
+    app of app_names under log_path, data being a memoryview of one or
+    more whole records, valid until the next item.
+
+    Without a checkpoint, or for a file it does not know, reading starts at
+    the end of the file, at its start with from_start. With once, the
+    generator returns once it has caught up instead of waiting for more.
+    """
+    states = load_checkpoint(checkpoint) if checkpoint else {}
+    followers = []
+    for app_name in app_names:
+        path = os.path.abspath(os.path.join(log_path, app_name, filename))
+        followers.append((app_name, Follower(path, states.get(path), from_start, drain_time, chunk_size)))
+    watcher = _watcher()
+    saved_at = time.time()
+    try:
+        while True:
+            for app_name, follower in followers:
+                watcher.watch(os.path.dirname(follower.path))
+                for data in follower.poll():
+                    yield app_name, data
+            if checkpoint and time.time() - saved_at >= checkpoint_interval:
+                _save(checkpoint, states, followers)
+                saved_at = time.time()
+            if once:
+                return
+            watcher.wait(poll_interval)
+    finally:
+        if checkpoint:
+            _save(checkpoint, states, followers)
+        watcher.close()
+        for _, follower in followers:
+            follower.close()
+
+
+def _save(checkpoint, states, followers):
+    for _, follower in followers:
+        state = follower.state()
+        if state is not None:
+            states[follower.path] = state
+    save_checkpoint(checkpoint, states)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Print the records written to the log files of apps, '
+                                                 'following rotations.')
+    parser.add_argument('log_path')
+    parser.add_argument('app_names', nargs='+', metavar='app_name')
+    parser.add_argument('--file', default='request.log', help='log file name, request.log by default')
+    parser.add_argument('--checkpoint', help='file to save the position in and start again from')
+    parser.add_argument('--from-start', action='store_true',
+                        help='read files the checkpoint does not know from their start, not their end')
+    parser.add_argument('--once', action='store_true', help='exit once everything written so far is printed')
+    parser.add_argument('--poll-interval', type=float, default=1.0,
+                        help='seconds between looks at the files without inotify, 1 by default')
+    options = parser.parse_args(argv)
+    out = sys.stdout.buffer
+    records = follow(options.log_path, options.app_names, options.file, options.checkpoint, options.from_start,
+                     options.once, options.poll_interval)
+    try:
+        for app_name, data in records:
+            if data[:2] == BINARY_MAGIC:
+                for record in log_reader.iter_binary(io.BytesIO(data)):
+                    out.write((log_reader.format_record(record) + '\n').encode('utf-8'))
+            else:
+                out.write(data)
+            out.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        records.close()
+    return 0
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except BrokenPipeError:
+        sys.exit(1)
@@ -0,0 +1,298 @@
+"""
+Formatters for log_tool.
+
+FastFormatter   : a drop-in logging.Formatter for '%' style format strings,
+                  producing byte-identical output for less work per record
+JsonFormatter   : one JSON object per line, written without building a dict
+BinaryFormatter : length-prefixed binary records, read back by log_reader
+
+apply_fields_profile() lets a logger skip the caller lookup (findCaller) and
+the thread/process capture when no formatter of its handlers needs them.
+"""
+
+import collections.abc
+import json
+import logging
+import operator
+import os
+import re
+import struct
+import time
+
+_field = re.compile(r'%%|%\((\w+)\)')
+_word = re.compile(r'\w+')
+
+# record attributes filled in by Logger.findCaller
+CALLER_FIELDS = frozenset(('pathname', 'filename', 'module', 'lineno', 'funcName'))
+# record attributes filled in from the current thread and process
+THREAD_FIELDS = frozenset(('thread', 'threadName', 'process', 'processName'))
+
+# attributes every LogRecord has, any other attribute came from extra=
+RECORD_ATTRS = frozenset(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime', 'taskName'}
+# record attributes the structured formatters write
+STRUCTURED_FIELDS = frozenset(('created', 'levelno', 'name', 'message', 'pathname', 'filename', 'lineno',
+                               'funcName', 'thread', 'process'))
+
+_encode_string = json.encoder.encode_basestring
+
+# binary record : magic, length of the rest, then the fixed fields and the
+# lengths of name, message, filename, funcName, exception, stack and extra
+BINARY_MAGIC = b'LG'
+binary_header = struct.Struct('<2sIdBIIQHIHHIII')
+# size of the magic and the length, which the length does not count
+BINARY_PREFIX_SIZE = 6
+
+if isinstance(logging._startTime, int):
+    # time.time_ns() since Python 3.13
+    _start_time = logging._startTime / 1e9
+else:
+    _start_time = logging._startTime
+
+
+class FastFormatter(logging.Formatter):
+    """
+    Formatter which compiles its '%' style format string once.
+
+    '%(name)s' fields are turned into a positional template plus one
+    attrgetter fetching all the fields of a record in a single call, and
+    the asctime text is cached for the current wall-clock second so only
+    the milliseconds are filled in per record. Set it up from the
+    formatters section of LOGGING with 'class': 'log_formatters.FastFormatter'.
+    Other styles are handed to logging.Formatter unchanged.
+    """
+
+    def __init__(self, fmt=None, datefmt=None, style='%', *args, **kwargs):
+        logging.Formatter.__init__(self, fmt, datefmt, style, *args, **kwargs)
+        self._getter = None
+        self._time_cache = (None, None)
+        if style != '%':
+            return
+        names = []
+
+        def positional(match):
+            if match.group(1) is None:
+                return '%%'
+            names.append(match.group(1))
+            return '%'
+
+        self._template = _field.sub(positional, self._fmt)
+        if names:
+            getter = operator.attrgetter(*names)
+            self._getter = getter if len(names) > 1 else (lambda record: (getter(record),))
+        self._uses_time = 'asctime' in names
+
+    def formatTime(self, record, datefmt=None):
+        """
+        Return the creation time of the record as formatted text, reusing
+        the text of the previous record when it fell in the same second.
+        """
+        if datefmt:
+            return logging.Formatter.formatTime(self, record, datefmt)
+        second = int(record.created)
+        cached_second, t = self._time_cache
+        if second != cached_second:
+            t = time.strftime(self.default_time_format, self.converter(record.created))
+            self._time_cache = (second, t)
+        if self.default_msec_format:
+            t = self.default_msec_format % (t, record.msecs)
+        return t
+
+    def format(self, record):
+        """
+        Format the specified record as text, as logging.Formatter does.
+        """
+        if self._getter is None:
+            return logging.Formatter.format(self, record)
+        record.message = record.getMessage()
+        if self._uses_time:
+            record.asctime = self.formatTime(record, self.datefmt)
+        try:
+            s = self._template % self._getter(record)
+        except AttributeError as e:
+            raise ValueError('Formatting field not found in record: %s' % e)
+        if record.exc_info:
+            # Cache the traceback text to avoid converting it multiple times
+            # (it's constant anyway)
+            if not record.exc_text:
+                record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            if s[-1:] != "\n":
+                s = s + "\n"
+            s = s + record.exc_text
+        if record.stack_info:
+            if s[-1:] != "\n":
+                s = s + "\n"
+            s = s + self.formatStack(record.stack_info)
+        return s
+
+
+def extra_fields(record):
+    """
+    Return the (name, value) pairs of the attributes set on record with
+    extra=, or an empty list.
+    """
+    return [(key, value) for key, value in record.__dict__.items() if key not in RECORD_ATTRS]
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formatter which writes a record as one line of JSON :
+
+        {"created": ..., "level": ..., "logger": ..., "message": ..., "file": ...,
+         "line": ..., "func": ..., "thread": ..., "process": ..., <extra fields>,
+         "exc_info": ..., "stack_info": ...}
+
+    The line is put together from the record's attributes with the C
+    string encoder of the json module, no dict is built on the way. extra=
+    fields are written with json.dumps, values it can't encode as their
+    repr(). exc_info and stack_info are only there when the record has one.
+    """
+    record_fields = STRUCTURED_FIELDS
+
+    def format(self, record):
+        """
+        Format the specified record as a line of JSON.
+        """
+        encode = _encode_string
+        thread = record.thread
+        process = record.process
+        s = '{"created":%r,"level":%s,"logger":%s,"message":%s,"file":%s,"line":%d,"func":%s,' \
+            '"thread":%s,"process":%s' % (
+                record.created, encode(record.levelname), encode(record.name), encode(record.getMessage()),
+                encode(record.filename), record.lineno or 0, encode(record.funcName or ''),
+                'null' if thread is None else thread, 'null' if process is None else process)
+        for key, value in extra_fields(record):
+            s += ',%s:%s' % (encode(key), json.dumps(value, ensure_ascii=False, default=repr))
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            s += ',"exc_info":' + encode(record.exc_text)
+        if record.stack_info:
+            s += ',"stack_info":' + encode(self.formatStack(record.stack_info))
+        return s + '}'
+
+
+class BinaryFormatter(logging.Formatter):
+    """
+    Formatter which encodes a record as a length-prefixed binary record :
+    a fixed size header packed with binary_header (magic, length of the
+    rest, created, levelno, lineno, process, thread and the lengths of the
+    strings), followed by name, message, filename, funcName, exception
+    text, stack and the extra= fields as JSON, utf-8.
+
+    The handlers of mlogging_handlers write the bytes of format_bytes()
+    as they are, without a terminator. log_reader decodes them.
+    """
+    binary = True
+    record_fields = STRUCTURED_FIELDS
+
+    def format_bytes(self, record):
+        """
+        Encode the specified record.
+        """
+        name = record.name.encode('utf-8')
+        message = record.getMessage().encode('utf-8', 'replace')
+        filename = record.filename.encode('utf-8')
+        func = (record.funcName or '').encode('utf-8')
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        exc = record.exc_text.encode('utf-8', 'replace') if record.exc_text else b''
+        stack = self.formatStack(record.stack_info).encode('utf-8', 'replace') if record.stack_info else b''
+        extra = extra_fields(record)
+        extra = json.dumps(dict(extra), ensure_ascii=False, default=repr).encode('utf-8') if extra else b''
+        length = binary_header.size - BINARY_PREFIX_SIZE + len(name) + len(message) + len(filename) + \
+            len(func) + len(exc) + len(stack) + len(extra)
+        header = binary_header.pack(BINARY_MAGIC, length, record.created, record.levelno, record.lineno or 0,
+                                    record.process or 0, record.thread or 0, len(name), len(message),
+                                    len(filename), len(func), len(exc), len(stack), len(extra))
+        return b''.join((header, name, message, filename, func, exc, stack, extra))
+
+
+class LeanLogRecord(logging.LogRecord):
+    """
+    LogRecord which leaves thread, threadName, process and processName at
+    None instead of asking the threading and multiprocessing modules.
+    """
+
+    def __init__(self, name, level, pathname, lineno, msg, args, exc_info, func=None, sinfo=None, **kwargs):
+        ct = time.time()
+        self.name = name
+        self.msg = msg
+        # a dictionary as the sole argument, see logging.LogRecord
+        if args and len(args) == 1 and isinstance(args[0], collections.abc.Mapping) and args[0]:
+            args = args[0]
+        self.args = args
+        self.levelname = logging.getLevelName(level)
+        self.levelno = level
+        self.pathname = pathname
+        self.filename = os.path.basename(pathname)
+        self.module = os.path.splitext(self.filename)[0]
+        self.exc_info = exc_info
+        self.exc_text = None
+        self.stack_info = sinfo
+        self.lineno = lineno
+        self.funcName = func
+        self.created = ct
+        self.msecs = int((ct - int(ct)) * 1000) + 0.0
+        self.relativeCreated = (ct - _start_time) * 1000
+        self.thread = None
+        self.threadName = None
+        self.processName = None
+        self.process = None
+        self.taskName = None
+
+
+def formatter_fields(formatter):
+    """
+    Return the names a formatter's format string refers to, a superset of
+    the record attributes it uses, or None if it can't be told.
+    """
+    if formatter is None:
+        return {'message'}
+    if getattr(formatter, 'record_fields', None) is not None:
+        return set(formatter.record_fields)
+    fmt = getattr(getattr(formatter, '_style', None), '_fmt', None)
+    if type(formatter).format not in (logging.Formatter.format, FastFormatter.format) or fmt is None:
+        return None
+    return set(_word.findall(fmt))
+
+
+def apply_fields_profile(logger, fields='auto'):
+    """
+    Make logger skip the work for record attributes nobody reads.
+
+    fields is 'full' to keep everything, 'lean' to skip both the caller
+    lookup and the thread/process capture, or 'auto' to skip whichever of
+    them no formatter of the logger's handlers refers to.
+    """
+    if fields == 'full':
+        return
+    need_caller = need_thread = False
+    if fields == 'auto':
+        for handler in logger.handlers:
+            names = formatter_fields(handler.formatter)
+            if names is None:
+                return
+            need_caller = need_caller or not names.isdisjoint(CALLER_FIELDS)
+            need_thread = need_thread or not names.isdisjoint(THREAD_FIELDS)
+    elif fields != 'lean':
+        raise ValueError("fields must be 'full', 'lean' or 'auto': %r" % fields)
+
+    if not need_caller:
+        def find_caller(stack_info=False, stacklevel=1):
+            if stack_info:
+                # a stack was asked for, walk it, one frame further up
+                return logging.Logger.findCaller(logger, stack_info, stacklevel + 1)
+            return "(unknown file)", 0, "(unknown function)", None
+        logger.findCaller = find_caller
+
+    if not need_thread:
+        def make_record(name, level, fn, lno, msg, args, exc_info, func=None, extra=None, sinfo=None):
+            rv = LeanLogRecord(name, level, fn, lno, msg, args, exc_info, func, sinfo)
+            if extra is not None:
+                for key in extra:
+                    if (key in ["message", "asctime"]) or (key in rv.__dict__):
+                        raise KeyError("Attempt to overwrite %r in LogRecord" % key)
+                    rv.__dict__[key] = extra[key]
+            return rv
+        logger.makeRecord = make_record
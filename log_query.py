@@ -0,0 +1,348 @@
+"""
+Time range queries over the log files of an app, rotated and compressed
+ones included.
+
+Usage : python log_query.py <log_path> <app_name> --start '2024-05-01 14:03' --end '2024-05-01 14:05'
+        python log_query.py <log_path> <app_name> --file request.log --start 1714572180 --end 1714572300
+
+prints the records of <log_path>/<app_name>/<file> and its rotated files
+created between start and end, in file order. Text, JSON lines and binary
+files are understood, binary records are printed as text lines.
+
+With index_interval set, the file handlers keep a sparse index of every
+log file in <file>.idx, (created, offset) entries packed with
+mlogging_handlers.index_entry. A file whose index tells it holds nothing
+of the range is skipped, and in the others the range is found by binary
+search in the index and only those bytes are read through mmap, so a
+query costs O(log n + output). Files without an index are scanned.
+
+Records of several processes are not written in exactly the order they
+were created, the index is searched skew seconds wider than the range and
+every record is checked against the range itself. A file may be appended
+to during the query, it is read up to its size when opened, without the
+last record if it is not whole yet.
+"""
+
+import argparse
+import bisect
+import io
+import mmap
+import os
+import sys
+import time
+if __package__:
+    from . import log_reader
+    from .log_formatters import BINARY_MAGIC, BINARY_PREFIX_SIZE, binary_header
+    from .mlogging_handlers import INDEX_SUFFIX, index_entry, _COMPRESSED_SUFFIXES
+else:
+    import log_reader
+    from log_formatters import BINARY_MAGIC, BINARY_PREFIX_SIZE, binary_header
+    from mlogging_handlers import INDEX_SUFFIX, index_entry, _COMPRESSED_SUFFIXES
+
+# text records start with the asctime of the formatters, e.g. '2024-05-01 14:03:00.123'
+_TIME_SIZE = 23
+_JSON_PREFIX = b'{"created":'
+
+
+class _Index(object):
+    """
+    The entries of a .idx file, mapped. Only whole entries are seen, the
+    file may be appended to.
+    """
+
+    def __init__(self, path):
+        self.mm = None
+        self.count = 0
+        try:
+            with open(path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                self.count = size // index_entry.size
+                if self.count:
+                    self.mm = mmap.mmap(f.fileno(), self.count * index_entry.size, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            pass
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        """
+        Return the created time of entry i, which is what bisect looks at.
+        """
+        return index_entry.unpack_from(self.mm, i * index_entry.size)[0]
+
+    def entry(self, i):
+        return index_entry.unpack_from(self.mm, i * index_entry.size)
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+
+def parse_time(text):
+    """
+    Return the epoch seconds of text, either a number or a local time as
+    'YYYY-MM-DD HH:MM[:SS[.fff]]', with a space or a 'T' in the middle.
+    """
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    text = text.replace('T', ' ')
+    fraction = 0.0
+    if '.' in text:
+        text, ms = text.split('.', 1)
+        fraction = float('0.' + ms)
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(text, fmt)) + fraction
+        except ValueError:
+            continue
+    raise ValueError('invalid time %r' % text)
+
+
+def log_files(log_dir, filename):
+    """
+    Return the paths of filename and its rotated files in log_dir, oldest
+    first, the live file last.
+    """
+    files = []
+    for name in os.listdir(log_dir):
+        if not name.startswith(filename + '.') or name.endswith((INDEX_SUFFIX, '.part')):
+            continue
+        path = os.path.join(log_dir, name)
+        try:
+            files.append((os.stat(path).st_mtime, path))
+        except FileNotFoundError:
+            continue
+    files.sort()
+    paths = [path for _, path in files]
+    live = os.path.join(log_dir, filename)
+    if os.path.exists(live):
+        paths.append(live)
+    return paths
+
+
+def _line_time(line, seconds):
+    """
+    Return the created time of the record a text or JSON line starts, or
+    None for a line which goes on the previous record, such as a line of a
+    traceback. seconds caches the epoch seconds of the timestamps seen.
+    """
+    if line.startswith(_JSON_PREFIX):
+        end = line.find(b',', len(_JSON_PREFIX))
+        try:
+            return float(line[len(_JSON_PREFIX):end])
+        except ValueError:
+            return None
+    if len(line) < _TIME_SIZE or line[4:5] != b'-' or line[13:14] != b':' or line[19:20] not in (b'.', b','):
+        return None
+    key = line[:19]
+    second = seconds.get(key)
+    if second is None:
+        try:
+            second = time.mktime(time.strptime(key.decode('ascii'), '%Y-%m-%d %H:%M:%S'))
+        except (UnicodeDecodeError, ValueError):
+            return None
+        seconds[key] = second
+    try:
+        return second + int(line[20:23]) / 1000.0
+    except ValueError:
+        return None
+
+
+def _text_in_range(buf, offset, stop, start, end, skew, final):
+    """
+    Yield (created, data) for the text or JSON records of buf[offset:stop]
+    created between start and end, data being the record's lines. stop is
+    at the end of a line. Return the offset to go on from, at the start of
+    the last record unless final, as more of its lines may follow, or
+    None once records are past end by more than skew.
+    """
+    seconds = {}
+    record_start = None
+    created = None
+    pos = offset
+    while pos < stop:
+        eol = buf.find(b'\n', pos, stop)
+        if eol < 0:
+            break
+        line_time = _line_time(buf[pos:min(pos + 64, eol)], seconds)
+        if line_time is not None:
+            if record_start is not None and start <= created <= end:
+                yield created, buf[record_start:pos]
+            if line_time > end + skew:
+                return None
+            record_start = pos
+            created = line_time
+        pos = eol + 1
+    if record_start is None:
+        return pos if not final else stop
+    if not final:
+        return record_start
+    if start <= created <= end:
+        yield created, buf[record_start:pos]
+    return pos
+
+
+def _binary_in_range(buf, offset, stop, start, end, skew):
+    """
+    Yield (created, data) for the whole binary records of buf[offset:stop]
+    created between start and end, skipping bytes which are not a record.
+    Return the offset of the first record which is not whole, or None once
+    records are past end by more than skew.
+    """
+    unpack = binary_header.unpack_from
+    header_size = binary_header.size
+    while stop - offset >= header_size:
+        header = unpack(buf, offset)
+        if header[0] != BINARY_MAGIC:
+            found = buf.find(BINARY_MAGIC, offset + 1, stop)
+            if found < 0:
+                return stop - 1
+            offset = found
+            continue
+        record_end = offset + BINARY_PREFIX_SIZE + header[1]
+        if header_size + sum(header[7:]) != record_end - offset:
+            offset += 1
+            continue
+        if record_end > stop:
+            return offset
+        created = header[2]
+        if created > end + skew:
+            return None
+        if start <= created <= end:
+            yield created, buf[offset:record_end]
+        offset = record_end
+    return offset
+
+
+def _index_range(index, size, start, end, skew):
+    """
+    Return the (begin, stop) offsets holding the records between start
+    and end, as told by the index, within a file of size bytes.
+    """
+    if not len(index):
+        return 0, size
+    i = bisect.bisect_left(index, start - skew)
+    begin = index.entry(i - 1)[1] if i > 0 else 0
+    j = bisect.bisect_right(index, end + skew)
+    stop = index.entry(j)[1] if j < len(index) else size
+    return min(begin, size), max(min(stop, size), min(begin, size))
+
+
+def _query_mapped(f, index, start, end, skew):
+    """
+    Yield the records of the uncompressed file f between start and end,
+    reading only the bytes the index points to.
+    """
+    size = os.fstat(f.fileno()).st_size
+    if not size:
+        return
+    mm = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    try:
+        begin, stop = _index_range(index, size, start, end, skew)
+        if mm[:2] == BINARY_MAGIC:
+            yield from _binary_in_range(mm, begin, stop, start, end, skew)
+            return
+        if begin > 0 and mm[begin - 1:begin] != b'\n':
+            # not the start of a line, a bad entry, go on from the next line
+            begin = mm.find(b'\n', begin, stop) + 1 or stop
+        if stop == size:
+            # the last line may not be whole yet
+            stop = mm.rfind(b'\n', begin, stop) + 1 or begin
+        yield from _text_in_range(mm, begin, stop, start, end, skew, True)
+    finally:
+        mm.close()
+
+
+def _query_stream(f, start, end, skew, chunk_size=1 << 20):
+    """
+    Yield the records of the file object f between start and end, reading
+    it from the start in chunks, for compressed files.
+    """
+    buf = b''
+    binary = None
+    while True:
+        data = f.read(chunk_size)
+        buf += data
+        if binary is None:
+            binary = buf[:2] == BINARY_MAGIC
+        if binary:
+            offset = yield from _binary_in_range(buf, 0, len(buf), start, end, skew)
+        else:
+            stop = len(buf) if not data else buf.rfind(b'\n') + 1
+            offset = yield from _text_in_range(buf, 0, stop, start, end, skew, not data)
+        if offset is None or not data:
+            return
+        buf = buf[offset:]
+
+
+def query(path, start, end, skew=5.0):
+    """
+    Yield (created, data) for the records of the log file path created
+    between start and end, data being the record as written. The file is
+    skipped if its mtime or its index tells it holds nothing of the range,
+    compressed files are read from the start.
+    """
+    index = _Index((path.rsplit('.', 1)[0] if path.endswith(_COMPRESSED_SUFFIXES) else path) + INDEX_SUFFIX)
+    try:
+        # the mtime bounds the last record, an index which starts at the
+        # start of the file bounds the first one
+        if os.stat(path).st_mtime < start - skew:
+            return
+        if len(index) and index.entry(0)[1] == 0 and index[0] > end + skew:
+            return
+        if path.endswith(_COMPRESSED_SUFFIXES):
+            with log_reader.open_log(path) as f:
+                yield from _query_stream(f, start, end, skew)
+        else:
+            with open(path, 'rb') as f:
+                yield from _query_mapped(f, index, start, end, skew)
+    except FileNotFoundError:
+        # rotated away or deleted since it was listed
+        return
+    finally:
+        index.close()
+
+
+def query_app(log_path, app_name, start, end, filename='info.log', skew=5.0):
+    """
+    Yield (created, data) for the records between start and end of
+    filename and its rotated files under <log_path>/<app_name>, oldest
+    file first.
+    """
+    for path in log_files(os.path.join(log_path, app_name), filename):
+        yield from query(path, start, end, skew)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Print the records of a log file and its rotated files '
+                                                 'created in a time range.')
+    parser.add_argument('log_path')
+    parser.add_argument('app_name')
+    parser.add_argument('--file', default='info.log', help='log file name, info.log by default')
+    parser.add_argument('--start', required=True, help="'YYYY-MM-DD HH:MM[:SS[.fff]]' local time, or epoch seconds")
+    parser.add_argument('--end', required=True)
+    parser.add_argument('--skew', type=float, default=5.0,
+                        help='seconds by which records may be written out of order, 5 by default')
+    options = parser.parse_args(argv)
+    start = parse_time(options.start)
+    end = parse_time(options.end)
+    out = sys.stdout.buffer
+    for created, data in query_app(options.log_path, options.app_name, start, end, options.file, options.skew):
+        if data[:2] == BINARY_MAGIC:
+            for record in log_reader.iter_binary(io.BytesIO(data)):
+                out.write((log_reader.format_record(record) + '\n').encode('utf-8'))
+        else:
+            out.write(data)
+    out.flush()
+    return 0
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except BrokenPipeError:
+        sys.exit(1)
@@ -0,0 +1,185 @@
+"""
+Reader for the structured log files written with record_format='json' or
+'binary', rotated and compressed ones included.
+
+Usage : python log_reader.py [--json] <file> ...
+
+prints the records of the files as text lines, or as JSON lines with
+--json. Every record is a dict with the keys
+
+    created, levelno, levelname, name, message, filename, lineno,
+    funcName, process, thread, exc_text, stack_info
+
+plus the extra= fields of the record.
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import lzma
+import sys
+import time
+if __package__:
+    from .log_formatters import BINARY_MAGIC, BINARY_PREFIX_SIZE, binary_header
+else:
+    from log_formatters import BINARY_MAGIC, BINARY_PREFIX_SIZE, binary_header
+
+# records longer than this are garbage, the reader looks for the next one
+MAX_RECORD_SIZE = 64 * 1024 * 1024
+
+
+def open_log(path):
+    """
+    Open a log file for reading bytes, decompressing .gz and .xz files.
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.xz'):
+        return lzma.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def iter_binary(f, chunk_size=1 << 20):
+    """
+    Yield the records of a binary log read from the file object f, in
+    chunks. Bytes which are not a whole record, such as a record torn by a
+    crash, are skipped up to the next record.
+    """
+    unpack = binary_header.unpack_from
+    header_size = binary_header.size
+    level_names = {}
+    buf = b''
+    offset = 0
+    eof = False
+    while True:
+        if len(buf) - offset < header_size:
+            if eof:
+                return
+            data = f.read(chunk_size)
+            eof = not data
+            buf = buf[offset:] + data
+            offset = 0
+            continue
+        (magic, length, created, levelno, lineno, process, thread, name_len, msg_len, file_len, func_len,
+         exc_len, stack_len, extra_len) = unpack(buf, offset)
+        if magic != BINARY_MAGIC:
+            found = buf.find(BINARY_MAGIC, offset + 1)
+            offset = found if found >= 0 else len(buf) - 1
+            continue
+        end = offset + BINARY_PREFIX_SIZE + length
+        if length > MAX_RECORD_SIZE:
+            offset += 1
+            continue
+        if end > len(buf):
+            if eof:
+                return
+            # the record goes on in the next chunk
+            data = f.read(max(chunk_size, end - len(buf)))
+            eof = not data
+            buf = buf[offset:] + data
+            offset = 0
+            continue
+        p1 = offset + header_size + name_len
+        p2 = p1 + msg_len
+        p3 = p2 + file_len
+        p4 = p3 + func_len
+        p5 = p4 + exc_len
+        p6 = p5 + stack_len
+        if p6 + extra_len != end:
+            offset += 1
+            continue
+        levelname = level_names.get(levelno)
+        if levelname is None:
+            levelname = level_names[levelno] = logging.getLevelName(levelno)
+        record = {
+            'created': created, 'levelno': levelno, 'levelname': levelname,
+            'name': buf[offset + header_size:p1].decode('utf-8', 'replace'),
+            'message': buf[p1:p2].decode('utf-8', 'replace'),
+            'filename': buf[p2:p3].decode('utf-8', 'replace'), 'lineno': lineno,
+            'funcName': buf[p3:p4].decode('utf-8', 'replace'), 'process': process, 'thread': thread,
+            'exc_text': buf[p4:p5].decode('utf-8', 'replace') if exc_len else None,
+            'stack_info': buf[p5:p6].decode('utf-8', 'replace') if stack_len else None,
+        }
+        if extra_len:
+            try:
+                record.update(json.loads(buf[p6:end]))
+            except ValueError:
+                offset += 1
+                continue
+        offset = end
+        yield record
+
+
+def iter_json(f):
+    """
+    Yield the records of a JSON lines log read from the file object f,
+    with the keys the binary reader gives. Lines which are not JSON, such
+    as a flight recorder dump, are skipped.
+    """
+    for line in f:
+        try:
+            data = json.loads(line)
+        except ValueError:
+            continue
+        levelname = data.pop('level', None)
+        record = {
+            'created': data.pop('created', None), 'levelno': logging.getLevelName(levelname),
+            'levelname': levelname, 'name': data.pop('logger', None), 'message': data.pop('message', None),
+            'filename': data.pop('file', None), 'lineno': data.pop('line', None),
+            'funcName': data.pop('func', None), 'process': data.pop('process', None),
+            'thread': data.pop('thread', None), 'exc_text': data.pop('exc_info', None),
+            'stack_info': data.pop('stack_info', None),
+        }
+        record.update(data)
+        yield record
+
+
+def read_records(path):
+    """
+    Yield the records of a structured log file, binary or JSON lines as
+    told by its first bytes.
+    """
+    with open_log(path) as f:
+        head = f.peek(2)[:2] if hasattr(f, 'peek') else b''
+        if head == BINARY_MAGIC:
+            yield from iter_binary(f)
+        else:
+            yield from iter_json(f)
+
+
+def format_record(record):
+    """
+    Return a record as a text line like the compact format.
+    """
+    created = record['created'] or 0
+    t = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(created))
+    s = '%s.%03d %s logger:%s - %s' % (t, int(created * 1000) % 1000, record['levelname'], record['name'],
+                                       record['message'])
+    if record.get('exc_text'):
+        s += '\n' + record['exc_text']
+    if record.get('stack_info'):
+        s += '\n' + record['stack_info']
+    return s
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Print the records of binary or JSON lines log files.')
+    parser.add_argument('--json', action='store_true', help='print JSON lines instead of text')
+    parser.add_argument('paths', nargs='+')
+    options = parser.parse_args(argv)
+    out = sys.stdout
+    for path in options.paths:
+        for record in read_records(path):
+            if options.json:
+                out.write(json.dumps(record, ensure_ascii=False) + '\n')
+            else:
+                out.write(format_record(record) + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except BrokenPipeError:
+        sys.exit(1)
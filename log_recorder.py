@@ -0,0 +1,277 @@
+"""
+Flight recorder : keeps the last records below ERROR of a process in a
+memory mapped ring buffer, and writes them to the error log when an ERROR
+record arrives, so that the debug context of an error is kept without
+writing every DEBUG record.
+
+Usage : python log_recorder.py [--all] <ring file or directory> ...
+
+prints the records left in the ring files of crashed processes, oldest
+first. Without --all, records already written to the error log are
+skipped.
+
+Ring file layout, little endian :
+
+    header : magic, version, slot size, slot count, pid, dumped sequence,
+             creation time
+    slots  : slot count slots of slot size bytes, each a slot header
+             (sequence, created, levelno, name length, message length)
+             followed by the logger name and the message, utf-8
+
+A slot is invalidated before it is overwritten and its sequence written
+last, so a slot torn by a crash is skipped by the reader.
+"""
+
+import argparse
+import logging
+import mmap
+import os
+import struct
+import sys
+import time
+if __package__:
+    from . import mlogging_handlers
+else:
+    import mlogging_handlers
+
+MAGIC = b'LOGRING1'
+VERSION = 1
+_header = struct.Struct('<8sIIIIQd')
+_slot_header = struct.Struct('<QdBBH')
+_sequence = struct.Struct('<Q')
+# offset of the dumped sequence in the header
+_DUMPED_OFFSET = 24
+
+
+def read_ring(buf):
+    """
+    Return the header fields (slot_size, slots, pid, dumped, created) of a
+    ring and its valid records as (seq, created, levelno, name, message)
+    tuples, oldest first.
+    """
+    magic, version, slot_size, slots, pid, dumped, created = _header.unpack_from(buf)
+    if magic != MAGIC or version != VERSION or len(buf) < _header.size + slot_size * slots:
+        raise ValueError('not a ring file')
+    records = []
+    for i in range(slots):
+        offset = _header.size + i * slot_size
+        seq, record_created, levelno, name_len, msg_len = _slot_header.unpack_from(buf, offset)
+        if not seq or _slot_header.size + name_len + msg_len > slot_size:
+            continue
+        start = offset + _slot_header.size
+        name = bytes(buf[start:start + name_len]).decode('utf-8', 'replace')
+        message = bytes(buf[start + name_len:start + name_len + msg_len]).decode('utf-8', 'replace')
+        records.append((seq, record_created, levelno, name, message))
+    records.sort()
+    return (slot_size, slots, pid, dumped, created), records
+
+
+def make_records(records, pid, reason):
+    """
+    Return logging records for a dump of records, between a header record
+    telling why and a footer record, for a formatter to write.
+    """
+    count = len(records)
+    records = [(created, levelno, name, message) for seq, created, levelno, name, message in records]
+    records.insert(0, (records[0][0] if records else time.time(), logging.INFO, 'flight_recorder',
+                       'flight recorder of process %d, %d records before %s' % (pid, count, reason)))
+    records.append((records[-1][0], logging.INFO, 'flight_recorder', 'end of flight recorder of process %d' % pid))
+    result = []
+    for created, levelno, name, message in records:
+        record = logging.makeLogRecord({'name': name, 'msg': message, 'levelno': levelno,
+                                        'levelname': logging.getLevelName(levelno), 'created': created,
+                                        'msecs': int(created * 1000) % 1000, 'process': pid, 'thread': 0,
+                                        'threadName': None, 'processName': None})
+        result.append(record)
+    return result
+
+
+def format_records(records, pid, reason):
+    """
+    Return the text of a dump of records, between a header line telling
+    why and a footer line.
+    """
+    lines = ['----- flight recorder of process %d, %d records before %s -----' % (pid, len(records), reason)]
+    for seq, created, levelno, name, message in records:
+        t = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(created))
+        lines.append('%s.%03d %s logger:%s - %s' % (t, int(created * 1000) % 1000, logging.getLevelName(levelno),
+                                                    name, message))
+    lines.append('----- end of flight recorder of process %d -----' % pid)
+    return '\n'.join(lines) + '\n'
+
+
+class FlightRecorderHandler(logging.Handler):
+    """
+    Handler which keeps the records below dump_level in a ring buffer of
+    capacity slots, memory mapped from <directory>/<pid>.ring, and writes
+    the records it holds to dump_filename when a record of dump_level or
+    above arrives, before that record is written by the other handlers.
+    With a formatter, that of the other files of dump_filename, the dump
+    is written as records of that format, text, JSON or binary, otherwise
+    as the text of format_records().
+
+    A record takes one fixed size slot: a slot header, the logger name and
+    the message, cut at slot_size bytes. Nothing is formatted until a dump.
+    A forked child maps a ring of its own. The ring file is removed on
+    close(), so only those of processes which died are left for the CLI.
+    """
+
+    def __init__(self, directory, dump_filename, capacity=1024, slot_size=512, dump_level=logging.ERROR,
+                 when='D', encoding=None, atomic_append=False):
+        logging.Handler.__init__(self)
+        self.directory = directory
+        self.capacity = capacity
+        self.slot_size = slot_size
+        self.dump_level = dump_level
+        self.metrics = mlogging_handlers.HandlerMetrics()
+        self.writer = mlogging_handlers.TimedRotatingFileHandlerMP(dump_filename, when=when, encoding=encoding,
+                                                                   delay=True, atomic_append=atomic_append)
+        self.encoding = encoding or 'utf-8'
+        self.names = {}
+        self.pid = None
+        self.mm = None
+        self.path = None
+        self.seq = 0
+
+    def _open_ring(self):
+        """
+        Create and map the ring file of this process.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        self.pid = os.getpid()
+        self.path = os.path.join(self.directory, '%d.ring' % self.pid)
+        size = _header.size + self.capacity * self.slot_size
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self.mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        _header.pack_into(self.mm, 0, MAGIC, VERSION, self.slot_size, self.capacity, self.pid, 0, time.time())
+        self.seq = 0
+
+    def emit(self, record):
+        """
+        Keep a record below dump_level in the ring, or dump the ring.
+        """
+        try:
+            if self.pid != os.getpid():
+                # a forked child must not write to the ring of its parent
+                self.mm = None
+                self._open_ring()
+            if record.levelno >= self.dump_level:
+                self.dump(record)
+                return
+            self.seq += 1
+            mm = self.mm
+            offset = _header.size + (self.seq % self.capacity) * self.slot_size
+            _sequence.pack_into(mm, offset, 0)
+            name = self.names.get(record.name)
+            if name is None:
+                name = self.names[record.name] = record.name.encode('utf-8')[:255]
+            message = record.getMessage().encode(self.encoding, 'replace')
+            msg_len = min(len(message), self.slot_size - _slot_header.size - len(name))
+            start = offset + _slot_header.size
+            mm[start:start + len(name)] = name
+            mm[start + len(name):start + len(name) + msg_len] = memoryview(message)[:msg_len]
+            _slot_header.pack_into(mm, offset, self.seq, record.created, record.levelno, len(name), msg_len)
+            self.metrics.add(mlogging_handlers.RECORDS)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+    def dump(self, record=None):
+        """
+        Write the records kept since the last dump to dump_filename in one
+        write, record being the one which caused the dump.
+        """
+        if self.mm is None:
+            return
+        (_, _, pid, dumped, _), records = read_ring(self.mm)
+        records = [r for r in records if r[0] > dumped]
+        if not records:
+            return
+        reason = record.levelname if record is not None else 'dump'
+        if self.formatter is None:
+            data = format_records(records, pid, reason).encode(self.encoding, 'replace')
+        else:
+            data = b''.join(map(self.writer.format_bytes, make_records(records, pid, reason)))
+        self.writer.emit_bytes(data, record)
+        _sequence.pack_into(self.mm, _DUMPED_OFFSET, records[-1][0])
+
+    def setFormatter(self, fmt):
+        """
+        Set the formatter of the dumps.
+        """
+        logging.Handler.setFormatter(self, fmt)
+        self.writer.setFormatter(fmt)
+
+    def handleError(self, record):
+        self.metrics.add(mlogging_handlers.ERRORS)
+        logging.Handler.handleError(self, record)
+
+    def snapshot_metrics(self):
+        """
+        Return the metrics of the handler, with those of the writer of
+        dump_filename under 'dump'.
+        """
+        result = self.metrics.snapshot()
+        result['dump'] = self.writer.snapshot_metrics()
+        return result
+
+    def close(self):
+        """
+        Unmap and remove the ring file, the records are only needed after
+        a crash.
+        """
+        self.acquire()
+        try:
+            if self.mm is not None and self.pid == os.getpid():
+                self.mm.close()
+                try:
+                    os.remove(self.path)
+                except OSError:
+                    pass
+            self.mm = None
+            self.pid = None
+        finally:
+            self.release()
+        self.writer.close()
+        logging.Handler.close(self)
+
+
+def recover(path, include_dumped=False):
+    """
+    Return the text of the records left in the ring file path.
+    """
+    with open(path, 'rb') as f:
+        buf = f.read()
+    (_, _, pid, dumped, _), records = read_ring(buf)
+    if not include_dumped:
+        records = [r for r in records if r[0] > dumped]
+    return format_records(records, pid, 'the process ended, recovered from %s' % path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Print the records left in flight recorder ring files.')
+    parser.add_argument('--all', action='store_true', help='include the records already written to the error log')
+    parser.add_argument('paths', nargs='+', help='ring files, or directories holding them')
+    options = parser.parse_args(argv)
+    status = 0
+    for path in options.paths:
+        if os.path.isdir(path):
+            files = sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith('.ring'))
+        else:
+            files = [path]
+        for name in files:
+            try:
+                sys.stdout.write(recover(name, options.all))
+            except (OSError, ValueError, struct.error) as e:
+                sys.stderr.write('%s: %s\n' % (name, e))
+                status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,12 +2,23 @@
 # @Author  : lirui
 # @ qq     : 270239148
 
-import logging.config
+import atexit
+import json
+import logging
 import os
-import sys
-curr_path = os.path.abspath(os.path.dirname(__file__))
-sys.path.append(curr_path)
-import mlogging_handlers
+import queue
+import threading
+import time
+# 作为log_tool包导入时用相对导入，直接运行同目录下的脚本时用顶层模块名，导入时不修改sys.path，也不访问文件系统
+if __package__:
+    from . import mlogging_handlers, log_formatters, log_filters
+else:
+    import mlogging_handlers
+    import log_formatters
+    import log_filters
+
+# LOGGING中类名字符串的前缀，dictConfig按本模块所在的包解析，如log_tool.mlogging_handlers.TimedRotatingFileHandlerMP
+_PACKAGE = __package__ + '.' if __package__ else ''
 
 '''
 日志的配置参数，日志对象主要有3个子模块，分别为formater（输出格式），handler（日志操作类型），logger（日志名），要分别进行设置。
@@ -20,38 +31,59 @@ logger会自动选择名为root的logger
 LOGGING = {
     "version": 1,
     "disable_existing_loggers": False,
+    # 格式化类FastFormatter只在初始化时解析一次格式字符串，并按秒缓存时间文本，输出与logging.Formatter完全一致
     "formatters": {
         "simple": {
             # 简单的输出模式
+            'class': _PACKAGE + 'log_formatters.FastFormatter',
             'format': '%(asctime)s %(levelname)s file:%(filename)s|lineno:'
                       '%(lineno)d|logger:%(name)s - %(message)s'
         },
         'standard': {
             # 较为复杂的输出模式，可以进行自定义
+            'class': _PACKAGE + 'log_formatters.FastFormatter',
             'format': '%(asctime)s %(levelname)s threadId:%(thread)d|processId:%(process)d:|file:%(filename)s|lineno:'
                       '%(lineno)d|func:%(funcName)s|module:%(module)s|logger:%(name)s - %(message)s'
+        },
+        'compact': {
+            # 精简的输出模式，不需要调用者、线程和进程信息，fields='lean'时使用
+            'class': _PACKAGE + 'log_formatters.FastFormatter',
+            'format': '%(asctime)s %(levelname)s logger:%(name)s - %(message)s'
+        },
+        'json': {
+            # 结构化输出：每条日志一行json，保留extra字段和异常信息，record_format='json'时使用
+            'class': _PACKAGE + 'log_formatters.JsonFormatter'
+        },
+        'binary': {
+            # 结构化输出：带长度前缀的二进制格式，体积更小、写入和解析更快，用log_reader.py读取，
+            # record_format='binary'时使用
+            'class': _PACKAGE + 'log_formatters.BinaryFormatter'
         }
     },
 
-    # 过滤器
+    # 过滤器，按日志等级的数值过滤，WARNING改名为WARN后依然有效
     "filters": {
         'debug_filter': {
-            '()': 'log_filters.DebugFilter'
+            '()': _PACKAGE + 'log_filters.DebugFilter'
         },
         'info_filter': {
-            '()': 'log_filters.InfoFilter'
+            '()': _PACKAGE + 'log_filters.LevelSetFilter',
+            'levels': [logging.INFO, logging.WARNING, logging.ERROR]
         },
         'warning_filter': {
-            '()': 'log_filters.WarningFilter'
+            '()': _PACKAGE + 'log_filters.LevelSetFilter',
+            'levels': [logging.WARNING]
         },
         'error_filter': {
-            '()': 'log_filters.ErrorFilter'
+            '()': _PACKAGE + 'log_filters.LevelSetFilter',
+            'levels': [logging.ERROR]
         },
         'critical_filter': {
-            '()': 'log_filters.CriticalFilter'
+            '()': _PACKAGE + 'log_filters.LevelSetFilter',
+            'levels': [logging.CRITICAL]
         },
         'no_debug_filter': {
-            '()': 'log_filters.NoDebugFilter'
+            '()': _PACKAGE + 'log_filters.NoDebugFilter'
         }
     },
 
@@ -95,6 +127,62 @@ LOGGING = {
 }
 
 
+# 异步模式下所有logger共用的后台写日志线程，以及使用异步模式的logger名
+_async_writer = None
+# close()是否已注册为退出时调用，每个进程只注册一次
+_atexit_registered = False
+_async_logger_names = []
+_async_lock = threading.Lock()
+# get_async_logger返回的logger，logger名 -> AsyncLogger
+_async_loggers = {}
+
+# 注册app的锁，多个线程同时注册app时保证每个app只初始化一次
+_register_lock = threading.RLock()
+# 所有app共用的formatter和filter对象，第一次注册app时创建
+_shared_conf = {}
+# 每个app的handler名，用于按app获取handler的监控指标
+_app_handlers = {}
+# 每个app的限流过滤器，logger名 -> LimiterFilter
+_app_limiters = {}
+# 每个app request logger的请求上下文过滤器，用于获取请求汇总和route耗时的监控指标
+_app_contexts = {}
+# 定期写监控指标的app，app名 -> _dump_metrics的参数，fork后子进程据此重新启动线程
+_metrics_dumpers = {}
+
+
+# 增量注册：只创建本app的handler并挂到本app的logger上，不重新执行dictConfig，
+# 已注册app的handler保持打开，不受影响
+def _configure_app(handler_names, logger_names):
+    # logging.config导入较慢，第一次注册app时才导入
+    import logging.config
+    conf = {
+        'version': 1,
+        'formatters': _shared_conf.get('formatters', dict(LOGGING['formatters'])),
+        'filters': _shared_conf.get('filters', dict(LOGGING['filters'])),
+        'handlers': {name: LOGGING['handlers'][name] for name in handler_names},
+    }
+    configurator = logging.config.DictConfigurator(conf)
+    config = configurator.config
+    if not _shared_conf:
+        # 与dictConfig相同的顺序：先formatter和filter，root只在第一次配置
+        formatters = config['formatters']
+        for name in formatters:
+            formatters[name] = configurator.configure_formatter(formatters[name])
+        filters = config['filters']
+        for name in filters:
+            filters[name] = configurator.configure_filter(filters[name])
+        configurator.configure_root(LOGGING['root'])
+        _shared_conf['formatters'] = {name: formatters[name] for name in formatters}
+        _shared_conf['filters'] = {name: filters[name] for name in filters}
+    handlers = config['handlers']
+    for name in sorted(handlers):
+        handler = configurator.configure_handler(handlers[name])
+        handler.name = name
+        handlers[name] = handler
+    for name in logger_names:
+        configurator.configure_logger(name, LOGGING['loggers'][name])
+
+
 # 定义日志类
 class Logger:
 
@@ -104,14 +192,25 @@ class Logger:
 
     # 对于每个app name单例模式
     def __new__(cls, app_name: str, log_path: str, *args, **kwargs):
-        if app_name not in cls.__instance:
-            cls.__instance[app_name] = super().__new__(cls)
-        return cls.__instance[app_name]
-
-    # 初始化logger，通过LOGGING配置logger
-    def __init__(self, app_name: str, log_path: str=None, is_debug=True, is_write_file=True):
-        if self.__is_init is True:
-            return
+        with _register_lock:
+            if app_name not in cls.__instance:
+                cls.__instance[app_name] = super().__new__(cls)
+            return cls.__instance[app_name]
+
+    # 初始化logger，加锁保证同一个app只初始化一次，参数见_setup
+    def __init__(self, app_name: str, log_path: str=None, *args, **kwargs):
+        with _register_lock:
+            if self.__is_init is True:
+                return
+            self._setup(app_name, log_path, *args, **kwargs)
+
+    # 通过LOGGING配置本app的logger，所有参数只在这里声明，get_logger和get_request_logger原样传入
+    def _setup(self, app_name: str, log_path: str=None, is_debug=True, is_write_file=True, atomic_append=False,
+               async_mode=False, use_collector=False, buffer_size=0, route_levels=False, fields='auto',
+               when='D', metrics_interval=0, backup_count=0, max_age=0, max_total_bytes=0, compress=None,
+               compress_level=6, flight_recorder=0, record_format='text', index_interval=0,
+               limiter=None, request_limiter=None, max_bytes=0, lazy=False, banner=True, request_context=False,
+               request_summary=False, route_histogram_interval=0):
         # #校验传入参数
         # app_name不能为空字符串
         assert(type(app_name) is str and app_name != ''), f'app_name必须为字符串类型，且不能为空字符串，当前传入的app_name为：{app_name}，类型为{type(app_name)}'
@@ -128,6 +227,17 @@ class Logger:
         level_conf = getattr(logging, '_levelToName')
         level_conf[30] = 'WARN'
 
+        # fields为lean时控制台和文件都使用精简的compact格式
+        assert fields in ('full', 'lean', 'auto'), f"fields只能为'full'、'lean'或'auto'，当前传入的fields为：{fields}"
+        console_formatter = 'compact' if fields == 'lean' else 'simple'
+        file_formatter = 'compact' if fields == 'lean' else 'standard'
+        # record_format为'json'或'binary'时文件使用结构化格式，二进制日志文件的后缀为.bin
+        assert record_format in ('text', 'json', 'binary'), \
+            f"record_format只能为'text'、'json'或'binary'，当前传入的record_format为：{record_format}"
+        if record_format != 'text':
+            file_formatter = record_format
+        log_ext = '.bin' if record_format == 'binary' else '.log'
+
         # 初始化logger配置
         logger_name = f'{app_name}_logger'
         # 初始化logger字典配置，空架子，未添加任何handler
@@ -139,81 +249,196 @@ class Logger:
         LOGGING['loggers'][request_logger_name] = self.get_request_logger_conf()
         request_logger_handlers = LOGGING['loggers'][request_logger_name]['handlers']
 
+        # 启动提示，配置完成后以DEBUG等级通过本app的logger输出，只出现在控制台，不写入文件，banner为False时不输出
+        banners = []
+
         # 当需要打印到控制台时
         if is_debug:
             # 添加debug handler
             handler_name = f'{app_name}_debug'
-            LOGGING['handlers'][handler_name] = self.get_console_handler_conf()
+            LOGGING['handlers'][handler_name] = self.get_console_handler_conf(formatter=console_formatter)
             logger_handlers.append(handler_name)
             # 添加request debug 日志
             request_logger_handlers.append(handler_name)
-            print(f"app名为{app_name}的日志的打印到控制台功能被初始化了，日志将输出到控制台")
+            banners.append(f"app名为{app_name}的日志的打印到控制台功能被初始化了，日志将输出到控制台")
 
         # 当需要写入到文件
         if is_write_file:
-            # 创建加锁文件夹，mlogging_handlers.py需要用到此文件夹
-            _lock_dir = str(os.path.abspath(__file__).rsplit('/', 1)[0]) + '/.lock'
-            if not os.path.exists(_lock_dir):
-                os.mkdir(_lock_dir)
+            # 加锁文件夹由mlogging_handlers在第一次加锁时创建
 
             # 校验文件路径
             assert(type(log_path) is str), f'传入的日志路径必须为字符串，当前传入的路径为：{log_path}，类型为：{type(log_path)}'
             # app_name名对应日志路径
             log_file_dir = os.path.join(log_path, app_name)
-            # 如果日志文件夹不存在，则创建
-            if not os.path.exists(log_file_dir):
-                os.makedirs(log_file_dir)
-
             # 默认日志路径，为request_logger使用
             default_log_file_dir = os.path.join(log_path, 'default')
-            # 如果默认日志文件夹不存在，则创建
-            if not os.path.exists(default_log_file_dir):
-                os.makedirs(default_log_file_dir)
-                print(f'默认日志路径：{default_log_file_dir} 被创建')
+            # lazy为True时不创建文件夹，也不打开日志文件，文件夹和文件在第一条写入它们的日志时才创建，
+            # 适合运行时间短的命令行任务和注册了很多app的服务
+            if not lazy:
+                # 如果日志文件夹不存在，则创建
+                if not os.path.exists(log_file_dir):
+                    os.makedirs(log_file_dir)
+                # 如果默认日志文件夹不存在，则创建
+                if not os.path.exists(default_log_file_dir):
+                    os.makedirs(default_log_file_dir)
+                    banners.append(f'默认日志路径：{default_log_file_dir} 被创建')
 
             # 启动服务时的友好提示
-            print(f'默认日志路径：{default_log_file_dir} ，当中间件找不到是调用哪个app时'
-                  f'（如404 not found情况下，不知道调用的哪个app），日志会记录到此文件夹下')
-            print(f"app名为{app_name}的日志的写入文件功能被初始化了，日志会写入到：{log_file_dir} 文件夹下")
+            banners.append(f'默认日志路径：{default_log_file_dir} ，当中间件找不到是调用哪个app时'
+                           f'（如404 not found情况下，不知道调用的哪个app），日志会记录到此文件夹下')
+            banners.append(f"app名为{app_name}的日志的写入文件功能被初始化了，日志会写入到：{log_file_dir} 文件夹下")
+
+            # 使用日志收集进程时，所有进程通过此unix socket把日志发给同一个收集进程，由它写文件和切分
+            collector_socket = os.path.join(log_path, '.collector.sock') if use_collector else None
+
+            # 切分出的旧日志文件的保留和压缩：最多保留backup_count个，删除超过max_age秒或使总大小超过
+            # max_total_bytes的最旧文件，compress为'gzip'或'lzma'时压缩。由后台线程完成，多进程时只有一个进程执行
+            # index_interval大于0时每个进程每index_interval秒在日志文件旁的.idx索引文件中记录一条(时间, 偏移)，
+            # 供log_query按时间范围查询，索引随日志文件一起切分和删除
+            # max_bytes大于0时日志文件按时间或达到max_bytes字节切分，先到者为准，切分出的文件名为test.log.yyyy-mm-dd.N
+            retention = {'backup_count': backup_count, 'max_age': max_age, 'max_total_bytes': max_total_bytes,
+                         'compress': compress, 'compress_level': compress_level, 'index_interval': index_interval,
+                         'max_bytes': max_bytes}
 
             # 添加日志handlers
             log_levels = ['info', 'warning', 'error',  'critical']
 
-            # 根据app_name动态更新LOGGING配置，为每个app_name创建文件夹，配置handler
-            for level in log_levels:
-                # handler 对应文件名，如 logs/default/info.log
-                # 为app_name 日志添加handler
-                handler_name = f'{app_name}_{level}'
-
-                # 为app_name日志添加handler
-                filename = os.path.join(log_file_dir, (level + '.log'))
-                # 日志等级转大写
-                lev_up = level.upper()
-                LOGGING['handlers'][handler_name] = self.get_file_handler_conf(filename=filename, level=lev_up)
+            # 按日志等级路由：每条日志只格式化一次，按等级查表写入对应的文件，每个文件只写一次
+            if route_levels and not use_collector:
+                info_file, warning_file, error_file, critical_file = (
+                    os.path.join(log_file_dir, (level + log_ext)) for level in log_levels)
+                # 未列出的等级按低于它的最近一个等级路由，info日志文件同时记录warning和error
+                routes = {'INFO': [info_file], 'WARNING': [info_file, warning_file],
+                          'ERROR': [info_file, error_file], 'CRITICAL': [critical_file]}
+                handler_name = f'{app_name}_file'
+                LOGGING['handlers'][handler_name] = self.get_routing_handler_conf(routes=routes,
+                                                                                  atomic_append=atomic_append,
+                                                                                  buffer_size=buffer_size,
+                                                                                  formatter=file_formatter,
+                                                                                  when=when,
+                                                                                  retention=retention,
+                                                                                  delay=lazy)
                 logger_handlers.append(handler_name)
 
-                # 为request 日志添加handler
-                request_handler_name = f'{app_name}_request_{level}'
-                request_filename = os.path.join(log_file_dir, 'request.log')
-                LOGGING['handlers'][request_handler_name] = self.get_file_handler_conf(filename=request_filename, level=lev_up)
+                # request日志所有INFO及以上等级都只写一次request.log
+                request_routes = {'INFO': [os.path.join(log_file_dir, 'request' + log_ext)]}
+                request_handler_name = f'{app_name}_request_file'
+                LOGGING['handlers'][request_handler_name] = self.get_routing_handler_conf(routes=request_routes,
+                                                                                          atomic_append=atomic_append,
+                                                                                          buffer_size=buffer_size,
+                                                                                          formatter=file_formatter,
+                                                                                          when=when,
+                                                                                          retention=retention,
+                                                                                          delay=lazy)
                 request_logger_handlers.append(request_handler_name)
+            else:
+                # 根据app_name动态更新LOGGING配置，为每个app_name创建文件夹，配置handler
+                for level in log_levels:
+                    # handler 对应文件名，如 logs/default/info.log
+                    # 为app_name 日志添加handler
+                    handler_name = f'{app_name}_{level}'
+
+                    # 为app_name日志添加handler
+                    filename = os.path.join(log_file_dir, (level + log_ext))
+                    # 日志等级转大写
+                    lev_up = level.upper()
+                    LOGGING['handlers'][handler_name] = self.get_file_handler_conf(filename=filename, level=lev_up,
+                                                                                   atomic_append=atomic_append,
+                                                                                   collector_socket=collector_socket,
+                                                                                   buffer_size=buffer_size,
+                                                                                   formatter=file_formatter,
+                                                                                   when=when,
+                                                                                   retention=retention,
+                                                                                   delay=lazy)
+                    logger_handlers.append(handler_name)
+
+                    # 为request 日志添加handler
+                    request_handler_name = f'{app_name}_request_{level}'
+                    request_filename = os.path.join(log_file_dir, 'request' + log_ext)
+                    LOGGING['handlers'][request_handler_name] = self.get_file_handler_conf(filename=request_filename,
+                                                                                           level=lev_up,
+                                                                                           atomic_append=atomic_append,
+                                                                                           collector_socket=collector_socket,
+                                                                                           buffer_size=buffer_size,
+                                                                                           formatter=file_formatter,
+                                                                                           when=when,
+                                                                                           retention=retention,
+                                                                                           delay=lazy)
+                    request_logger_handlers.append(request_handler_name)
+
+            # 飞行记录器：ERROR以下的日志只保存在本进程内存映射的环形缓冲区中，不写文件，
+            # 出现ERROR及以上的日志时，先把缓冲区中的日志以日志文件的格式写入error.log或error.bin，
+            # 作为这条错误之前的上下文
+            if flight_recorder:
+                handler_name = f'{app_name}_flight_recorder'
+                LOGGING['handlers'][handler_name] = self.get_flight_recorder_conf(
+                    directory=os.path.join(log_file_dir, '.recorder'),
+                    dump_filename=os.path.join(log_file_dir, 'error' + log_ext), capacity=flight_recorder,
+                    atomic_append=atomic_append, when=when, formatter=file_formatter)
+                # 放在最前面，缓冲区中的日志先于这条错误写入
+                logger_handlers.insert(0, handler_name)
 
         # import json
         # print(json.dumps(LOGGING, indent=2))
 
-        # 将LOGGING中的配置信息更新到logging中
-        logging.config.dictConfig(LOGGING)
+        # 将本app在LOGGING中的配置更新到logging中，只创建本app的handler
+        handler_names = list(dict.fromkeys(logger_handlers + request_logger_handlers))
+        _configure_app(handler_names, [logger_name, request_logger_name])
+        _app_handlers[app_name] = handler_names
+        if banner:
+            for message in banners:
+                logging.getLogger(logger_name).debug(message)
+
+        # 定期把本app各handler的监控指标以一行json写入metrics.log
+        if metrics_interval and is_write_file:
+            metrics_file = os.path.join(log_path, app_name, 'metrics.log')
+            _metrics_dumpers[app_name] = (app_name, metrics_file, metrics_interval, when)
+            threading.Thread(target=_dump_metrics, args=_metrics_dumpers[app_name], daemon=True).start()
+
+        # 限流：limiter和request_limiter为LimiterFilter的参数，如
+        # {'levels': {'ERROR': (10, 100)}, 'site_rate': 5, 'dedup_window': 10}、{'sample_rates': {'INFO': 0.1}}，
+        # 挂在logger上，在格式化之前丢弃日志，定期写一条WARN汇总丢弃的条数
+        for name, options in ((logger_name, limiter), (request_logger_name, request_limiter)):
+            if options:
+                limiter_filter = log_filters.LimiterFilter(**options).attach(logging.getLogger(name))
+                _app_limiters.setdefault(app_name, {})[name] = limiter_filter
+
+        # 请求上下文：用log_context.request(request_logger, route=..., request_id=...)包住一次请求，
+        # 绑定的字段只拼接一次成前缀，加在本app两个logger的每条日志前，json和二进制格式时作为额外字段。
+        # request_summary为True时请求中request logger的WARN以下日志不单独写入，请求结束时连同耗时和计数合成一条写入request.log，
+        # route_histogram_interval大于0时按route统计请求耗时，每隔这么多秒每个route写一条汇总
+        if request_context or request_summary or route_histogram_interval:
+            if __package__:
+                from . import log_context
+            else:
+                import log_context
+            structured = record_format != 'text'
+            log_context.RequestContextFilter(structured=structured).attach(logging.getLogger(logger_name))
+            context_filter = log_context.RequestContextFilter(structured=structured, summary=request_summary,
+                                                              histogram_interval=route_histogram_interval)
+            context_filter.attach(logging.getLogger(request_logger_name))
+            _app_contexts[app_name] = context_filter
+
+        # 格式中用不到调用者信息或线程、进程信息时，跳过findCaller的栈回溯和线程、进程信息的获取
+        for name in (logger_name, request_logger_name):
+            log_formatters.apply_fields_profile(logging.getLogger(name), fields)
+
+        # 异步模式：logger只把日志放入队列，由后台线程格式化并批量写入原来的handler
+        if async_mode:
+            for name in (logger_name, request_logger_name):
+                _async_logger_names.append(name)
+                _attach_async_writer(name)
 
     # 控制台输出handler配置
     @staticmethod
-    def get_console_handler_conf():
+    def get_console_handler_conf(formatter='simple'):
         console_handler_conf = {
             # 定义输出流的类
             "class": "logging.StreamHandler",
             # handler等级，如果实际执行等级高于此等级，则不触发handler
             "level": "DEBUG",
             # 输出的日志格式
-            "formatter": "simple",
+            "formatter": formatter,
             # 流调用系统输出
             "stream": "ext://sys.stdout",
             "filters": ["debug_filter"]
@@ -222,10 +447,11 @@ class Logger:
 
     @staticmethod
     # 写入文件handler配置
-    def get_file_handler_conf(filename: str, level='INFO'):
+    def get_file_handler_conf(filename: str, level='INFO', atomic_append=False, collector_socket=None,
+                              buffer_size=0, formatter='standard', when='D', retention=None, delay=False):
         file_handler_conf = {
             # 定义写入文件的日志类，此类为按时间分割日志类，还有一些按日志大小分割日志的类等
-            "class": "mlogging_handlers.TimedRotatingFileHandlerMP",
+            "class": _PACKAGE + "mlogging_handlers.TimedRotatingFileHandlerMP",
             # 日志等级
             "level": "",
             # 日志写入格式，因为要写入到文件后期可能会debug用，所以用了较为详细的standard日志格式
@@ -236,13 +462,87 @@ class Logger:
             # 比如文件名为test.log，到凌晨0点的时候会自动分离出test.log.yyyy-mm-dd
             "when": 'D',
             "encoding": "utf8",
+            # 旧日志文件的保留和压缩
+            "backup_count": 0,
+            "max_age": 0,
+            "max_total_bytes": 0,
+            "compress": None,
+            "compress_level": 6,
+            # 稀疏时间索引的间隔秒数，0为不建索引
+            "index_interval": 0,
+            # 为True时每条日志用O_APPEND一次os.write写入，不再对每条日志加文件锁，
+            # 超过max_atomic_size字节的日志仍然走加锁写入
+            "atomic_append": False,
+            "max_atomic_size": 65536,
+            # 大于0时日志先缓存在内存中，攒够buffer_size字节、等待超过flush_interval秒
+            # 或遇到ERROR及以上等级的日志时，一次性写入文件
+            "buffer_size": 0,
+            "flush_interval": 1.0,
+            # 为True时第一条日志写入时才打开文件，并创建所在的文件夹
+            "delay": False,
             "filters": []
         }
         filters = ['%s_filter' % (level.lower())]
-        update_dict = {'filename': filename, 'level': level, 'filters': filters}
+        update_dict = {'filename': filename, 'level': level, 'filters': filters, 'atomic_append': atomic_append,
+                       'buffer_size': buffer_size, 'formatter': formatter, 'when': when, 'delay': delay}
         file_handler_conf.update(update_dict)
+        file_handler_conf.update(retention or {})
+        # 设置了max_bytes时改用按时间和大小切分的handler
+        if file_handler_conf.get('max_bytes'):
+            file_handler_conf['class'] = _PACKAGE + 'mlogging_handlers.HybridRotatingFileHandlerMP'
+        else:
+            file_handler_conf.pop('max_bytes', None)
+        # 交给日志收集进程写入，收集进程不可用时才由本进程直接写文件
+        if collector_socket:
+            # 收集进程不可用时使用的handler总是第一条日志写入时才打开文件
+            for key in ('max_atomic_size', 'buffer_size', 'flush_interval', 'delay'):
+                del file_handler_conf[key]
+            file_handler_conf.update({'class': _PACKAGE + 'log_collector.CollectorHandler',
+                                      'socket_path': collector_socket})
         return file_handler_conf
 
+    @staticmethod
+    # 按日志等级路由写入文件的handler配置，routes为日志等级到文件列表的映射
+    def get_routing_handler_conf(routes: dict, atomic_append=False, buffer_size=0, formatter='standard', when='D',
+                                 retention=None, delay=False):
+        routing_handler_conf = {
+            "class": _PACKAGE + "mlogging_handlers.LevelRoutingHandlerMP",
+            "level": "INFO",
+            # 每条日志只格式化一次
+            "formatter": formatter,
+            "routes": routes,
+            # 以下参数传给每个文件对应的TimedRotatingFileHandlerMP
+            "when": when,
+            "encoding": "utf8",
+            "atomic_append": atomic_append,
+            "buffer_size": buffer_size,
+            "delay": delay
+        }
+        routing_handler_conf.update(retention or {})
+        return routing_handler_conf
+
+    @staticmethod
+    # 飞行记录器handler配置，capacity为缓冲区保存的日志条数
+    def get_flight_recorder_conf(directory: str, dump_filename: str, capacity=1024, atomic_append=False, when='D',
+                                 formatter='standard'):
+        flight_recorder_conf = {
+            "class": _PACKAGE + "log_recorder.FlightRecorderHandler",
+            # 接收所有等级的日志，ERROR以下的保存在缓冲区，ERROR及以上的触发写入
+            "level": "DEBUG",
+            # 写入时使用的格式，与dump_filename的其他日志相同
+            "formatter": formatter,
+            # 本进程的环形缓冲区文件为directory下的<pid>.ring，进程崩溃后可以用log_recorder.py恢复
+            "directory": directory,
+            "dump_filename": dump_filename,
+            "capacity": capacity,
+            # 每条日志占用的字节数，超出的部分被截断
+            "slot_size": 512,
+            "when": when,
+            "encoding": "utf8",
+            "atomic_append": atomic_append
+        }
+        return flight_recorder_conf
+
     @staticmethod
     # logger 配置
     def get_logger_conf():
@@ -264,22 +564,155 @@ class Logger:
         return logger_conf
 
 
-# 获取日常logger
-def get_logger(app_name: str, log_path: str=None, is_debug=True, is_write_file=True):
-    Logger(log_path=log_path, app_name=app_name, is_debug=is_debug, is_write_file=is_write_file)
+# 获取异步写日志的后台线程，第一次调用时启动，并在程序退出时把剩余日志写完
+def _get_async_writer():
+    global _async_writer, _atexit_registered
+    with _async_lock:
+        if _async_writer is None:
+            _async_writer = mlogging_handlers.QueueListenerMP(queue.Queue(-1))
+            _async_writer.start()
+            if not _atexit_registered:
+                atexit.register(close)
+                _atexit_registered = True
+        return _async_writer
+
+
+# 把logger的handler交给后台线程，logger本身只保留一个入队的QueueHandlerMP
+def _attach_async_writer(logger_name):
+    logger = logging.getLogger(logger_name)
+    writer = _get_async_writer()
+    writer.add_route(logger_name, logger.handlers)
+    logger.handlers = [mlogging_handlers.QueueHandlerMP(writer.queue)]
+
+
+# 等待异步队列中已有的日志全部写入，并flush所有handler
+def flush():
+    if _async_writer is not None:
+        _async_writer.flush()
+    for name in list(LOGGING['loggers']):
+        for handler in logging.getLogger(name).handlers:
+            handler.flush()
+
+
+# 停止后台写线程，剩余日志写完后，异步logger恢复为直接写入，get_async_logger返回的logger关闭，
+# 之后的日志忽略，程序退出时自动调用
+def close():
+    global _async_writer
+    with _async_lock:
+        writer, _async_writer = _async_writer, None
+        if writer is None:
+            return
+        for async_logger in _async_loggers.values():
+            async_logger.disabled = True
+        writer.stop()
+        for name in _async_logger_names:
+            logging.getLogger(name).handlers = writer.routes.get(name, [])
+        _async_logger_names.clear()
+        writer.flush()
+
+
+# 获取handler的监控指标快照：写入的日志条数、字节数、等待文件锁和写文件的耗时、切分日志的次数和耗时、
+# 出错次数，限流丢弃的日志数，请求汇总条数和各route的请求耗时，异步模式下还有队列中等待写入的日志数。app_name为None时返回所有app的指标
+def get_metrics(app_name=None):
+    apps = {}
+    for app, handler_names in list(_app_handlers.items()):
+        if app_name is not None and app != app_name:
+            continue
+        apps[app] = {}
+        for name in handler_names:
+            handler = getattr(logging, '_handlers').get(name)
+            if hasattr(handler, 'snapshot_metrics'):
+                apps[app][name] = handler.snapshot_metrics()
+        for name, limiter_filter in _app_limiters.get(app, {}).items():
+            apps[app][name + '_limiter'] = limiter_filter.snapshot_metrics()
+        if app in _app_contexts:
+            apps[app]['request_context'] = _app_contexts[app].snapshot_metrics()
+    metrics = {'time': time.time(), 'pid': os.getpid(), 'apps': apps}
+    writer = _async_writer
+    if writer is not None:
+        metrics['async_writer'] = writer.snapshot_metrics()
+    for name, async_logger in list(_async_loggers.items()):
+        metrics.setdefault('async_loggers', {})[name] = async_logger.snapshot_metrics()
+    return metrics
+
+
+# fork后在子进程中调用。后台写线程和写监控指标的线程不随fork复制，父进程的锁可能正被其他线程持有：
+# 重新创建锁，启动新的写线程，异步logger的QueueHandlerMP和AsyncLogger改用新线程的队列，
+# 父进程队列中尚未写入的日志由父进程写，子进程不再写一遍；写监控指标的线程重新启动
+def _after_fork():
+    global _async_writer, _async_lock, _register_lock
+    _async_lock = threading.Lock()
+    _register_lock = threading.RLock()
+    inherited = _async_writer
+    if inherited is not None:
+        _async_writer = mlogging_handlers.QueueListenerMP(queue.Queue(-1), inherited.batch_size)
+        for name, handlers in inherited.routes.items():
+            _async_writer.add_route(name, handlers)
+        _async_writer.start()
+        for name in _async_logger_names:
+            logging.getLogger(name).handlers = [mlogging_handlers.QueueHandlerMP(_async_writer.queue)]
+        for async_logger in _async_loggers.values():
+            async_logger.writer = _async_writer
+            async_logger.queue = _async_writer.queue
+    for args in _metrics_dumpers.values():
+        threading.Thread(target=_dump_metrics, args=args, daemon=True).start()
+
+
+# mlogging_handlers先于本模块导入，子进程中它的handler先重置，再启动新的写线程
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+# 后台线程，每隔interval秒把app的监控指标追加到metrics.log，按when切分
+def _dump_metrics(app_name, filename, interval, when):
+    writer = mlogging_handlers.TimedRotatingFileHandlerMP(filename, when=when, delay=True, atomic_append=True)
+    while True:
+        time.sleep(interval)
+        try:
+            writer.emit_bytes((json.dumps(get_metrics(app_name)) + '\n').encode('utf-8'))
+        except Exception:
+            pass
+
+
+# 获取日常logger，参数见Logger._setup，async_mode为True时日志由后台线程写入，调用方只负责入队
+def get_logger(app_name: str, log_path: str=None, *args, **kwargs):
+    Logger(app_name, log_path, *args, **kwargs)
     logger_name = '%s_logger' % app_name
     logger = logging.getLogger(logger_name)
     return logger
 
 
-# 获取request logger
-def get_request_logger(app_name: str, log_path: str=None, is_debug=True, is_write_file=True):
-    Logger(app_name=app_name, log_path=log_path, is_debug=is_debug, is_write_file=is_write_file)
+# 获取request logger，参数见Logger._setup
+def get_request_logger(app_name: str, log_path: str=None, *args, **kwargs):
+    Logger(app_name, log_path, *args, **kwargs)
     logger_name = '%s_request_logger' % app_name
     logger = logging.getLogger(logger_name)
     return logger
 
 
+# 获取asyncio使用的logger，日志调用只把日志放入有界队列，不阻塞事件循环，由后台线程写入文件，
+# request为True时对应request logger，其余参数与get_logger相同。队列满时丢弃日志并计数，
+# 用await logger.flush()等待写入，await logger.aclose()关闭，写过日志的事件循环关闭时（如asyncio.run返回前）自动关闭，
+# 程序退出时自动写完队列中的日志
+def get_async_logger(app_name: str, log_path: str=None, request=False, queue_size=10000, **kwargs):
+    if request:
+        logger = get_request_logger(app_name=app_name, log_path=log_path, **kwargs)
+    else:
+        logger = get_logger(app_name=app_name, log_path=log_path, **kwargs)
+    # log_async导入asyncio，较慢，用到时才导入
+    if __package__:
+        from . import log_async
+    else:
+        import log_async
+    writer = _get_async_writer()
+    with _async_lock:
+        async_logger = _async_loggers.get(logger.name)
+        if async_logger is None or async_logger.disabled:
+            async_logger = log_async.AsyncLogger(logger, writer, queue_size=queue_size)
+            _async_loggers[logger.name] = async_logger
+        return async_logger
+
+
 if __name__ == '__main__':
     # 临时目录
     log_root_path = '/Users/lr/my_git/data_scripts/pypip/build/lib/log_tool'
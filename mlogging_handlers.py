@@ -19,22 +19,392 @@ Additional handler : RotatingFileHandler and TimedRotatingFileHandler
                         for MultiProcess
 """
 
-from logging import StreamHandler, FileHandler
-from logging.handlers import RotatingFileHandler, TimedRotatingFileHandler
+from logging import Handler, StreamHandler, FileHandler, Formatter, ERROR, _checkLevel
+from logging.handlers import RotatingFileHandler, TimedRotatingFileHandler, QueueHandler, QueueListener
+import calendar
 import fcntl
+import gzip
+import locale
+import lzma
+import mmap
+import queue
+import shutil
+import struct
 import time
 import os
 import re
-import shutil
+import threading
+import weakref
 from stat import ST_MTIME
 
 
+class _BufferFlusher(object):
+    """
+    One background thread per process which flushes the buffers of the
+    buffered file handlers once they are older than their flush_interval.
+    """
+
+    def __init__(self):
+        self.handlers = weakref.WeakSet()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def add(self, handler):
+        with self.lock:
+            self.handlers.add(handler)
+        self.start()
+
+    def start(self):
+        """
+        Start the thread unless it runs already. A forked child has none,
+        its buffered handlers start it again with their first record.
+        """
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def after_fork(self):
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def _run(self):
+        while True:
+            handlers = list(self.handlers)
+            time.sleep(max(min([h.flush_interval for h in handlers] or [1.0]) / 2, _MIN_FLUSH_SLEEP))
+            now = time.time()
+            for handler in handlers:
+                handler.flush_if_due(now)
+
+
+# the flusher thread never sleeps less than this, whatever the flush_interval
+# of a handler changed after it was made
+_MIN_FLUSH_SLEEP = 0.01
+_buffer_flusher = _BufferFlusher()
+
+
+class _Housekeeper(object):
+    """
+    One background thread per process which compresses rotated log files
+    and deletes those beyond the retention limits, so that none of this
+    runs on an emitting thread. Jobs are kept per file, a file asked for
+    several times before its job ran is done once.
+    """
+
+    def __init__(self):
+        self.jobs = {}
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def schedule(self, handler, delay=0):
+        """
+        Have handler.housekeep() called in delay seconds.
+        """
+        with self.cond:
+            due = time.time() + delay
+            job = self.jobs.get(handler.baseFilename)
+            if job is None or due < job[0]:
+                self.jobs[handler.baseFilename] = (due, handler)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def after_fork(self):
+        """
+        The thread does not survive a fork. The jobs are left to the
+        parent, the child starts a thread again when it schedules one.
+        """
+        self.jobs = {}
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def _run(self):
+        while True:
+            with self.cond:
+                now = time.time()
+                while not any(due <= now for due, _ in self.jobs.values()):
+                    timeout = min([due for due, _ in self.jobs.values()] or [now + 3600]) - now
+                    self.cond.wait(timeout)
+                    now = time.time()
+                ready = [filename for filename, (due, _) in self.jobs.items() if due <= now]
+                handlers = [self.jobs.pop(filename)[1] for filename in ready]
+            for handler in handlers:
+                try:
+                    again = handler.housekeep()
+                except Exception:
+                    again = True
+                if again:
+                    self.schedule(handler, handler.settle_time)
+
+
+_housekeeper = _Housekeeper()
+# the FileHandlerMP instances of the process, for _after_fork()
+_mp_handlers = weakref.WeakSet()
+
+
+class _WriteLock(object):
+    """
+    The lock taken to write to a file, one per file and process, shared by
+    the handlers of the process writing to it. A thread lock keeps the
+    threads of the process out of each other's way, as a flock taken
+    through a shared descriptor would not, a flock on the lock file the
+    other processes. The lock file is opened on first use and closed along
+    with the last handler using it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+        self.users = 0
+
+    def acquire(self):
+        self.lock.acquire()
+        try:
+            if self.file is None:
+                self.file = _open_creating_dir(self.path, "a+")
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        except BaseException:
+            self.lock.release()
+            raise
+
+    def release(self):
+        try:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        finally:
+            self.lock.release()
+
+    def after_fork(self):
+        """
+        Let go of the lock file inherited from the parent and of the thread
+        lock, which a thread of the parent may have held.
+        """
+        self.lock = threading.Lock()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+# the write locks of the process by path of the file they lock
+_write_locks = {}
+_write_locks_lock = threading.Lock()
+
+
+def _get_write_lock(filename, path):
+    """
+    Return the write lock of filename, taken on the lock file at path,
+    counting one more handler using it.
+    """
+    with _write_locks_lock:
+        lock = _write_locks.get(filename)
+        if lock is None:
+            lock = _write_locks[filename] = _WriteLock(path)
+        lock.users += 1
+        return lock
+
+
+def _put_write_lock(filename):
+    """
+    Count one handler less using the write lock of filename, closing it
+    when it was the last one.
+    """
+    with _write_locks_lock:
+        lock = _write_locks[filename]
+        lock.users -= 1
+        if not lock.users:
+            del _write_locks[filename]
+            lock.after_fork()
+
+
+def _after_fork():
+    """
+    Run in the child after a fork. logging reinitialises the handler
+    locks itself, the rest the child inherited is shared with the parent
+    and is let go of here, see FileHandlerMP._after_fork().
+    """
+    global _write_locks_lock
+    _buffer_flusher.after_fork()
+    _housekeeper.after_fork()
+    _write_locks_lock = threading.Lock()
+    for lock in _write_locks.values():
+        lock.after_fork()
+    for handler in list(_mp_handlers):
+        handler._after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+_COMPRESSED_SUFFIXES = ('.gz', '.xz')
+
+# within this many bytes of max_bytes every write of a size rotating handler
+# checks the size of the file and writes under the rollover lock
+_SIZE_MARGIN = 64 * 1024
+# farther from it a process asks the file again after writing 1/_SIZE_STEPS of
+# the room left, up to that many processes don't get past the margin unseen
+_SIZE_STEPS = 64
+# the count of the rotations of a file, mapped from .<file>.rotations : a
+# process which renames the file away bumps it, so that the others, writing
+# to the renamed file until they next ask its size, find out at once
+_rotation_count = struct.Struct('Q')
+
+# entry of a <file>.idx sidecar index : created time of a record, offset of
+# the record in the file
+INDEX_SUFFIX = '.idx'
+index_entry = struct.Struct('<dQ')
+
+# counters and histograms of HandlerMetrics, the same for every handler
+RECORDS, BYTES, WRITES, ERRORS, ROLLOVERS, BATCHES, DROPS = range(7)
+COUNTERS = ('records', 'bytes', 'writes', 'errors', 'rollovers', 'batches', 'drops')
+LOCK_WAIT, WRITE, ROLLOVER = range(3)
+HISTOGRAMS = ('lock_wait', 'write', 'rollover')
+# latencies are counted in power of two buckets of nanoseconds, up to 2**40 ns, about 18 minutes
+_BUCKETS = 41
+# a histogram is its total, its maximum and its buckets, after the counters
+_HISTOGRAM_SIZE = 2 + _BUCKETS
+_SIZE = len(COUNTERS) + len(HISTOGRAMS) * _HISTOGRAM_SIZE
+_WRITE_BASE = len(COUNTERS) + WRITE * _HISTOGRAM_SIZE
+
+
+class HandlerMetrics(object):
+    """
+    Counters and latency histograms of one handler.
+
+    The values are a plain list updated without a lock of its own: the
+    handler only records while holding its own lock, which logging takes
+    around emit() anyway, so recording costs a few list operations.
+    snapshot() may run concurrently and then sees values a record old.
+    """
+
+    def __init__(self):
+        self.values = [0] * _SIZE
+
+    def add(self, counter, n=1):
+        """
+        Add n to one of the counters, RECORDS, BYTES, etc.
+        """
+        self.values[counter] += n
+
+    def observe(self, histogram, ns):
+        """
+        Count a duration of ns nanoseconds in one of the histograms,
+        LOCK_WAIT, WRITE or ROLLOVER.
+        """
+        values = self.values
+        base = len(COUNTERS) + histogram * _HISTOGRAM_SIZE
+        values[base] += ns
+        if ns > values[base + 1]:
+            values[base + 1] = ns
+        values[base + 2 + min(ns.bit_length(), _BUCKETS - 1)] += 1
+
+    def write(self, ns, n):
+        """
+        Count one write of n bytes which took ns nanoseconds, the same as
+        add(WRITES), add(BYTES, n) and observe(WRITE, ns), in one call.
+        """
+        values = self.values
+        values[WRITES] += 1
+        values[BYTES] += n
+        values[_WRITE_BASE] += ns
+        if ns > values[_WRITE_BASE + 1]:
+            values[_WRITE_BASE + 1] = ns
+        values[_WRITE_BASE + 2 + min(ns.bit_length(), _BUCKETS - 1)] += 1
+
+    def snapshot(self):
+        """
+        Return the counters, and for each histogram the count, the total,
+        the maximum and the p50/p99/p999 estimated as the upper bound of
+        their bucket, as a dict.
+        """
+        values = list(self.values)
+        result = dict(zip(COUNTERS, values))
+        for histogram, name in enumerate(HISTOGRAMS):
+            base = len(COUNTERS) + histogram * _HISTOGRAM_SIZE
+            buckets = values[base + 2:base + _HISTOGRAM_SIZE]
+            count = sum(buckets)
+            stats = {'count': count, 'total_ms': values[base] / 1e6, 'max_us': values[base + 1] / 1e3}
+            for label, p in (('p50_us', 0.5), ('p99_us', 0.99), ('p999_us', 0.999)):
+                stats[label] = _bucket_percentile(buckets, count, p)
+            result[name] = stats
+        return result
+
+
+def _bucket_percentile(buckets, count, p):
+    """
+    Return the upper bound, in microseconds, of the bucket holding the
+    p-quantile, or None for an empty histogram.
+    """
+    if not count:
+        return None
+    rank = count * p
+    seen = 0
+    for i, n in enumerate(buckets):
+        seen += n
+        if seen >= rank:
+            return (1 << i) / 1e3
+    return (1 << (len(buckets) - 1)) / 1e3
+
+
+def _open_creating_dir(path, mode):
+    """
+    Open path, creating its directory first if it does not exist yet, as
+    with delay the directory of a log file is only made when the first
+    record is written.
+    """
+    try:
+        return open(path, mode)
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return open(path, mode)
+
+
+def _rename_index(source, target):
+    """
+    Move the index of the log file source along with it to target.
+    """
+    try:
+        os.rename(source + INDEX_SUFFIX, target + INDEX_SUFFIX)
+    except FileNotFoundError:
+        _remove_index(target)
+
+
+def _remove_index(path):
+    """
+    Remove the index of the log file path, compressed or not, if any.
+    """
+    if path.endswith(_COMPRESSED_SUFFIXES):
+        path = path.rsplit('.', 1)[0]
+    try:
+        os.remove(path + INDEX_SUFFIX)
+    except FileNotFoundError:
+        pass
+
+
 class StreamHandlerMP(StreamHandler):
     """
     A handler class which writes logging records, appropriately formatted,
     to a stream. Use for multiprocess.
+
+    Every handler of this module keeps a HandlerMetrics as self.metrics.
     """
 
+    def __init__(self, stream=None):
+        StreamHandler.__init__(self, stream)
+        self.metrics = HandlerMetrics()
+
+    def handleError(self, record):
+        """
+        Count the error, then report it as logging.Handler does.
+        """
+        self.metrics.add(ERRORS)
+        StreamHandler.handleError(self, record)
+
+    def snapshot_metrics(self):
+        """
+        Return a snapshot of the handler's metrics as a dict.
+        """
+        return self.metrics.snapshot()
+
     def emit(self, record):
         """
         Emit a record.
@@ -53,8 +423,503 @@ class FileHandlerMP(FileHandler, StreamHandlerMP):
     """
     A handler class which writes formatted logging records to disk files 
         for multiprocess
+
+    If atomic_append is true, records are written with a single os.write on
+    a descriptor opened with O_APPEND. The kernel positions every such write
+    at the end of file atomically, so no lock file and no seek is needed.
+    Records longer than max_atomic_size fall back to the locked path.
+
+    If buffer_size is set, encoded records are collected in memory and
+    written with one write when buffer_size bytes are waiting, when the
+    oldest is flush_interval seconds old, or at once for records of
+    flush_level and above, so that crash evidence is never held back. A
+    buffer only ever holds whole records and goes to the file in a single
+    O_APPEND write, so records of different processes never interleave.
+
+    If index_interval is set, a sparse index of the file is kept in
+    <file>.idx : every process appends one (created, offset) entry,
+    packed with index_entry, for the first record it writes in every
+    index_interval seconds. log_query uses it to find a time range without
+    reading the file from the start.
+
+    The lock files are opened once per process and kept open, taking a
+    lock is a single flock. The handlers of a process writing the same
+    file share its write lock. A forked child, such as a worker of a server
+    which set up logging before forking, closes the descriptors it
+    inherited, lock files included as a lock taken through a shared
+    descriptor would not keep the parent out, and drops the records still
+    buffered, which the parent writes. It opens its own on first use.
+    The lock files are hidden files next to the file they lock.
     """
 
+    def __init__(self, filename, mode='a', encoding=None, delay=False,
+                 atomic_append=False, max_atomic_size=65536,
+                 buffer_size=0, flush_interval=1.0, flush_level=ERROR, index_interval=0):
+        # the text stream is not opened when the records only go through the O_APPEND descriptor
+        FileHandler.__init__(self, filename, mode, encoding, delay or atomic_append or bool(buffer_size))
+        self._init_mp(atomic_append, max_atomic_size, buffer_size, flush_interval, flush_level, index_interval,
+                      delay)
+
+    def _init_mp(self, atomic_append, max_atomic_size, buffer_size, flush_interval, flush_level, index_interval=0,
+                 delay=True):
+        """
+        Set up the O_APPEND write path, the write buffer and the index.
+        Unless delay is set, the O_APPEND descriptor is opened here if the
+        records go through it, the stream having been left closed, the
+        other descriptors are opened lazily.
+        """
+        if buffer_size and not flush_interval > 0:
+            raise ValueError("flush_interval must be positive with buffer_size: %r" % flush_interval)
+        self.metrics = HandlerMetrics()
+        self.atomic_append = atomic_append
+        self.max_atomic_size = max_atomic_size
+        self._append_fd = None
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.flush_level = flush_level
+        self._buffer = bytearray()
+        self._buffer_since = None
+        self._buffer_created = None
+        self.index_interval = index_interval
+        self._index_fd = None
+        self._next_index = 0
+        # bytes written by this process after which the file size is checked again
+        self._size_check_at = 0
+        # the shared count of the rotations, mapped on first use, and its value when last seen
+        self._rotations = None
+        self._rotations_seen = 0
+        # open lock files by path
+        self._lock_files = {}
+        # the shared lock of the writes, see _acquire_write_lock()
+        self._write_lock = None
+        if buffer_size:
+            _buffer_flusher.add(self)
+        _mp_handlers.add(self)
+        if not delay and self.stream is None:
+            self._append_fd = self._open_append_fd(self.mode == 'w')
+
+    def _after_fork(self):
+        """
+        Let go of what the child inherited from the parent : the buffered
+        records, the descriptors of the file, its index and the lock files,
+        and the metrics.
+        """
+        self._buffer.clear()
+        self._buffer_since = None
+        self._buffer_created = None
+        for f in self._lock_files.values():
+            f.close()
+        self._lock_files = {}
+        self._close_append_fd()
+        if self.stream is not None:
+            # whatever the stream still buffers was the parent's, it goes to
+            # /dev/null instead of being written a second time
+            null = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(null, self.stream.fileno())
+            os.close(null)
+            try:
+                self.stream.close()
+            except OSError:
+                pass
+            self.stream = None
+        self._next_index = 0
+        self._size_check_at = 0
+        self.metrics = HandlerMetrics()
+
+    def _lock_file(self, path):
+        """
+        Return the lock file at path, opened on first use and kept open.
+        The handler lock keeps the threads of the process out of each
+        other's way, the flock on it the other processes.
+        """
+        f = self._lock_files.get(path)
+        if f is None:
+            f = self._lock_files[path] = _open_creating_dir(path, "a+")
+        return f
+
+    def _open(self):
+        """
+        Open the stream, creating the directory of the file if needed, so
+        that with delay nothing is created before the first record.
+        """
+        try:
+            return FileHandler._open(self)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+            return FileHandler._open(self)
+
+    def _open_append_fd(self, truncate=False):
+        """
+        Open the O_APPEND descriptor used by the lock-free write path,
+        emptying the file with truncate.
+        """
+        flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT | (os.O_TRUNC if truncate else 0)
+        try:
+            return os.open(self.baseFilename, flags, 0o644)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+            return os.open(self.baseFilename, flags, 0o644)
+
+    def _close_append_fd(self):
+        if self._append_fd is not None:
+            os.close(self._append_fd)
+            self._append_fd = None
+        if self._index_fd is not None:
+            os.close(self._index_fd)
+            self._index_fd = None
+
+    def _index(self, created, offset, fd):
+        """
+        Append an index entry for the record created at created and written
+        at offset, if it is the first one of its index interval. fd is the
+        descriptor the record went through. No index is opened for a file
+        which another process has rotated away already, its entries would
+        end up in the index of the new file.
+        """
+        if created < self._next_index:
+            return
+        self._next_index = (int(created / self.index_interval) + 1) * self.index_interval
+        if self._index_fd is None:
+            try:
+                if os.fstat(fd).st_ino != os.stat(self.baseFilename).st_ino:
+                    return
+            except FileNotFoundError:
+                return
+            self._index_fd = os.open(self.baseFilename + INDEX_SUFFIX, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                                     0o644)
+        os.write(self._index_fd, index_entry.pack(created, offset))
+
+    def format_bytes(self, record):
+        """
+        Format a record and encode it, terminator included, the same way
+        the stream would. A binary formatter, one with binary set, encodes
+        the record itself.
+        """
+        if getattr(self.formatter, 'binary', False):
+            return self.formatter.format_bytes(record)
+        encoding = self.encoding
+        if encoding is None or encoding == 'locale':
+            encoding = locale.getpreferredencoding(False)
+        msg = self.format(record) + self.terminator
+        return msg.encode(encoding, getattr(self, 'errors', None) or 'strict')
+
+    def _write_atomic(self, data, created=None):
+        """
+        Write already encoded data with one os.write on the O_APPEND
+        descriptor. Regular files only return short on errors such as a
+        full disk, in which case the rest is written as well. created is
+        the time of the first record in data, for the index.
+        """
+        if self._append_fd is None:
+            self._append_fd = self._open_append_fd()
+        started = time.perf_counter_ns()
+        written = os.write(self._append_fd, data)
+        while written < len(data):
+            written += os.write(self._append_fd, data[written:])
+        self.metrics.write(time.perf_counter_ns() - started, written)
+        if self.index_interval:
+            # the O_APPEND write left the offset at the end of our data
+            offset = os.lseek(self._append_fd, 0, os.SEEK_CUR) - written
+            self._index(time.time() if created is None else created, offset, self._append_fd)
+
+    def _acquire_write_lock(self):
+        """
+        Take the write lock of the file, shared by the handlers of the
+        process writing it, counting the wait.
+        """
+        if self._write_lock is None:
+            self._write_lock = _get_write_lock(self.baseFilename, self._lock_path('lock'))
+        started = time.perf_counter_ns()
+        self._write_lock.acquire()
+        self.metrics.observe(LOCK_WAIT, time.perf_counter_ns() - started)
+        return self._write_lock
+
+    def _emit_locked(self, record):
+        """
+        Write a record to the stream while holding the write lock.
+        """
+        lock = self._acquire_write_lock()
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            # nobody else writes while we hold the lock, the end moves by our record only
+            start = self.stream.seek(0, os.SEEK_END)
+            started = time.perf_counter_ns()
+            FileHandlerMP.emit(self, record)
+            self.metrics.write(time.perf_counter_ns() - started, self.stream.tell() - start)
+            if self.index_interval:
+                self._index(record.created, start, self.stream.fileno())
+        finally:
+            lock.release()
+
+    def _flock(self, f):
+        """
+        Take the lock on the open lock file f, counting the wait.
+        """
+        started = time.perf_counter_ns()
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        self.metrics.observe(LOCK_WAIT, time.perf_counter_ns() - started)
+
+    def _flush_buffer(self):
+        """
+        Write out the buffered records with a single write, under the write
+        lock unless atomic_append is set.
+        """
+        if not self._buffer:
+            return
+        data = bytes(self._buffer)
+        created = self._buffer_created
+        self._buffer.clear()
+        self._buffer_since = None
+        if self.atomic_append:
+            self._write_atomic(data, created)
+        else:
+            self._write_locked(data, created)
+
+    def flush_if_due(self, now):
+        """
+        Flush the buffer if its oldest record has waited flush_interval.
+        Called from the background flusher thread.
+        """
+        if self._buffer_since is None or now - self._buffer_since < self.flush_interval:
+            return
+        self.acquire()
+        try:
+            self._flush_buffer()
+        except Exception:
+            pass
+        finally:
+            self.release()
+
+    def flush(self):
+        """
+        Flush the write buffer and the stream.
+        """
+        self.acquire()
+        try:
+            self._flush_buffer()
+        finally:
+            self.release()
+        StreamHandler.flush(self)
+
+    def _write_locked(self, data, created=None):
+        """
+        Write already encoded data while holding the write lock.
+        """
+        lock = self._acquire_write_lock()
+        try:
+            self._write_atomic(data, created)
+        finally:
+            lock.release()
+
+    def _write_mp(self, data, record=None):
+        """
+        Write already encoded records either into the buffer, lock-free
+        through O_APPEND or, by default and for data longer than
+        max_atomic_size, through the locked path. record is the record data
+        was made from, if there is a single one.
+        """
+        created = record.created if record is not None else None
+        if self.buffer_size:
+            if self._buffer_since is None:
+                self._buffer_since = time.time()
+                self._buffer_created = created
+                if _buffer_flusher.thread is None:
+                    _buffer_flusher.start()
+            self._buffer += data
+            if len(self._buffer) >= self.buffer_size or (record is not None and record.levelno >= self.flush_level):
+                self._flush_buffer()
+        elif self.atomic_append and len(data) <= self.max_atomic_size:
+            self._write_atomic(data, created)
+        else:
+            self._write_locked(data, created)
+
+    def _writes_append_fd(self):
+        """
+        Tell whether the records only go through the O_APPEND descriptor,
+        as they do with atomic_append, buffer_size or a binary formatter.
+        """
+        return bool(self.buffer_size or self.atomic_append or getattr(self.formatter, 'binary', False))
+
+    def setFormatter(self, fmt):
+        """
+        Set the formatter, closing the stream if it is left unused.
+        """
+        Handler.setFormatter(self, fmt)
+        if self.stream is not None and self._writes_append_fd():
+            self.acquire()
+            try:
+                self.stream.close()
+                self.stream = None
+                if self._append_fd is None:
+                    self._append_fd = self._open_append_fd()
+            finally:
+                self.release()
+
+    def _emit_mp(self, record):
+        """
+        Write a record in whichever way _write_mp() would. The default,
+        unbuffered locked path keeps writing text through the stream.
+        """
+        self.metrics.add(RECORDS)
+        if self._writes_append_fd():
+            self._write_mp(self.format_bytes(record), record)
+        else:
+            self._emit_locked(record)
+
+    def _lock_path(self, kind):
+        """
+        Return the lock file of the given kind for this file, a hidden file
+        in the same directory, so that it goes away with the logs.
+        """
+        dir_name, base_name = os.path.split(self.baseFilename)
+        return os.path.join(dir_name, '.%s.%s' % (base_name, kind))
+
+    def _acquire_rollover_lock(self):
+        """
+        Take the rollover lock shared by every process writing this file.
+        """
+        f = self._lock_file(self._lock_path('rollover'))
+        self._flock(f)
+        return f
+
+    @staticmethod
+    def _release_rollover_lock(f):
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _open_inode(self):
+        """
+        Return the inode of the file this handler writes to, or None if
+        nothing is open yet.
+        """
+        if self._append_fd is not None:
+            return os.fstat(self._append_fd).st_ino
+        if self.stream is not None:
+            return os.fstat(self.stream.fileno()).st_ino
+        return None
+
+    def _file_size(self):
+        """
+        Return the size of the file this handler writes to.
+        """
+        if self._append_fd is not None:
+            return os.fstat(self._append_fd).st_size
+        if self.stream is not None:
+            return os.fstat(self.stream.fileno()).st_size
+        try:
+            return os.stat(self.baseFilename).st_size
+        except FileNotFoundError:
+            return 0
+
+    def _size_due(self, max_bytes):
+        """
+        Tell whether the file is within _SIZE_MARGIN bytes of max_bytes, in
+        which case the write goes through _write_capped().
+
+        The bytes this process wrote are counted in memory anyway (the
+        BYTES counter of the metrics), the file itself is only asked once
+        this process has written 1/_SIZE_STEPS of the room left before the
+        margin at the last check, as the other processes write to the file
+        as well. Far from max_bytes that is rarely, within the margin it is
+        every write. In between, the shared count of the rotations tells
+        whether another process has rotated the file, which then is no
+        longer the one this process writes to.
+        """
+        written = self.metrics.values[BYTES]
+        if written < self._size_check_at:
+            return _rotation_count.unpack_from(self._rotations)[0] != self._rotations_seen
+        if self._rotations is None:
+            self._map_rotations()
+        # read before the size, a rotation in between shows at the next write
+        self._rotations_seen = _rotation_count.unpack_from(self._rotations)[0]
+        room = max_bytes - _SIZE_MARGIN - self._file_size()
+        if room <= 0:
+            return True
+        self._size_check_at = written + room // _SIZE_STEPS + 1
+        return False
+
+    def _map_rotations(self):
+        """
+        Map the shared count of the rotations of the file.
+        """
+        path = self._lock_path('rotations')
+        try:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # growing the file to the same size keeps what another process wrote
+            if os.fstat(fd).st_size < _rotation_count.size:
+                os.ftruncate(fd, _rotation_count.size)
+            self._rotations = mmap.mmap(fd, _rotation_count.size)
+        finally:
+            os.close(fd)
+
+    def _count_rotation(self):
+        """
+        Bump the shared count of the rotations, the file having been renamed
+        away. Called with the rollover lock held.
+        """
+        if self._rotations is None:
+            self._map_rotations()
+        self._rotations_seen = _rotation_count.unpack_from(self._rotations)[0] + 1
+        _rotation_count.pack_into(self._rotations, 0, self._rotations_seen)
+
+    def _write_capped(self, max_bytes, write, *args):
+        """
+        Call write(*args) while holding the rollover lock, rotating the
+        file first if it has reached max_bytes. The size is checked and the
+        data written by one process at a time, and those writing to the
+        file unchecked stop as soon as it is rotated, so together they get
+        past max_bytes by at most one write, a record or, with buffer_size,
+        a buffer.
+        """
+        f = self._acquire_rollover_lock()
+        try:
+            try:
+                st = os.stat(self.baseFilename)
+            except FileNotFoundError:
+                st = None
+            if st is not None and self._rotated_elsewhere(st):
+                self._reopen()
+            elif st is not None and st.st_size >= max_bytes:
+                self._rollover_locked(f)
+            write(*args)
+        finally:
+            self._release_rollover_lock(f)
+
+    def _rotated_elsewhere(self, st):
+        """
+        Tell whether the file on disk, as given by its stat result, is no
+        longer the one this handler has open, i.e. another process renamed
+        it away.
+        """
+        inode = self._open_inode()
+        return inode is not None and st.st_ino != inode
+
+    def _reopen(self, mode='a'):
+        """
+        Close the stream and the O_APPEND descriptor and open baseFilename
+        again, which after a rename is the new, empty file : the stream,
+        or the O_APPEND descriptor if the records only go through it.
+        """
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        self._close_append_fd()
+        # the new file gets an index entry for its first record, its size is asked again
+        self._next_index = 0
+        self._size_check_at = 0
+        if self._writes_append_fd():
+            self._append_fd = self._open_append_fd(mode == 'w')
+            return
+        self.mode = mode
+        try:
+            self.stream = self._open()
+        finally:
+            self.mode = 'a'
+
     def emit(self, record):
         """
         Emit a record.
@@ -66,6 +931,29 @@ class FileHandlerMP(FileHandler, StreamHandlerMP):
             self.stream = self._open()
         StreamHandlerMP.emit(self, record)
 
+    def close(self):
+        """
+        Write out the buffer, then close the stream and the O_APPEND
+        descriptor.
+        """
+        self.acquire()
+        try:
+            self._flush_buffer()
+            self._close_append_fd()
+            for f in self._lock_files.values():
+                f.close()
+            self._lock_files = {}
+            if self._write_lock is not None:
+                _put_write_lock(self.baseFilename)
+                self._write_lock = None
+            if self._rotations is not None:
+                self._rotations.close()
+                self._rotations = None
+                self._size_check_at = 0
+        finally:
+            self.release()
+        FileHandler.close(self)
+
 
 class RotatingFileHandlerMP(RotatingFileHandler, FileHandlerMP):
     """
@@ -74,30 +962,73 @@ class RotatingFileHandlerMP(RotatingFileHandler, FileHandlerMP):
 
     Based on logging.RotatingFileHandler, modified for Multiprocess
     """
-    _lock_dir = str(os.path.abspath(__file__).rsplit('/', 1)[0]) + '/.lock'
+
+    def __init__(self, filename, mode='a', maxBytes=0, backupCount=0, encoding=None, delay=False,
+                 atomic_append=False, max_atomic_size=65536,
+                 buffer_size=0, flush_interval=1.0, flush_level=ERROR, index_interval=0):
+        RotatingFileHandler.__init__(self, filename, mode, maxBytes, backupCount, encoding,
+                                     delay or atomic_append or bool(buffer_size))
+        self._init_mp(atomic_append, max_atomic_size, buffer_size, flush_interval, flush_level, index_interval,
+                      delay)
+
+    def shouldRollover(self, record):
+        """
+        Determine if rollover should occur.
+
+        Unlike logging.RotatingFileHandler, the record is not formatted.
+        emit() doesn't ask, it writes under the rollover lock once the file
+        is close to maxBytes, see FileHandlerMP._write_capped().
+        """
+        return self.maxBytes > 0 and self._file_size() >= self.maxBytes
 
     def doRollover(self):
         """
         Do a rollover, as described in __init__().
-        For multiprocess, we use shutil.copy instead of rename.
-        """
-
-        self.stream.close()
-        if self.backupCount > 0:
-            for i in range(self.backupCount - 1, 0, -1):
-                sfn = "%s.%d" % (self.baseFilename, i)
-                dfn = "%s.%d" % (self.baseFilename, i + 1)
-                if os.path.exists(sfn):
-                    if os.path.exists(dfn):
-                        os.remove(dfn)
-                    shutil.copy(sfn, dfn)
-            dfn = self.baseFilename + ".1"
-            if os.path.exists(dfn):
-                os.remove(dfn)
-            if os.path.exists(self.baseFilename):
-                shutil.copy(self.baseFilename, dfn)
-        self.mode = 'w'
-        self.stream = self._open()
+
+        For multiprocess, the files are shifted with os.rename while holding
+        the rollover lock. A process which finds that baseFilename is no
+        longer the file it has open knows another process already rotated
+        it, and only reopens.
+        """
+        f = self._acquire_rollover_lock()
+        try:
+            self._rollover_locked(f)
+        finally:
+            self._release_rollover_lock(f)
+
+    def _rollover_locked(self, f):
+        """
+        The rollover of doRollover(), the rollover lock f being held.
+        """
+        started = time.perf_counter_ns()
+        self._flush_buffer()
+        try:
+            try:
+                st = os.stat(self.baseFilename)
+            except FileNotFoundError:
+                st = None
+            if st is not None and self._rotated_elsewhere(st):
+                self._reopen()
+                return
+            if self.backupCount > 0:
+                for i in range(self.backupCount - 1, 0, -1):
+                    sfn = "%s.%d" % (self.baseFilename, i)
+                    dfn = "%s.%d" % (self.baseFilename, i + 1)
+                    if os.path.exists(sfn):
+                        os.rename(sfn, dfn)
+                    _rename_index(sfn, dfn)
+                if st is not None:
+                    os.rename(self.baseFilename, self.baseFilename + ".1")
+                    _rename_index(self.baseFilename, self.baseFilename + ".1")
+                    self._count_rotation()
+                self._reopen()
+            else:
+                _remove_index(self.baseFilename)
+                self._reopen('w')
+            self.metrics.add(ROLLOVERS)
+        finally:
+            self._size_check_at = 0
+            self.metrics.observe(ROLLOVER, time.perf_counter_ns() - started)
 
     def emit(self, record):
         """
@@ -106,17 +1037,14 @@ class RotatingFileHandlerMP(RotatingFileHandler, FileHandlerMP):
         Output the record to the file, catering for rollover as described
         in doRollover().
 
-        For multiprocess, we use file lock. Any better method ?
+        For multiprocess, we use file lock, or a single O_APPEND write if
+        atomic_append is set.
         """
         try:
-            if self.shouldRollover(record):
-                self.doRollover()
-            file_lock = self._lock_dir + '/' + os.path.basename(self.baseFilename) + '.' + record.levelname
-            f = open(file_lock, "w+")
-            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
-            FileHandlerMP.emit(self, record)
-            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
-            f.close()
+            if self.maxBytes > 0 and self._size_due(self.maxBytes):
+                self._write_capped(self.maxBytes, self._emit_mp, record)
+            else:
+                self._emit_mp(record)
         except (KeyboardInterrupt, SystemExit):
             raise
         except:
@@ -130,14 +1058,37 @@ class TimedRotatingFileHandlerMP(TimedRotatingFileHandler, FileHandlerMP):
 
     If backupCount is > 0, when rollover is done, no more than backupCount
     files are kept - the oldest ones are deleted.
+
+    Rotated files are also deleted once older than max_age seconds, and
+    the oldest ones while all of them take more than max_total_bytes. With
+    compress set to 'gzip' or 'lzma', rotated files are compressed at
+    compress_level into <file>.gz or <file>.xz, once nobody wrote to them
+    for settle_time seconds, as a process may still write a few late
+    records to the file it had open. Compression and retention run in a
+    background thread, never in doRollover(), and under a non-blocking
+    lock, so that one process does them for all the processes writing the
+    file.
     """
-    _lock_dir = str(os.path.abspath(__file__).rsplit('/', 1)[0]) + '/.lock'
 
-    def __init__(self, filename, when='h', interval=1, backup_count=0, encoding=None, delay=0, utc=0):
-        FileHandlerMP.__init__(self, filename, 'a', encoding, delay)
+    def __init__(self, filename, when='h', interval=1, backup_count=0, encoding=None, delay=0, utc=0,
+                 atomic_append=False, max_atomic_size=65536,
+                 buffer_size=0, flush_interval=1.0, flush_level=ERROR,
+                 compress=None, compress_level=6, max_age=0, max_total_bytes=0, settle_time=60,
+                 index_interval=0):
+        FileHandlerMP.__init__(self, filename, 'a', encoding, delay, atomic_append, max_atomic_size,
+                               buffer_size, flush_interval, flush_level, index_interval)
         self.encoding = encoding
         self.when = when.upper()
         self.backup_count = backup_count
+        # getFilesToDelete() of the stdlib reads backupCount
+        self.backupCount = backup_count
+        if compress not in (None, 'gzip', 'lzma'):
+            raise ValueError("compress must be None, 'gzip' or 'lzma': %r" % compress)
+        self.compress = compress
+        self.compress_level = compress_level
+        self.max_age = max_age
+        self.max_total_bytes = max_total_bytes
+        self.settle_time = settle_time
         self.utc = utc
         # Calculate the real rollover interval, which is just the number of
         # seconds between rollovers.  Also set the filename suffix used when
@@ -178,74 +1129,372 @@ class TimedRotatingFileHandlerMP(TimedRotatingFileHandler, FileHandlerMP):
 
         if interval != 1:
             raise ValueError("Invalid rollover interval, must be 1")
+        self.interval = interval
+        # due at once : the first record finds out through doRollover() whether
+        # the live file, left by an earlier process, belongs to an interval that
+        # is over, in which case it is rotated before anything is added to it.
+        # Nothing is touched on disk before that
+        self.rolloverAt = 0
+        self._started = False
+
+    def _period_bounds(self, t):
+        """
+        Return the (start, end) epoch seconds of the rollover interval which
+        contains the time t.
+
+        Seconds, minutes and hours are counted back from the broken down time
+        so that zones with a non whole hour offset work as well. Days and
+        weeks go through mktime/timegm, which normalise an out of range day.
+        """
+        if self.utc:
+            time_tuple = time.gmtime(t)
+        else:
+            time_tuple = time.localtime(t)
+        year, month, day, hour, minute, second, week_day = time_tuple[:7]
+        t = int(t)
+        if self.when == 'S':
+            return t, t + 1
+        elif self.when == 'M':
+            start = t - second
+            return start, start + 60
+        elif self.when == 'H':
+            start = t - minute * 60 - second
+            return start, start + 3600
+        if self.when.startswith('W'):
+            day -= (week_day - self.dayOfWeek) % 7
+            days = 7
+        else:
+            days = 1
+        if self.utc:
+            start = calendar.timegm((year, month, day, 0, 0, 0, 0, 0, 0))
+            end = calendar.timegm((year, month, day + days, 0, 0, 0, 0, 0, 0))
+        else:
+            start = int(time.mktime((year, month, day, 0, 0, 0, 0, 0, -1)))
+            end = int(time.mktime((year, month, day + days, 0, 0, 0, 0, 0, -1)))
+        return start, max(end, t + 1)
+
+    def computeRollover(self, currentTime):
+        """
+        Work out the rollover time based on the specified time.
+        """
+        return self._period_bounds(currentTime)[1]
 
     def shouldRollover(self, record):
         """
         Determine if rollover should occur.
 
-        record is not used, as we are just comparing times, but it is needed so
-        the method signatures are the same
+        This is a single float comparison against the cached deadline. Once
+        the deadline has passed, doRollover() checks the file on disk to find
+        out whether another process has rotated it already.
         """
-        if not os.path.exists(self.baseFilename):
-            # print "file don't exist"
-            return 0
+        return self._rollover_due(record.created)
 
-        c_time = time.localtime(time.time())
-        m_time = time.localtime(os.stat(self.baseFilename)[ST_MTIME])
-        if self.when == "S" and c_time[5] != m_time[5]:
-            # print "c_time:", c_time[5], "m_time:", m_time[5]
-            return 1
-        elif self.when == 'M' and c_time[4] != m_time[4]:
-            # print "c_time:", c_time[4], "m_time:", m_time[4]
-            return 1
-        elif self.when == 'H' and c_time[3] != m_time[3]:
-            # print "c_time:", c_time[3], "m_time:", m_time[3]
-            return 1
-        elif (self.when == 'MIDNIGHT' or self.when == 'D') and c_time[2] != m_time[2]:
-            # print "c_time:", c_time[2], "m_time:", m_time[2]
-            return 1
-        elif self.when == 'W' and c_time[1] != m_time[1]:
-            # print "c_time:", c_time[1], "m_time:", m_time[1]
-            return 1
-        else:
+    def _rollover_due(self, now):
+        """
+        Tell whether a rollover is due for a record created at now.
+        """
+        if now < self.rolloverAt:
             return 0
+        self.rolloverAt = self.computeRollover(now)
+        return 1
+
+    @staticmethod
+    def _read_rollover_state(f):
+        """
+        Read the (inode, interval start) of the live file, which the process
+        that last rotated it keeps in the rollover lock file.
+        """
+        f.seek(0)
+        try:
+            inode, start = f.read().split()
+            return int(inode), int(start)
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _write_rollover_state(f, inode, start):
+        f.seek(0)
+        f.truncate()
+        f.write('%d %d' % (inode, start))
+        f.flush()
 
     def doRollover(self):
         """
         do a rollover; in this case, a date/time stamp is appended to the filename
         when the rollover happens.  However, you want the file to be named for the
-        start of the interval, not the current time.  If there is a backup count,
-        then we have to get a list of matching filenames, sort them and remove
-        the one with the oldest suffix.
+        start of the interval, not the current time.  Deleting the oldest
+        files and compressing is left to the background thread, see
+        housekeep().
 
-        For multiprocess, we use shutil.copy instead of rename.
+        For multiprocess, the file is renamed while holding the rollover lock,
+        so a rollover costs the same whatever the size of the file. The lock
+        file records the inode of the live file and the interval it belongs
+        to. A process which finds that baseFilename is no longer the file it
+        has open, or that the live file already belongs to the current
+        interval, knows another process rotated it and only reopens. This
+        leaves exactly one rotated file per interval.
         """
-        if self.stream:
-            self.stream.close()
-        # get the time that this sequence started at and make it a TimeTuple
-        # t = self.rolloverAt - self.interval
-        t = int(time.time())
-        if self.utc:
-            time_tuple = time.gmtime(t)
+        self._start()
+        started = time.perf_counter_ns()
+        f = self._acquire_rollover_lock()
+        try:
+            try:
+                st = os.stat(self.baseFilename)
+            except FileNotFoundError:
+                self._flush_buffer()
+                self._reopen()
+                return
+            # the buffered records belong to the interval that is over, they
+            # go to the old file, but only after its mtime has been taken
+            self._flush_buffer()
+            if self._rotated_elsewhere(st):
+                self._reopen()
+                return
+            start = self._period_bounds(time.time())[0]
+            state = self._read_rollover_state(f)
+            if state is not None and state[0] == st.st_ino:
+                t = state[1]
+            else:
+                # a file we know nothing about, go by its last write
+                t = self._period_bounds(st[ST_MTIME])[0]
+            if t >= start:
+                # the live file belongs to the current interval already
+                if state is None or state[0] != st.st_ino:
+                    self._write_rollover_state(f, st.st_ino, t)
+                return
+            # get the time that this sequence started at and make it a TimeTuple
+            if self.utc:
+                time_tuple = time.gmtime(t)
+            else:
+                time_tuple = time.localtime(t)
+            dfn = self.baseFilename + "." + time.strftime(self.suffix, time_tuple)
+            if os.path.exists(dfn):
+                os.remove(dfn)
+            _remove_index(dfn)
+            os.rename(self.baseFilename, dfn)
+            _rename_index(self.baseFilename, dfn)
+            self._reopen()
+            self._write_rollover_state(f, self._open_inode(), start)
+            self.metrics.add(ROLLOVERS)
+            if self._housekeeping():
+                # the oldest files are deleted in the background, see housekeep()
+                _housekeeper.schedule(self, 0 if self.compress is None else self.settle_time)
+        finally:
+            self._release_rollover_lock(f)
+            self.metrics.observe(ROLLOVER, time.perf_counter_ns() - started)
+
+    def _start(self):
+        """
+        Have the files rotated before a restart dealt with as well, on the
+        first rollover, that of the first record, so that a handler made
+        with delay touches nothing on disk until a record is written.
+        """
+        if self._started:
+            return
+        self._started = True
+        if self._housekeeping():
+            _housekeeper.schedule(self, self.settle_time)
+
+    def _housekeeping(self):
+        """
+        Tell whether rotated files are compressed or deleted at all.
+        """
+        return bool(self.compress or self.backup_count > 0 or self.max_age or self.max_total_bytes)
+
+    def _rotated_files(self):
+        """
+        Return the rotated files of baseFilename, compressed or not, oldest
+        first. Leftovers of an interrupted compression are removed.
+        """
+        dir_name, base_name = os.path.split(self.baseFilename)
+        prefix = base_name + "."
+        files = []
+        try:
+            file_names = os.listdir(dir_name)
+        except FileNotFoundError:
+            # delay is set and nothing was written yet
+            return files
+        for file_name in file_names:
+            if not file_name.startswith(prefix):
+                continue
+            suffix = file_name[len(prefix):]
+            if suffix.endswith('.part'):
+                os.remove(os.path.join(dir_name, file_name))
+                continue
+            if suffix.endswith(_COMPRESSED_SUFFIXES):
+                suffix = suffix.rsplit('.', 1)[0]
+            if self.extMatch.match(suffix):
+                files.append((self._suffix_key(suffix), os.path.join(dir_name, file_name)))
+        files.sort()
+        return [path for key, path in files]
+
+    def _suffix_key(self, suffix):
+        """
+        Return what rotated files sort by, oldest first, given their suffix.
+        """
+        return suffix
+
+    def _compress_file(self, path):
+        """
+        Compress a rotated file next to it, keeping its mtime, and remove
+        it. Return the path of the compressed file.
+        """
+        if self.compress == 'gzip':
+            target = path + '.gz'
+            opener = lambda name: gzip.open(name, 'wb', compresslevel=self.compress_level)
         else:
-            time_tuple = time.localtime(t)
-        dfn = self.baseFilename + "." + time.strftime(self.suffix, time_tuple)
-        if os.path.exists(dfn):
-            os.remove(dfn)
-        if os.path.exists(self.baseFilename):
-            shutil.copy(self.baseFilename, dfn)
-            # print "%s -> %s" % (self.baseFilename, dfn)
-            # os.rename(self.baseFilename, dfn)
-        if self.backup_count > 0:
-            # find the oldest log file and delete it
-            # s = glob.glob(self.baseFilename + ".20*")
-            # if len(s) > self.backup_count:
-            #    s.sort()
-            #    os.remove(s[0])
-            for s in self.getFilesToDelete():
-                os.remove(s)
-        self.mode = 'w'
-        self.stream = self._open()
+            target = path + '.xz'
+            opener = lambda name: lzma.open(name, 'wb', preset=self.compress_level)
+        part = target + '.part'
+        st = os.stat(path)
+        with open(path, 'rb') as src, opener(part) as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+        os.utime(part, (st.st_atime, st.st_mtime))
+        os.rename(part, target)
+        os.remove(path)
+        return target
+
+    def _files_to_delete(self, files):
+        """
+        Return the files, among the rotated files oldest first, which are
+        beyond backup_count, max_age or max_total_bytes.
+        """
+        doomed = set()
+        if self.backup_count > 0 and len(files) > self.backup_count:
+            doomed.update(files[:len(files) - self.backup_count])
+        if self.max_age or self.max_total_bytes:
+            cutoff = time.time() - self.max_age
+            total = 0
+            for path in reversed(files):
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                total += st.st_size
+                if self.max_age and st.st_mtime < cutoff:
+                    doomed.add(path)
+                elif self.max_total_bytes and total > self.max_total_bytes:
+                    doomed.add(path)
+        return [path for path in files if path in doomed]
+
+    def housekeep(self):
+        """
+        Compress the rotated files and delete those beyond the retention
+        limits. Runs in the background thread, under a lock which only one
+        process at a time gets. Return True if it has to run again later,
+        because another process holds the lock or a rotated file was
+        written to less than settle_time seconds ago.
+        """
+        f = _open_creating_dir(self._lock_path('housekeeping'), "a")
+        try:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return True
+            again = False
+            files = self._rotated_files()
+            if self.compress:
+                now = time.time()
+                for i, path in enumerate(files):
+                    if path.endswith(_COMPRESSED_SUFFIXES):
+                        continue
+                    if now - os.stat(path).st_mtime < self.settle_time:
+                        again = True
+                        continue
+                    files[i] = self._compress_file(path)
+            for path in self._files_to_delete(files):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                _remove_index(path)
+            return again
+        finally:
+            f.close()
+
+    def emit_bytes(self, data, record=None):
+        """
+        Write data, whole records formatted and encoded elsewhere (by a log
+        collector client, or once for all its files by LevelRoutingHandlerMP),
+        rotating the file first if the interval is over. record is the record
+        data was made from, if there is a single one.
+        """
+        self.acquire()
+        try:
+            if record is not None:
+                self.metrics.add(RECORDS)
+            self._write_rotating(record.created if record is not None else time.time(), self._write_mp, data, record)
+        finally:
+            self.release()
+
+    def _write_rotating(self, now, write, *args):
+        """
+        Call write(*args) for data created at now, rotating the file first
+        if the interval is over.
+        """
+        if self._rollover_due(now):
+            self.doRollover()
+        write(*args)
+
+    def emit_batch(self, records):
+        """
+        Emit records, those of a batch of QueueListenerMP, formatted one by
+        one and written together by emit_bytes_batch(). They are filtered
+        as handle() would, their level is the caller's business.
+        """
+        items = []
+        for record in records:
+            if not self.filter(record):
+                continue
+            try:
+                items.append((record, self.format_bytes(record)))
+            except Exception:
+                self.handleError(record)
+        if items:
+            self.emit_bytes_batch(items)
+
+    def emit_bytes_batch(self, items):
+        """
+        Write items, (record, data) pairs of records formatted and encoded
+        elsewhere, together : one write under one lock for all of them,
+        one more for each rollover between them.
+        """
+        self.acquire()
+        try:
+            data = bytearray()
+            first = None
+            count = 0
+            top = 0
+            for record, encoded in items:
+                if first is not None and record.created >= self.rolloverAt:
+                    self._write_batch(data, first, count, top)
+                    data = bytearray()
+                    first = None
+                    count = top = 0
+                data += encoded
+                if first is None:
+                    first = record
+                count += 1
+                top = max(top, record.levelno)
+            if first is not None:
+                self._write_batch(data, first, count, top)
+        finally:
+            self.release()
+
+    def _write_batch(self, data, first, count, top):
+        """
+        Write the data of count records, first being the first of them and
+        top the highest of their levels, as emit_bytes() would.
+        """
+        try:
+            self.metrics.add(RECORDS, count)
+            self._write_rotating(first.created, self._write_mp, bytes(data), first)
+            if self.buffer_size and top >= self.flush_level:
+                self._flush_buffer()
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(first)
 
     def emit(self, record):
         """
@@ -254,18 +1503,410 @@ class TimedRotatingFileHandlerMP(TimedRotatingFileHandler, FileHandlerMP):
         Output the record to the file, catering for rollover as described
         in doRollover().
 
-        For multiprocess, we use file lock. Any better method ?
+        For multiprocess, we use file lock, or a single O_APPEND write if
+        atomic_append is set.
         """
         try:
-            if self.shouldRollover(record):
-                self.doRollover()
-            file_lock = self._lock_dir + '/' + os.path.basename(self.baseFilename) + '.' + record.levelname
-            f = open(file_lock, "w+")
-            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
-            FileHandlerMP.emit(self, record)
-            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
-            f.close()
+            self._write_rotating(record.created, self._emit_mp, record)
         except (KeyboardInterrupt, SystemExit):
             raise
         except:
             self.handleError(record)
+
+
+class HybridRotatingFileHandlerMP(TimedRotatingFileHandlerMP):
+    """
+    Handler for logging to a file, rotating the log file at certain timed
+    intervals or when it reaches max_bytes, whichever comes first.
+
+    Rotated files are named <file>.<interval suffix>.N, N counting from 1
+    within an interval, e.g. info.log.2024-05-01.1, info.log.2024-05-01.2.
+    The size is tracked in memory, see FileHandlerMP._size_due(), and a
+    rotation is a rename under the rollover lock, so neither a record nor a
+    rollover costs more for a bigger file. Within the last _SIZE_MARGIN
+    bytes the records are written under the rollover lock, so that with
+    any number of processes a file gets past max_bytes by one record at
+    most, one buffer with buffer_size. The other keyword arguments are
+    those of TimedRotatingFileHandlerMP.
+    """
+
+    def __init__(self, filename, max_bytes=0, when='h', **kwargs):
+        TimedRotatingFileHandlerMP.__init__(self, filename, when, **kwargs)
+        self.max_bytes = max_bytes
+        self.extMatch = re.compile(self.extMatch.pattern[:-1] + r"\.\d+$")
+
+    def _rollover_due(self, now):
+        """
+        Tell whether a rollover is due for a record created at now, because
+        the interval is over or the file is full.
+        """
+        if now >= self.rolloverAt:
+            self.rolloverAt = self.computeRollover(now)
+            return 1
+        return self.max_bytes > 0 and self._file_size() >= self.max_bytes
+
+    def _write_rotating(self, now, write, *args):
+        """
+        Call write(*args) for data created at now, rotating the file first
+        if the interval is over, and through _write_capped() once the file
+        is close to max_bytes.
+        """
+        if now >= self.rolloverAt:
+            self.rolloverAt = self.computeRollover(now)
+            self.doRollover()
+        if self.max_bytes > 0 and self._size_due(self.max_bytes):
+            self._write_capped(self.max_bytes, write, *args)
+        else:
+            write(*args)
+
+    def _suffix_key(self, suffix):
+        suffix, n = suffix.rsplit('.', 1)
+        return suffix, int(n)
+
+    def _rotated_name(self, t):
+        """
+        Return the name of the next rotated file of the interval starting
+        at t, numbered after those already there, compressed or not.
+        """
+        if self.utc:
+            time_tuple = time.gmtime(t)
+        else:
+            time_tuple = time.localtime(t)
+        prefix = self.baseFilename + "." + time.strftime(self.suffix, time_tuple) + "."
+        dir_name, base_name = os.path.split(prefix)
+        last = 0
+        for file_name in os.listdir(dir_name):
+            if file_name.startswith(base_name):
+                n = file_name[len(base_name):].split('.', 1)[0]
+                if n.isdigit():
+                    last = max(last, int(n))
+        return prefix + str(last + 1)
+
+    def doRollover(self):
+        """
+        Do a rollover if the live file belongs to an interval that is over
+        or has reached max_bytes.
+
+        As in TimedRotatingFileHandlerMP.doRollover(), the rollover lock
+        file tells the interval of the live file, and a process which finds
+        that another one rotated the file already only reopens.
+        """
+        self._start()
+        f = self._acquire_rollover_lock()
+        try:
+            self._rollover_locked(f)
+        finally:
+            self._release_rollover_lock(f)
+
+    def _rollover_locked(self, f):
+        """
+        The rollover of doRollover(), the rollover lock f being held.
+        """
+        started = time.perf_counter_ns()
+        try:
+            try:
+                st = os.stat(self.baseFilename)
+            except FileNotFoundError:
+                self._flush_buffer()
+                self._reopen()
+                return
+            self._flush_buffer()
+            if self._rotated_elsewhere(st):
+                self._reopen()
+                return
+            start = self._period_bounds(time.time())[0]
+            state = self._read_rollover_state(f)
+            if state is not None and state[0] == st.st_ino:
+                t = state[1]
+            else:
+                t = self._period_bounds(st[ST_MTIME])[0]
+            if t >= start and (not self.max_bytes or os.stat(self.baseFilename).st_size < self.max_bytes):
+                if state is None or state[0] != st.st_ino:
+                    self._write_rollover_state(f, st.st_ino, t)
+                return
+            dfn = self._rotated_name(t)
+            os.rename(self.baseFilename, dfn)
+            _rename_index(self.baseFilename, dfn)
+            self._count_rotation()
+            self._reopen()
+            self._write_rollover_state(f, self._open_inode(), start)
+            self.metrics.add(ROLLOVERS)
+            if self._housekeeping():
+                _housekeeper.schedule(self, 0 if self.compress is None else self.settle_time)
+        finally:
+            self._size_check_at = 0
+            self.metrics.observe(ROLLOVER, time.perf_counter_ns() - started)
+
+
+def timed_file_handler(filename, max_bytes=0, **kwargs):
+    """
+    Return a HybridRotatingFileHandlerMP for filename if max_bytes is set,
+    a TimedRotatingFileHandlerMP otherwise.
+    """
+    if max_bytes:
+        return HybridRotatingFileHandlerMP(filename, max_bytes=max_bytes, **kwargs)
+    return TimedRotatingFileHandlerMP(filename, **kwargs)
+
+
+class QueueHandlerMP(QueueHandler):
+    """
+    Handler which puts the records of a logger in async mode on the queue
+    of QueueListenerMP.
+
+    Unlike logging.handlers.QueueHandler, which formats the record and
+    queues the result as its message, only the arguments are merged into
+    the message, as they may change before the writer thread formats the
+    record, and the exception is formatted into exc_text, as the traceback
+    keeps its frames alive. The formatters behind the writer thread get
+    the record as the logger made it, JsonFormatter and BinaryFormatter
+    keep the exception a field of its own.
+    """
+    _exception_formatter = Formatter()
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self._exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class QueueListenerMP(QueueListener):
+    """
+    Writer thread for loggers in async mode.
+
+    The loggers only put their records on the queue. One thread, shared by
+    all of them, takes the records off in batches, routes every record to
+    the handlers of the logger it came from by record.name, and flushes
+    those handlers once the queue is empty. Buffered handlers are not
+    flushed, the background flusher writes their buffers after
+    flush_interval, or a record of flush_level at once. Handlers with an
+    emit_batch() method,
+    the TimedRotatingFileHandlerMP family, get the records of a batch all
+    at once and write them together.
+    """
+
+    def __init__(self, queue, batch_size=256):
+        QueueListener.__init__(self, queue, respect_handler_level=True)
+        self.routes = {}
+        self.batch_size = batch_size
+        self.metrics = HandlerMetrics()
+
+    def add_route(self, name, handlers):
+        """
+        Send the records of the logger called name to handlers.
+        """
+        self.routes[name] = list(handlers)
+        self.handlers = tuple({id(h): h for hs in self.routes.values() for h in hs}.values())
+
+    def handle(self, record):
+        """
+        Handle a record with the handlers of the logger it came from.
+        """
+        record = self.prepare(record)
+        for handler in self.routes.get(record.name, ()):
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+    def handle_batch(self, records):
+        """
+        Handle records, those of a batch, with the handlers of the loggers
+        they came from. The records go to a handler in the order they were
+        queued, to those with emit_batch() in one call per batch.
+        """
+        batches = {}
+        for record in records:
+            record = self.prepare(record)
+            for handler in self.routes.get(record.name, ()):
+                if record.levelno >= handler.level:
+                    if hasattr(handler, 'emit_batch'):
+                        batches.setdefault(handler, []).append(record)
+                    else:
+                        handler.handle(record)
+        for handler, batch in batches.items():
+            handler.emit_batch(batch)
+
+    def _monitor(self):
+        """
+        Monitor the queue for records, handle as many as are waiting, up to
+        batch_size, and then, if none are left, flush the handlers that
+        don't buffer.
+
+        This method runs on a separate, internal thread.
+        The thread will terminate if it sees a sentinel object in the queue.
+        """
+        q = self.queue
+        stop = False
+        while not stop:
+            batch = [self.dequeue(True)]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(q.get_nowait())
+                except queue.Empty:
+                    break
+            records = [record for record in batch if record is not self._sentinel]
+            stop = len(records) < len(batch)
+            self.handle_batch(records)
+            if stop or q.empty():
+                for handler in self.handlers:
+                    if not getattr(handler, 'buffer_size', 0):
+                        handler.flush()
+            metrics = self.metrics
+            metrics.add(BATCHES)
+            metrics.add(RECORDS, len(records))
+            for _ in batch:
+                q.task_done()
+
+    def enqueue_sentinel(self):
+        """
+        Put the sentinel on the queue, waiting for room if it is a bounded
+        one.
+        """
+        self.queue.put(self._sentinel)
+
+    def flush(self):
+        """
+        Wait until every record queued so far has been written, then flush
+        the handlers.
+        """
+        if self._thread is not None:
+            self.queue.join()
+        for handler in self.handlers:
+            handler.flush()
+
+    def snapshot_metrics(self):
+        """
+        Return the metrics of the writer thread, with the number of records
+        waiting in the queue.
+        """
+        result = self.metrics.snapshot()
+        result['queue_depth'] = self.queue.qsize()
+        return result
+
+
+class LevelRoutingHandlerMP(Handler):
+    """
+    Handler which formats a record once and writes it to every file its
+    level is routed to, each file once.
+
+    routes maps a level (name or number) to the list of files records of
+    that level go to; a level which is not listed uses the routes of the
+    nearest listed level below it, and goes nowhere if there is none. The
+    files are written by one TimedRotatingFileHandlerMP each, made with the
+    remaining keyword arguments, or a HybridRotatingFileHandlerMP if they
+    set max_bytes, so per record the work is one format and one dict lookup
+    whatever the number of levels. A batch of QueueListenerMP goes to each
+    file in a single write, under a single lock.
+    """
+
+    def __init__(self, routes, **kwargs):
+        Handler.__init__(self)
+        self.metrics = HandlerMetrics()
+        self.writers = {}
+        self.table = {}
+        for level, filenames in routes.items():
+            writers = []
+            for filename in filenames:
+                filename = os.path.abspath(filename)
+                if filename not in self.writers:
+                    self.writers[filename] = timed_file_handler(filename, **kwargs)
+                if self.writers[filename] not in writers:
+                    writers.append(self.writers[filename])
+            self.table[_checkLevel(level)] = tuple(writers)
+        self.encoding = kwargs.get('encoding')
+        if self.encoding is None:
+            self.encoding = locale.getpreferredencoding(False)
+        # the writers buffer, QueueListenerMP leaves flushing them to the background flusher
+        self.buffer_size = kwargs.get('buffer_size', 0)
+
+    def _writers_for(self, levelno):
+        """
+        Look up the destinations of a level missing from the table and
+        cache them.
+        """
+        lower = [level for level in self.table if level <= levelno]
+        writers = self.table[max(lower)] if lower else ()
+        self.table[levelno] = writers
+        return writers
+
+    def emit(self, record):
+        """
+        Emit a record.
+
+        Format and encode it once, then hand the bytes to the writer of
+        each of its files.
+        """
+        try:
+            writers = self.table.get(record.levelno)
+            if writers is None:
+                writers = self._writers_for(record.levelno)
+            if not writers:
+                return
+            self.metrics.add(RECORDS)
+            data = self._format_bytes(record)
+            for writer in writers:
+                writer.emit_bytes(data, record)
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+    def emit_batch(self, records):
+        """
+        Emit records, those of a batch of QueueListenerMP : each is
+        formatted once, then every writer gets the records of its file in
+        one call, see TimedRotatingFileHandlerMP.emit_bytes_batch(). They
+        are filtered as handle() would, their level is the caller's
+        business.
+        """
+        batches = {}
+        for record in records:
+            if not self.filter(record):
+                continue
+            try:
+                writers = self.table.get(record.levelno)
+                if writers is None:
+                    writers = self._writers_for(record.levelno)
+                if not writers:
+                    continue
+                self.metrics.add(RECORDS)
+                data = self._format_bytes(record)
+            except Exception:
+                self.handleError(record)
+                continue
+            for writer in writers:
+                batches.setdefault(writer, []).append((record, data))
+        for writer, items in batches.items():
+            writer.emit_bytes_batch(items)
+
+    def _format_bytes(self, record):
+        """
+        Format a record and encode it, terminator included.
+        """
+        if getattr(self.formatter, 'binary', False):
+            return self.formatter.format_bytes(record)
+        return (self.format(record) + '\n').encode(self.encoding)
+
+    def handleError(self, record):
+        self.metrics.add(ERRORS)
+        Handler.handleError(self, record)
+
+    def snapshot_metrics(self):
+        """
+        Return the metrics of the handler, with those of the writer of
+        each file under 'files'.
+        """
+        result = self.metrics.snapshot()
+        result['files'] = {filename: writer.metrics.snapshot() for filename, writer in self.writers.items()}
+        return result
+
+    def flush(self):
+        for writer in self.writers.values():
+            writer.flush()
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+        Handler.close(self)
@@ -0,0 +1,201 @@
+"""
+The asyncio logger: shared writer thread, fork, records written in order
+without blocking the loop, closed by the loop shutdown. The lag and the
+throughput themselves are measured by log_benchmark.py --event-loop.
+"""
+
+import asyncio
+import atexit
+import json
+import logging.handlers
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import log_simple_util
+
+TASKS = 4
+RECORDS = 5000
+# only a loop blocked until the records are written is this late, not a slow or busy machine
+MAX_LAG = 1.0
+
+
+def _log_from_loop(logger):
+    """
+    Log TASKS * RECORDS records from as many tasks, giving the loop back
+    every 10 records, while a probe measures how late the loop wakes it
+    from 1 ms sleeps. Return the largest lag.
+    """
+    lags = []
+
+    async def task(t):
+        for seq in range(RECORDS):
+            logger.info('loop t=%d seq=%d payload=%s end', t, seq, 'x' * 100)
+            if seq % 10 == 9:
+                await asyncio.sleep(0)
+
+    async def probe(done):
+        while not done.is_set():
+            started = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lags.append(time.perf_counter() - started - 0.001)
+
+    async def main():
+        done = asyncio.Event()
+        prober = asyncio.ensure_future(probe(done))
+        await asyncio.gather(*[task(t) for t in range(TASKS)])
+        done.set()
+        await prober
+
+    asyncio.run(main())
+    return max(lags)
+
+
+def _lines(path):
+    with open(path) as f:
+        return f.read().splitlines()
+
+
+class AsyncLoggerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        log_simple_util.close()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def _get(self, app_name, **kwargs):
+        return log_simple_util.get_async_logger(app_name, self.dir, is_debug=False, banner=False, **kwargs)
+
+    def test_one_writer_and_exit_hook(self):
+        first = self._get('async_shared_a')
+        second = self._get('async_shared_b', request=True)
+        self.assertIs(first.writer, second.writer)
+        self.assertIs(first.writer, log_simple_util._async_writer)
+        log_simple_util.close()
+        self.assertTrue(first.disabled)
+        with mock.patch.object(atexit, 'register') as register:
+            third = self._get('async_shared_a')
+        self.assertIsNot(third, first)
+        self.assertFalse(third.disabled)
+        register.assert_not_called()
+
+    def test_async_mode_queued_once(self):
+        logger = self._get('async_mode_app', async_mode=True)
+        handlers = logger.writer.routes[logger.name]
+        self.assertFalse([h for h in handlers if isinstance(h, logging.handlers.QueueHandler)])
+        for i in range(100):
+            logger.info('record %d', i)
+        logger.close()
+        lines = _lines(os.path.join(self.dir, 'async_mode_app', 'info.log'))
+        self.assertEqual(len([line for line in lines if ' - record ' in line]), 100)
+
+    def test_exception_json(self):
+        sync_logger = log_simple_util.get_logger('exc_sync', self.dir, is_debug=False, banner=False,
+                                                 record_format='json')
+        queued = log_simple_util.get_logger('exc_queued', self.dir, is_debug=False, banner=False,
+                                            record_format='json', async_mode=True)
+        async_logger = self._get('exc_async', record_format='json')
+        for logger in (sync_logger, queued, async_logger):
+            try:
+                raise ValueError('bad value')
+            except ValueError:
+                logger.exception('failed %s', 'request')
+        log_simple_util.flush()
+        records = []
+        for app_name in ('exc_sync', 'exc_queued', 'exc_async'):
+            with open(os.path.join(self.dir, app_name, 'error.log')) as f:
+                record = json.loads(f.read().splitlines()[-1])
+            records.append((record['message'], record['exc_info'].splitlines()[-1]))
+        self.assertEqual(records, [('failed request', 'ValueError: bad value')] * 3)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'needs fork')
+    def test_fork(self):
+        logger = self._get('async_fork_app')
+        queued = log_simple_util.get_logger('async_fork_queued', self.dir, is_debug=False, banner=False,
+                                            async_mode=True)
+        logger.info('parent record')
+        log_simple_util.flush()
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                logger.info('child record')
+                queued.info('child queued record')
+                log_simple_util.flush()
+                code = 0
+            finally:
+                os._exit(code)
+        deadline = time.time() + 10
+        while True:
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if done:
+                break
+            if time.time() > deadline:
+                os.kill(pid, 9)
+                os.waitpid(pid, 0)
+                self.fail('flush() in the child did not return')
+            time.sleep(0.01)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        logger.info('parent record again')
+        log_simple_util.flush()
+        lines = _lines(os.path.join(self.dir, 'async_fork_app', 'info.log'))
+        for message in ('parent record', 'child record', 'parent record again'):
+            self.assertEqual(len([line for line in lines if line.endswith(' - ' + message)]), 1, message)
+        lines = _lines(os.path.join(self.dir, 'async_fork_queued', 'info.log'))
+        self.assertEqual(len([line for line in lines if line.endswith(' - child queued record')]), 1)
+
+    def test_records_in_order_loop_not_blocked(self):
+        logger = self._get('loop_async', queue_size=TASKS * RECORDS)
+        self.assertLess(_log_from_loop(logger), MAX_LAG)
+        # asyncio.run() closed the logger, its records are written
+        self.assertTrue(logger.disabled)
+        self.assertEqual(logger.dropped, 0)
+        seqs = {}
+        for line in _lines(os.path.join(self.dir, 'loop_async', 'info.log')):
+            match = re.search(r' - loop t=(\d+) seq=(\d+) ', line)
+            if match:
+                seqs.setdefault(int(match.group(1)), []).append(int(match.group(2)))
+        self.assertEqual(seqs, {t: list(range(RECORDS)) for t in range(TASKS)})
+
+    def test_closed_on_loop_shutdown(self):
+        logger = self._get('loop_shutdown')
+
+        async def main():
+            async def late():
+                try:
+                    await asyncio.sleep(3600)
+                finally:
+                    logger.info('cancelled task record')
+            asyncio.ensure_future(late())
+            await asyncio.sleep(0)
+            for i in range(100):
+                logger.info('record %d', i)
+
+        asyncio.run(main())
+        self.assertTrue(logger.disabled)
+        lines = _lines(os.path.join(self.dir, 'loop_shutdown', 'info.log'))
+        self.assertEqual([line.split(' - ', 1)[1] for line in lines if ' - ' in line and 'record' in line],
+                         ['record %d' % i for i in range(100)] + ['cancelled task record'])
+        # the writer thread goes on for a logger got again, and for the next loop
+        logger = self._get('loop_shutdown')
+        self.assertFalse(logger.disabled)
+
+        async def again():
+            logger.info('next loop record')
+
+        asyncio.run(again())
+        lines = _lines(os.path.join(self.dir, 'loop_shutdown', 'info.log'))
+        self.assertTrue(lines[-1].endswith(' - next loop record'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,239 @@
+"""
+Size rotation with many processes writing the same file.
+"""
+
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mlogging_handlers
+
+PROCESSES = 16
+RECORDS = 1500
+MAX_BYTES = 256 * 1024
+FORMAT = '%(process)d %(message)s'
+
+
+def _write(handler_class, filename, kwargs, barrier):
+    handler = handler_class(filename, **kwargs)
+    handler.setFormatter(logging.Formatter(FORMAT))
+    logger = logging.getLogger('rotation.%d' % os.getpid())
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+    barrier.wait()
+    for i in range(RECORDS):
+        logger.info('record %06d %s', i, 'x' * (i % 60))
+    handler.close()
+
+
+class SizeRotationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def _run(self, handler_class, **kwargs):
+        filename = os.path.join(self.dir, 'size.log')
+        barrier = multiprocessing.Barrier(PROCESSES)
+        workers = [multiprocessing.Process(target=_write, args=(handler_class, filename, kwargs, barrier))
+                   for _ in range(PROCESSES)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+            self.assertEqual(worker.exitcode, 0)
+        return filename
+
+    def _check(self, filename):
+        # the longest record : '<pid> record 000000 ' plus 59 x and a newline
+        max_record = len('%d record 000000 ' % (1 << 22)) + 59 + 1
+        names = os.listdir(self.dir)
+        rotated = [name for name in names if name != os.path.basename(filename)]
+        self.assertGreaterEqual(len(rotated), 3)
+        for name in rotated:
+            self.assertLessEqual(os.path.getsize(os.path.join(self.dir, name)), MAX_BYTES + max_record, name)
+        lines = 0
+        for name in names:
+            with open(os.path.join(self.dir, name), 'rb') as f:
+                lines += f.read().count(b'\n')
+        self.assertEqual(lines, PROCESSES * RECORDS)
+
+    def test_hybrid_locked(self):
+        filename = self._run(mlogging_handlers.HybridRotatingFileHandlerMP, max_bytes=MAX_BYTES, when='D')
+        self._check(filename)
+
+    def test_hybrid_atomic_append(self):
+        filename = self._run(mlogging_handlers.HybridRotatingFileHandlerMP, max_bytes=MAX_BYTES, when='D',
+                             atomic_append=True)
+        self._check(filename)
+
+    def test_rotating_atomic_append(self):
+        filename = self._run(mlogging_handlers.RotatingFileHandlerMP, maxBytes=MAX_BYTES, backupCount=100,
+                             atomic_append=True)
+        self._check(filename)
+
+    def test_rotated_elsewhere(self):
+        # two handlers stand for two processes, each with its own descriptor
+        filename = os.path.join(self.dir, 'size.log')
+        writer, rotator = [mlogging_handlers.RotatingFileHandlerMP(filename, maxBytes=MAX_BYTES, backupCount=5,
+                                                                   atomic_append=True) for _ in range(2)]
+        for handler in (writer, rotator):
+            handler.setFormatter(logging.Formatter('%(message)s'))
+        record = logging.makeLogRecord({'msg': 'record'})
+        # far from MAX_BYTES, the writer does not ask the size again for a while
+        writer.emit(record)
+        rotator.doRollover()
+        writer.emit(record)
+        writer.close()
+        rotator.close()
+        with open(filename + '.1') as f:
+            self.assertEqual(f.read(), 'record\n')
+        with open(filename) as f:
+            self.assertEqual(f.read(), 'record\n')
+
+
+class StaleFileTest(unittest.TestCase):
+    """
+    A live file left by a process of an earlier interval is rotated by the
+    first record of the next process.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'info.log')
+        with open(self.filename, 'w') as f:
+            f.write('old record\n')
+        self.old = time.time() - 2 * 86400
+        os.utime(self.filename, (self.old, self.old))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def _emit(self, handler):
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        handler.emit(logging.makeLogRecord({'msg': 'new record', 'created': time.time()}))
+        handler.close()
+        rotated = 'info.log.' + time.strftime(handler.suffix, time.localtime(self.old))
+        if isinstance(handler, mlogging_handlers.HybridRotatingFileHandlerMP):
+            rotated += '.1'
+        with open(os.path.join(self.dir, rotated)) as f:
+            self.assertEqual(f.read(), 'old record\n')
+        with open(self.filename) as f:
+            self.assertEqual(f.read(), 'new record\n')
+        # the rollover state is kept next to the file
+        self.assertTrue(os.path.exists(os.path.join(self.dir, '.info.log.rollover')))
+
+    def test_timed(self):
+        self._emit(mlogging_handlers.TimedRotatingFileHandlerMP(self.filename, when='D'))
+
+    def test_timed_atomic_append(self):
+        self._emit(mlogging_handlers.TimedRotatingFileHandlerMP(self.filename, when='D', atomic_append=True))
+
+    def test_hybrid(self):
+        self._emit(mlogging_handlers.HybridRotatingFileHandlerMP(self.filename, when='D', max_bytes=1 << 20))
+
+
+class DelayTest(unittest.TestCase):
+    """
+    With delay, nothing is created on disk before the first record.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'app', 'info.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def _check(self, handler):
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        # long enough for the housekeeping thread to run, were it scheduled
+        time.sleep(0.2)
+        self.assertEqual(os.listdir(self.dir), [])
+        handler.emit(logging.makeLogRecord({'msg': 'record'}))
+        handler.close()
+        with open(self.filename) as f:
+            self.assertEqual(f.read(), 'record\n')
+
+    def test_timed(self):
+        self._check(mlogging_handlers.TimedRotatingFileHandlerMP(self.filename, when='D', delay=True,
+                                                                 backup_count=3, settle_time=0))
+
+    def test_hybrid_atomic_append(self):
+        self._check(mlogging_handlers.HybridRotatingFileHandlerMP(self.filename, when='D', delay=True,
+                                                                  max_bytes=1 << 20, backup_count=3,
+                                                                  settle_time=0, atomic_append=True))
+
+
+class WriteLockTest(unittest.TestCase):
+    """
+    The handlers of a process writing the same file share one write lock,
+    whatever the level of the records, a batch takes it once per file.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'info.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_shared(self):
+        text = mlogging_handlers.TimedRotatingFileHandlerMP(self.filename, when='D')
+        buffered = mlogging_handlers.TimedRotatingFileHandlerMP(self.filename, when='D', buffer_size=1 << 20)
+        for handler in (text, buffered):
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            for level in (logging.INFO, logging.ERROR):
+                handler.emit(logging.makeLogRecord({'msg': 'record', 'levelno': level,
+                                                    'levelname': logging.getLevelName(level)}))
+        buffered.flush()
+        self.assertIs(text._write_lock, buffered._write_lock)
+        self.assertEqual(sorted(name for name in os.listdir(self.dir) if name.endswith('.lock')),
+                         ['.info.log.lock'])
+        text.close()
+        self.assertIn(self.filename, mlogging_handlers._write_locks)
+        buffered.close()
+        self.assertNotIn(self.filename, mlogging_handlers._write_locks)
+        with open(self.filename) as f:
+            self.assertEqual(f.read().count('record\n'), 4)
+
+    def test_routed_batch(self):
+        error_filename = os.path.join(self.dir, 'error.log')
+        handler = mlogging_handlers.LevelRoutingHandlerMP({logging.INFO: [self.filename],
+                                                           logging.ERROR: [self.filename, error_filename]},
+                                                          when='D')
+        handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+
+        def batch(n):
+            return [logging.makeLogRecord({'msg': 'record %d' % i, 'levelno': level,
+                                           'levelname': logging.getLevelName(level)})
+                    for i in range(n) for level in (logging.INFO, logging.ERROR)]
+
+        # the first batch checks the live files, see StaleFileTest
+        handler.emit_batch(batch(1))
+        before = handler.snapshot_metrics()['files']
+        handler.emit_batch(batch(50))
+        after = handler.snapshot_metrics()['files']
+        handler.close()
+        for filename in (self.filename, error_filename):
+            # one lock and one write per file for the whole batch
+            self.assertEqual(after[filename]['lock_wait']['count'] - before[filename]['lock_wait']['count'], 1)
+            self.assertEqual(after[filename]['writes'] - before[filename]['writes'], 1)
+        with open(self.filename) as f:
+            self.assertEqual(len(f.read().splitlines()), 102)
+        with open(error_filename) as f:
+            self.assertEqual(f.read().splitlines(), ['ERROR record 0'] + ['ERROR record %d' % i for i in range(50)])
+
+
+if __name__ == '__main__':
+    unittest.main()